@@ -8,108 +8,235 @@ matplotlib.use('Agg')  # Set non-interactive backend
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 from matplotlib.backends.backend_pdf import PdfPages
-from pydub import AudioSegment
-import io
+import soundfile as sf
+import subprocess
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from event_store import EventStore, IntervalIndex, PHASE_TYPES, PHASE_CODES, CYCLE_PATTERN, json_times
 
 # --- CONFIGURATION CONSTANTS ---
 APNEA_THRESHOLD_FACTOR = 0.1
+MAX_SWEEP_FACTORS = 200  # Upper bound on the apnea factors evaluated by one threshold sweep
+ENVELOPE_HOP_SECONDS = 1  # Envelope frame length (s); e.g. 0.25 or 0.1 for sub-second event timing
+FEATURE_CHUNK_SAMPLES = 1 << 18  # Samples reduced per chunk by the frame kernel, sized to stay in cache
+FEATURE_WORKERS = 1  # Threads reducing the chunks of one recording (e.g. os.cpu_count() on a dedicated server)
+STREAMING_BLOCK_SECONDS = 60  # Seconds of audio read per block in streaming mode
+STREAMING_MIN_DURATION = 600  # Recordings at least this long (s) are analyzed block by block
+FFMPEG_BINARY = 'ffmpeg'
+FFPROBE_BINARY = 'ffprobe'
+DECODE_MONO = False  # Let ffmpeg downmix MP3 input to mono while decoding
+DECODE_SAMPLE_RATE = None  # Let ffmpeg decimate MP3 input to this rate (Hz) while decoding
+FEATURES_FILENAME = 'features.npz'  # Per-session cache of the envelope and waveshow data
+FEATURES_VERSION = 3  # Bump when the feature extraction changes, to invalidate old caches
+ANALYSIS_VERSION = 1  # Bump when the segmentation changes, to invalidate cached analyses (content_store.py)
+WAVEFORM_FILENAME = 'waveform.bin'  # Per-session min/max pyramid served by /waveform
+WAVEFORM_BIN_SAMPLES = 256  # Samples per bin at the finest pyramid level (~6 ms at 44.1 kHz)
+WAVEFORM_MAGIC = b'WFPY'
+WAVEFORM_VERSION = 1
+WAVEFORM_HEADER = struct.Struct('<4sIIIQI4x')  # magic, version, sampling rate, bin samples, base bins, levels
+PREVIEW_FILENAME = 'playback_preview'  # Per-session compressed copy of the audio, one file per format
+PREVIEW_BITRATE = '32k'  # Bit rate of the mono playback preview
+PREVIEW_FORMATS = {  # Preview format -> (ffmpeg encoder, ffmpeg muxer, file extension, MIME type)
+    'opus': ('libopus', 'ogg', 'opus', 'audio/ogg'),
+    'mp3': ('libmp3lame', 'mp3', 'mp3', 'audio/mpeg')
+}
+CYCLE_PHASE_COLUMNS = ['Inhalation (s)', 'Apnea 1 (s)', 'Exhalation (s)', 'Apnea 2 (s)']
+CYCLES_TABLE_HEADER = ['Cycle'] + CYCLE_PHASE_COLUMNS + ['Total Cycle (s)']  # Columns of the cycles table shown on the page
 
-def calculate_amplitude_envelope(y, sr):
+def calculate_amplitude_envelope(y, sr, hop_seconds=ENVELOPE_HOP_SECONDS, workers=None):
     """
-    Calculates the amplitude envelope by averaging the signal in 1-second segments.
+    Calculates the amplitude envelope by averaging the signal in frames of `hop_seconds`.
 
     Args:
         y (np.ndarray): The audio time series.
         sr (int): The sampling rate of the audio.
+        hop_seconds (float): Frame length in seconds. A trailing partial frame is included.
+        workers (int, optional): Threads used by `calculate_frame_features`.
 
     Returns:
         pd.DataFrame: A DataFrame with 'Time', 'Positive_Mean', and 'Negative_Mean' columns.
     """
-    full_seconds = int(len(y) / sr)
-    if full_seconds == 0:
-        return pd.DataFrame({'Time': [], 'Positive_Mean': [], 'Negative_Mean': []})
-    
-    y_truncated = y[:full_seconds * sr]
-    segments = y_truncated.reshape((full_seconds, sr))
-    
-    positive_mean = np.nan_to_num(np.mean(segments, axis=1, where=(segments > 0)))
-    negative_mean = np.nan_to_num(np.mean(segments, axis=1, where=(segments < 0)))
-    
-    time = np.arange(full_seconds)
-    return pd.DataFrame({'Time': time, 'Positive_Mean': positive_mean, 'Negative_Mean': negative_mean})
+    positive_mean, negative_mean, _, _ = calculate_frame_features(y, sr, hop_seconds, workers)
+    return _envelope_frame(positive_mean, negative_mean, hop_seconds)
+
+def calculate_frame_features(y, sr, hop_seconds=ENVELOPE_HOP_SECONDS, workers=None):
+    """
+    Computes the positive mean, negative mean, minimum and maximum of every frame in one pass.
+
+    The signal is walked once in chunks of whole frames small enough to stay in cache,
+    and each chunk gets all four reductions before moving on. Frames are reduced
+    independently, so feeding the signal in blocks of whole frames gives exactly the
+    same values as feeding it in one piece. For the same reason the chunks can be
+    reduced by several threads (the NumPy reductions release the GIL), each writing
+    its own rows of the outputs, with results identical to the serial pass.
+
+    Args:
+        y (np.ndarray): The audio time series.
+        sr (int): The sampling rate of the audio.
+        hop_seconds (float): Frame length in seconds. A trailing partial frame is included.
+        workers (int, optional): Threads reducing chunks at the same time. Defaults to FEATURE_WORKERS.
+
+    Returns:
+        tuple: Positive mean, negative mean, minimum and maximum per frame (float32 arrays).
+    """
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    hop = _hop_samples(sr, hop_seconds)
+    full_frames = len(y) // hop
+    n_frames = full_frames + (1 if len(y) % hop else 0)
+    outputs = tuple(np.empty(n_frames, dtype=np.float32) for _ in range(4))
+
+    frames_per_chunk = max(1, FEATURE_CHUNK_SAMPLES // hop)
+
+    def reduce_chunk(first):
+        last = min(first + frames_per_chunk, full_frames)
+        _reduce_frames(y[first * hop:last * hop].reshape((last - first, hop)), outputs, first)
+
+    _map_chunks(reduce_chunk, range(0, full_frames, frames_per_chunk), workers)
+    if n_frames > full_frames:
+        _reduce_frames(y[full_frames * hop:][None, :], outputs, full_frames)
 
-def identify_phase_intervals(apnea_mask, time):
+    return outputs
+
+def _map_chunks(function, chunk_starts, workers=None):
+    """
+    Calls `function` on every chunk start, serially or on a pool of `workers` threads.
+    """
+    workers = FEATURE_WORKERS if workers is None else workers
+    if workers <= 1 or len(chunk_starts) <= 1:
+        for start in chunk_starts:
+            function(start)
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(chunk_starts))) as pool:
+        # Consuming the results re-raises the first exception of a chunk
+        for _ in pool.map(function, chunk_starts):
+            pass
+
+def _reduce_frames(frames, outputs, first):
+    """
+    Writes the four per-frame reductions of a (frames, samples) chunk into `outputs` at row `first`.
+
+    The means are sums of the clipped frame divided by the count of non-zero samples,
+    which is the mean of `np.mean(frames, axis=1, where=frames > 0)` (and `< 0`). The
+    float32 sums run over the zeros as well, so they are grouped differently from the
+    masked mean and can differ from it by a few float32 ulps (relative error below 1e-5,
+    about 1e-6 in practice). That is far below the resolution of the apnea threshold.
+    The minimum and maximum are exact.
+    """
+    positive_mean, negative_mean, frame_min, frame_max = outputs
+    last = first + len(frames)
+
+    clipped = np.maximum(frames, 0)
+    positive_count = np.count_nonzero(clipped, axis=1)
+    positive_sum = clipped.sum(axis=1)
+    np.minimum(frames, 0, out=clipped)
+    negative_count = np.count_nonzero(clipped, axis=1)
+    negative_sum = clipped.sum(axis=1)
+
+    # Frames without positive (or negative) samples have a mean of 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        positive_mean[first:last] = np.nan_to_num(positive_sum / positive_count)
+        negative_mean[first:last] = np.nan_to_num(negative_sum / negative_count)
+    frame_min[first:last] = frames.min(axis=1)
+    frame_max[first:last] = frames.max(axis=1)
+
+def _hop_samples(sr, hop_seconds):
+    """Returns the frame length in samples for a hop given in seconds."""
+    return max(1, int(round(sr * hop_seconds)))
+
+def _normalize_hop(hop_seconds):
+    """Returns whole-second hops as int, so frame times and event bounds stay integers."""
+    hop_seconds = float(hop_seconds)
+    return int(hop_seconds) if hop_seconds.is_integer() else hop_seconds
+
+def _frame_times(n_frames, hop_seconds):
+    """Returns the start time of each frame, rounded to microseconds for sub-second hops."""
+    hop_seconds = _normalize_hop(hop_seconds)
+    if isinstance(hop_seconds, int):
+        return np.arange(n_frames) * hop_seconds
+    return np.round(np.arange(n_frames) * hop_seconds, 6)
+
+def _envelope_frame(positive_mean, negative_mean, hop_seconds):
+    """Wraps per-frame means into the envelope DataFrame used by the segmentation."""
+    return pd.DataFrame({
+        'Time': _frame_times(len(positive_mean), hop_seconds),
+        'Positive_Mean': positive_mean,
+        'Negative_Mean': negative_mean
+    })
+
+def identify_phase_intervals(apnea_mask, time, hop_seconds=ENVELOPE_HOP_SECONDS):
     """
     Identifies and classifies time intervals as inhalation, exhalation, or apnea.
 
     Args:
         apnea_mask (pd.Series): A boolean mask indicating apnea (True) or non-apnea (False).
         time (pd.Series): The time series corresponding to the apnea_mask.
+        hop_seconds (float): Frame length, i.e. how long the last frame lasts.
 
     Returns:
         dict: A dictionary with lists of [start_time, end_time] for 'inhalation', 'exhalation', and 'apnea'.
     """
-    details = {'inhalation': [], 'exhalation': [], 'apnea': []}
+    details = {phase: [] for phase in PHASE_TYPES}
     if time.empty:
         return details
-        
-    # Detect changes in the apnea mask to find phase transitions
-    changes = np.diff(apnea_mask.astype(int), prepend=apnea_mask.iloc[0])
-    change_points_idx = np.where(changes != 0)[0]
-    
-    start_idx = 0
-    respiration_alternator = True  # True for inhalation, False for exhalation
-    
-    # Add the end of the mask as a change point to process the last segment
-    change_indices = list(change_points_idx) + [len(apnea_mask)]
-
-    for end_idx in change_indices:
-        if end_idx == 0: continue
-        if start_idx >= len(time): break
-
-        is_apnea = apnea_mask.iloc[start_idx]
-        start_time = time.iloc[start_idx]
-        # The end time is now the start of the next segment, making it exclusive.
-        if end_idx < len(time):
-            end_time = time.iloc[end_idx]
-        else:
-            # For the last segment, the end is the last time point + 1.
-            end_time = time.iloc[-1] + 1
 
-        if end_time > start_time:
-            if is_apnea:
-                details['apnea'].append([start_time, end_time])
-            else:
-                if respiration_alternator:
-                    details['inhalation'].append([start_time, end_time])
-                else:
-                    details['exhalation'].append([start_time, end_time])
-                respiration_alternator = not respiration_alternator
-        
-        start_idx = end_idx
-        
+    _, starts, ends, codes = segment_apnea_masks(np.asarray(apnea_mask, dtype=bool)[None, :], time.to_numpy(), hop_seconds)
+    for code, phase in enumerate(PHASE_TYPES):
+        selected = codes == code
+        details[phase] = np.column_stack((starts[selected], ends[selected])).tolist()
     return details
 
-def phases_to_events(phases):
+def segment_apnea_masks(apnea_masks, time, hop_seconds=ENVELOPE_HOP_SECONDS):
     """
-    Converts the phases dictionary into a sorted list of events.
+    Run-length segments one or more apnea masks in a single vectorized pass.
+
+    Each row of `apnea_masks` is split into runs of equal values. Apnea runs become
+    'apnea' phases and the non-apnea runs of a row alternate between inhalation and
+    exhalation, starting with inhalation, as in `identify_phase_intervals`.
 
     Args:
-        phases (dict): A dictionary of phase intervals (e.g., {'inhalation': [[s1, e1]], 'apnea': [[s2, e2]]}).
+        apnea_masks (np.ndarray): Boolean matrix of shape (n_masks, n_frames), True for apnea.
+        time (np.ndarray): Start time of each frame.
+        hop_seconds (float): Frame length, i.e. how long the last frame lasts.
 
     Returns:
-        list: A list of event dictionaries, each with 'id', 'start', 'end', and 'type'.
+        tuple: Arrays ordered by row and then by time:
+            - np.ndarray: Row (mask) index of each phase.
+            - np.ndarray: Start time of each phase.
+            - np.ndarray: End time of each phase (exclusive).
+            - np.ndarray: Phase type codes, indexes into PHASE_TYPES.
     """
-    events = []
-    # Assign a unique ID to each phase for frontend manipulation
-    phase_id = 0
-    for phase_type, intervals in phases.items():
-        for start, end in intervals:
-            events.append({'id': phase_id, 'start': int(start), 'end': int(end), 'type': phase_type})
-            phase_id += 1
-    # Sort by start time
-    events.sort(key=lambda x: x['start'])
-    return events
+    apnea_masks = np.asarray(apnea_masks, dtype=bool)
+    time = np.asarray(time)
+    n_masks, n_frames = apnea_masks.shape
+    if n_frames == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, time[:0], time[:0], empty
+
+    # A run starts at the first frame of every row and wherever the mask flips
+    run_starts = np.ones(apnea_masks.shape, dtype=bool)
+    run_starts[:, 1:] = apnea_masks[:, 1:] != apnea_masks[:, :-1]
+    rows, start_idx = np.nonzero(run_starts)
+
+    # A run ends where the next run of the same row starts, or at the end of the row
+    end_idx = np.full(len(start_idx), n_frames)
+    same_row = rows[1:] == rows[:-1]
+    end_idx[:-1][same_row] = start_idx[1:][same_row]
+
+    # Number the breathing (non-apnea) runs within each row to alternate inhalation/exhalation
+    is_apnea = apnea_masks[rows, start_idx]
+    is_breath = ~is_apnea
+    breath_rank = np.cumsum(is_breath) - 1
+    breaths_per_row = np.bincount(rows[is_breath], minlength=n_masks)
+    breath_rank -= np.concatenate(([0], np.cumsum(breaths_per_row)[:-1]))[rows]
+    codes = np.where(is_apnea, PHASE_CODES['apnea'],
+                     np.where(breath_rank % 2 == 0, PHASE_CODES['inhalation'], PHASE_CODES['exhalation']))
+
+    # The last frame of the recording ends one hop after its start
+    hop_seconds = _normalize_hop(hop_seconds)
+    last_end = time[-1] + hop_seconds if isinstance(hop_seconds, int) else round(float(time[-1]) + hop_seconds, 6)
+    boundaries = np.append(time, last_end)
+    return rows, time[start_idx], boundaries[end_idx], codes
 
 def build_respiratory_cycles_table(events):
     """
@@ -117,65 +244,96 @@ def build_respiratory_cycles_table(events):
     Cycles must start with an inhalation, ignoring initial apneas.
 
     Args:
-        events (list): A list of event dictionaries, typically generated by `phases_to_events`.
+        events (EventStore or list): The phase events, as an EventStore or a list of event dictionaries.
 
     Returns:
         tuple: A tuple containing:
             - pd.DataFrame: DataFrame of respiratory cycles, including an 'avg' row.
             - list: A list of cycle event dictionaries for visualization.
     """
-    cycles_data = []
-    cycle_events = []
+    events = EventStore.from_records(events)
+    cycle_starts = find_respiratory_cycles(events.codes)
+    durations = cycle_durations(events, cycle_starts)
+    averages = cycle_averages(cycle_statistics(durations))
+    return cycles_dataframe(durations, averages), cycle_event_items(events, cycle_starts)
 
-    # Find the index of the first inhalation event to start the search.
-    try:
-        search_start_index = next(i for i, event in enumerate(events) if event['type'] == 'inhalation')
-    except StopIteration:
-        # If no inhalations, no cycles can be formed.
-        return pd.DataFrame(columns=['Cycle', 'Inhalation (s)', 'Apnea 1 (s)', 'Exhalation (s)', 'Apnea 2 (s)', 'Total Cycle (s)']), []
-
-    i = search_start_index
-    cycle_num = 1
-    while i <= len(events) - 4:
-        # A canonical respiratory cycle is Inhalation -> Apnea -> Exhalation -> Apnea
-        e1, e2, e3, e4 = events[i:i+4]
-        if (e1['type'] == 'inhalation' and 
-            e2['type'] == 'apnea' and 
-            e3['type'] == 'exhalation' and 
-            e4['type'] == 'apnea'):
-            
-            current_cycle = {
-                'Cycle': cycle_num,
-                'Inhalation (s)': e1['end'] - e1['start'],
-                'Apnea 1 (s)': e2['end'] - e2['start'],
-                'Exhalation (s)': e3['end'] - e3['start'],
-                'Apnea 2 (s)': e4['end'] - e4['start']
-            }
-            current_cycle['Total Cycle (s)'] = sum(list(current_cycle.values())[1:])
-            cycles_data.append(current_cycle)
-            
-            cycle_events.append({
-                'id': f'cycle_{cycle_num}',
-                'start': e1['start'],
-                'end': e4['end'],
-                'label': f'{cycle_num}',
-                'cycle_number': cycle_num
-            })
-            
-            cycle_num += 1
-            i += 4  # Advance to the next potential cycle*
-        else:
-            i += 1  # Try the next sequence
-            
-    if not cycles_data:
-        return pd.DataFrame(columns=['Cycle', 'Inhalation (s)', 'Apnea 1 (s)', 'Exhalation (s)', 'Apnea 2 (s)', 'Total Cycle (s)']), []
-    
-    df_cycles = pd.DataFrame(cycles_data)
-    averages = df_cycles.drop(columns='Cycle').mean().round(2)
+def find_respiratory_cycles(codes, first=0):
+    """
+    Finds the respiratory cycles in a sequence of phase types.
+
+    A canonical respiratory cycle is Inhalation -> Apnea -> Exhalation -> Apnea. The
+    pattern cannot overlap itself (its second, third and fourth phases are not
+    inhalations), so the greedy left-to-right scan keeps every window that matches, all
+    of them can be found at once, and the cycles from any position on do not depend on
+    the phases before it.
+
+    Args:
+        codes (np.ndarray): The phase type codes of the events, in start order.
+        first (int): Position of the first event a cycle may start at.
+
+    Returns:
+        np.ndarray: Positions of the events that start a cycle, ascending.
+    """
+    codes = codes[first:]
+    n_windows = len(codes) - len(CYCLE_PATTERN) + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.int64)
+    matches = np.ones(n_windows, dtype=bool)
+    for offset, code in enumerate(CYCLE_PATTERN):
+        matches &= codes[offset:offset + n_windows] == code
+    return np.flatnonzero(matches) + first
+
+def cycle_durations(events, cycle_starts):
+    """
+    Returns the (n_cycles, 5) STATISTICS_COLUMNS durations (the four phases and the
+    total, rounded to microseconds) of the cycles starting at `cycle_starts`.
+    """
+    phase_index = cycle_starts[:, None] + np.arange(len(CYCLE_PATTERN))
+    durations = np.round(events.ends[phase_index] - events.starts[phase_index], 6)
+    return np.column_stack([durations, np.round(durations.sum(axis=1), 6)])
+
+def cycle_averages(statistics):
+    """Returns the 'avg' row of the cycles table (the column means, rounded to 2 decimals) from the cycle statistics."""
+    if statistics['count'] == 0:
+        return np.zeros(0)
+    return np.round(_statistics_moments(statistics)[0], 2)
+
+def cycles_dataframe(durations, averages, first_number=1):
+    """
+    Builds the cycles table from the durations of its cycles and its 'avg' row.
+
+    Args:
+        durations (np.ndarray): (n_cycles, 5) array, from `cycle_durations`.
+        averages (np.ndarray): The 'avg' row, from `cycle_averages`.
+        first_number (int): Number of the first cycle.
+
+    Returns:
+        pd.DataFrame: The cycles table, closed by the 'avg' row when it has cycles.
+    """
+    columns = CYCLES_TABLE_HEADER
+    if len(durations) == 0:
+        return pd.DataFrame(columns=columns)
+    df_cycles = pd.DataFrame(durations, columns=columns[1:])
+    df_cycles.insert(0, 'Cycle', np.arange(first_number, first_number + len(durations)))
+    # Whole-second durations are shown as integers, as they were with integer event times
+    for column in df_cycles.columns[1:]:
+        if np.all(np.mod(df_cycles[column], 1) == 0):
+            df_cycles[column] = df_cycles[column].astype(np.int64)
+    averages = pd.Series(averages, index=columns[1:])
     averages['Cycle'] = 'avg'
-    df_cycles = pd.concat([df_cycles, pd.DataFrame([averages])], ignore_index=True)
-    
-    return df_cycles, cycle_events
+    return pd.concat([df_cycles, pd.DataFrame([averages])], ignore_index=True)
+
+def cycle_event_items(events, cycle_starts, first_number=1):
+    """Returns the cycle event dictionaries shown over the waveform for the cycles starting at `cycle_starts`."""
+    return [{
+        'id': f'cycle_{cycle_num}',
+        'start': start,
+        'end': end,
+        'label': f'{cycle_num}',
+        'cycle_number': cycle_num
+    } for cycle_num, start, end in zip(range(first_number, first_number + len(cycle_starts)),
+                                       json_times(events.starts[cycle_starts]),
+                                       json_times(events.ends[cycle_starts + len(CYCLE_PATTERN) - 1]))]
 
 # --- Respiration Analysis Functions (test) --- 
 
@@ -198,6 +356,16 @@ CONFIG = {
 
 PHASE_COLUMNS = ['Inhalation (s)', 'Apnea 1 (s)', 'Exhalation (s)', 'Apnea 2 (s)']
 
+STATISTICS_COLUMNS = PHASE_COLUMNS + ['Total Cycle (s)']  # Columns of the cycles table the scores are computed from
+STATISTICS_UNITS = 1_000_000  # Durations are kept in the sufficient statistics as integer microseconds
+SCORE_TOLERANCE = 0.01  # Largest difference between a formatted score and the pandas pillar functions' value
+
+RECOMMENDATIONS = {
+    "Depth": "Try to breathe slower and deeper (breaths per minute).",
+    "Stability": "Focus on maintaining a consistent rhythm in each phase.",
+    "Internal Balance": "Work on the structure of your breath (e.g., longer exhalation and/or apneas)."
+}
+
 def calculate_depth_score(df, config):
     """
     Calculates the depth score based on the average total cycle duration.
@@ -278,102 +446,486 @@ def analyze_respiration(df_cycles, custom_config=None):
     if df_cycles.empty or 'avg' not in df_cycles['Cycle'].values:
         return None
 
-    # Merge custom config with default config
+    # Exclude the 'avg' row for score calculations
+    df = df_cycles[df_cycles['Cycle'] != 'avg']
+    if df.empty:
+        return None
+
+    return score_statistics(cycle_statistics(df[STATISTICS_COLUMNS].to_numpy(dtype=np.float64)), custom_config)
+
+# --- Scoring from sufficient statistics ---
+#
+# Every score only depends on the count, mean and standard deviation of each column of
+# the cycles table, which follow from the count, sum and sum of squares of the column.
+# Durations are summed as integer microseconds (the cycles table rounds them to 6
+# decimals), so the statistics are exact: updated edit by edit, they equal the ones
+# computed from the whole table, and scoring from them is a few arithmetic operations.
+#
+# The means and deviations are correctly rounded from those exact sums, while the pandas
+# pillar functions (`calculate_depth_score` and the others) accumulate float rounding
+# errors over the table. The pillar values can therefore differ in their last bits, and
+# a score lying on a hundredths boundary may round the other way when formatted: scores
+# agree with the pandas functions within SCORE_TOLERANCE, not always digit for digit.
+
+def cycle_statistics(durations):
+    """
+    Computes the sufficient statistics of a set of respiratory cycles.
+
+    Args:
+        durations (np.ndarray): (n_cycles, 5) array with the STATISTICS_COLUMNS durations
+            (the four phases and the total) of every cycle.
+
+    Returns:
+        dict: 'count' of cycles, and per column the 'sums' and 'squares' (sums of squares)
+              of the durations in integer microseconds.
+    """
+    units = _duration_units(durations)
+    return {'count': len(units), 'sums': units.sum(axis=0).tolist(), 'squares': (units * units).sum(axis=0).tolist()}
+
+def update_cycle_statistics(statistics, removed=None, added=None):
+    """
+    Returns the statistics of a set of cycles after some cycles were removed and others added.
+
+    Args:
+        statistics (dict): The statistics before the change, from `cycle_statistics`.
+        removed (np.ndarray, optional): (n, 5) durations of the cycles that are gone.
+        added (np.ndarray, optional): (n, 5) durations of the new cycles.
+
+    Returns:
+        dict: The new statistics, equal to `cycle_statistics` of the new set of cycles.
+    """
+    count, sums, squares = statistics['count'], list(statistics['sums']), list(statistics['squares'])
+    for durations, sign in ((removed, -1), (added, 1)):
+        if durations is None or len(durations) == 0:
+            continue
+        units = _duration_units(durations)
+        count += sign * len(units)
+        sums = [total + sign * value for total, value in zip(sums, units.sum(axis=0).tolist())]
+        squares = [total + sign * value for total, value in zip(squares, (units * units).sum(axis=0).tolist())]
+    return {'count': count, 'sums': sums, 'squares': squares}
+
+def score_statistics(statistics, custom_config=None):
+    """
+    Scores a session from the sufficient statistics of its cycles, without any DataFrame.
+
+    Args:
+        statistics (dict): From `cycle_statistics` or `update_cycle_statistics`.
+        custom_config (dict, optional): A dictionary with custom scoring parameters to override defaults.
+
+    Returns:
+        dict: The respiration analysis, as returned by `analyze_respiration`, or None if
+              there are no cycles. Its scores are within SCORE_TOLERANCE of the pandas
+              pillar functions (see the notes above `cycle_statistics`).
+    """
+    if statistics['count'] == 0:
+        return None
     final_config = CONFIG.copy()
     if custom_config:
         final_config.update(custom_config)
+    means, stds = _statistics_moments(statistics)
+    return _respiration_analyses(*_pillar_scores(means, stds, final_config), np.array(statistics['count']))
 
-    # Exclude the 'avg' row for score calculations
-    df = df_cycles[df_cycles['Cycle'] != 'avg'].copy()
-    if df.empty:
-        return None
+def score_config_variants(statistics, custom_configs):
+    """
+    Scores one session under many scoring configurations at once.
 
-    depth_score = calculate_depth_score(df, final_config)
-    stability_score = calculate_stability_score(df, final_config)
-    balance_score = calculate_balance_score(df, final_config)
+    The configurations are stacked along a variant axis (see `_stack_config_values`) and
+    the pillar formulas give scores indexed [variant, session], so they run once for all
+    of them; thousands of variants take milliseconds.
 
-    weights = final_config["PILLAR_WEIGHTS"]
-    final_score = (weights['depth'] * depth_score +
-                   weights['stability'] * stability_score +
-                   weights['balance'] * balance_score)
+    Args:
+        statistics (dict): From `cycle_statistics` or `update_cycle_statistics`.
+        custom_configs (list): Dictionaries of custom scoring parameters, each overriding the defaults.
 
-    scores = {
-        'Depth': depth_score,
-        'Stability': stability_score,
-        'Internal Balance': balance_score,
-        'Final': final_score
-    }
+    Returns:
+        list: The respiration analysis under every configuration (empty if there are no cycles).
+    """
+    if statistics['count'] == 0 or not custom_configs:
+        return []
+    configs = []
+    for custom_config in custom_configs:
+        final_config = CONFIG.copy()
+        final_config.update(custom_config)
+        configs.append(final_config)
+    stacked = {key: _stack_config_values(configs, key) for key in CONFIG}
+    means, stds = _statistics_moments(statistics)
+    # The moments of the one session are indexed [session, column], the scores [variant, session]
+    scores = _pillar_scores(means[None, None, :], stds[None, None, :], stacked)
+    return _respiration_analyses(*(session_scores[:, 0] for session_scores in scores), np.full(len(configs), statistics['count']))
+
+def _stack_config_values(configs, key):
+    """
+    Stacks one CONFIG entry of many configurations along the variant axis.
 
-    # Identify the weakest pillar (excluding the 'Final' score)
-    weakest_pillar = min({k: v for k, v in scores.items() if k != 'Final'}, key=scores.get)
-    
-    recommendations = {
-        "Depth": "Try to breathe slower and deeper (breaths per minute).",
-        "Stability": "Focus on maintaining a consistent rhythm in each phase.",
-        "Internal Balance": "Work on the structure of your breath (e.g., longer exhalation and/or apneas)."
-    }
+    Numbers become (n_variants, 1) arrays and named weights a dictionary of them, so they
+    broadcast against the session axis of the moments. The PHASE_STABILITY_WEIGHTS become
+    an (n_variants, 1, n_phases) array, see `_phase_stability_weights`.
+    """
+    if key == "PHASE_STABILITY_WEIGHTS":
+        return np.stack([_phase_stability_weights(config) for config in configs])[:, None, :]
+    if isinstance(CONFIG[key], dict):
+        return {name: np.array([config[key][name] for config in configs], dtype=np.float64)[:, None] for name in CONFIG[key]}
+    return np.array([config[key] for config in configs], dtype=np.float64)[:, None]
 
-    return {
-        "scores": {k: f"{v:.2f}" for k, v in scores.items()},
-        "num_cycles": len(df),
-        "weakest_pillar": weakest_pillar,
-        "recommendation": recommendations[weakest_pillar]
-    }
+def _phase_stability_weights(config):
+    """
+    Returns the PHASE_STABILITY_WEIGHTS of a configuration as an array over PHASE_COLUMNS.
+
+    The n-th weight applies to the n-th phase column whatever its name, as in
+    `calculate_stability_score`. Stacked configurations already hold the array.
+    """
+    weights = config["PHASE_STABILITY_WEIGHTS"]
+    if isinstance(weights, dict):
+        weights = list(weights.values())[:len(PHASE_COLUMNS)]
+    return np.asarray(weights, dtype=np.float64)
+
+def score_sessions(durations, offsets, custom_config=None):
+    """
+    Scores many sessions at once, with the results of `analyze_respiration` on each of them.
+
+    The statistics of all sessions are summed together with grouped NumPy reductions and
+    the pillar formulas run once for the whole batch, instead of one DataFrame per
+    session. A session's scores do not depend on the other sessions of the batch.
+
+    Args:
+        durations (np.ndarray): (n_cycles, 5) array with the STATISTICS_COLUMNS durations of
+            every cycle, the cycles of one session after those of the previous one.
+        offsets (np.ndarray): Index of the first cycle of every session. Every session has
+            at least one cycle.
+        custom_config (dict, optional): A dictionary with custom scoring parameters to override defaults.
+
+    Returns:
+        list: The respiration analysis of every session, as returned by `analyze_respiration`;
+              like it, within SCORE_TOLERANCE of the pandas pillar functions.
+    """
+    final_config = CONFIG.copy()
+    if custom_config:
+        final_config.update(custom_config)
+    units = _duration_units(durations)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if len(offsets) == 0:
+        return []
+    counts = np.diff(np.append(offsets, len(units)))
+    sums = np.add.reduceat(units, offsets, axis=0)
+    squares = np.add.reduceat(units * units, offsets, axis=0)
+    moments = [_statistics_moments({'count': count, 'sums': session_sums, 'squares': session_squares})
+               for count, session_sums, session_squares in zip(counts.tolist(), sums.tolist(), squares.tolist())]
+    means = np.array([session_means for session_means, _ in moments])
+    stds = np.array([session_stds for _, session_stds in moments])
+    return _respiration_analyses(*_pillar_scores(means, stds, final_config), counts)
+
+def _duration_units(durations):
+    """Converts (n, 5) durations in seconds to exact integer microseconds (Python ints, which cannot overflow when squared)."""
+    durations = np.asarray(durations, dtype=np.float64).reshape(-1, len(STATISTICS_COLUMNS))
+    return np.rint(durations * STATISTICS_UNITS).astype(np.int64).astype(object)
+
+def _statistics_moments(statistics):
+    """
+    Returns the mean and sample standard deviation (NaN for a single cycle) of every column,
+    in seconds, each correctly rounded from the exact statistics.
+    """
+    count = statistics['count']
+    means = np.array([total / (count * STATISTICS_UNITS) for total in statistics['sums']])
+    if count < 2:
+        return means, np.full(len(means), np.nan)
+    variances = [max(count * squares - total * total, 0) / (count * (count - 1))
+                 for total, squares in zip(statistics['sums'], statistics['squares'])]
+    return means, np.sqrt(variances) / STATISTICS_UNITS
+
+def _pillar_scores(means, stds, config):
+    """
+    Computes the pillar scores from the mean and standard deviation of each column.
+
+    The formulas are those of `calculate_depth_score`, `calculate_stability_score` and
+    `calculate_balance_score`. The arrays may hold several sessions (rows of `means` and
+    `stds`) or several configurations (stacked by `_stack_config_values`); the scores
+    broadcast to their common shape.
+
+    Returns:
+        tuple: Depth, stability, internal balance and final score arrays.
+    """
+    means, stds = np.asarray(means, dtype=np.float64), np.asarray(stds, dtype=np.float64)
+    n_phases = len(PHASE_COLUMNS)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_phases, mean_cycle = means[..., :n_phases], means[..., n_phases]
+
+        depth_scores = np.minimum(1.0, mean_cycle / config["TARGET_CYCLE_DURATION"]) * 100
+
+        # A session with one cycle has no deviation (NaN), which scores 0 like max(0, NaN) does
+        cvs = np.where(mean_phases > 0, stds[..., :n_phases] / mean_phases, 0)
+        phase_scores = np.where(cvs < 1, 1 - cvs, 0) * 100
+        phase_weights = _phase_stability_weights(config)
+        stability_scores = 0
+        for column in range(phase_weights.shape[-1]):
+            stability_scores = stability_scores + phase_weights[..., column] * phase_scores[..., column]
+
+        balance_weights = config["INTERNAL_BALANCE_WEIGHTS"]
+        target_ie_ratio = config["TARGET_IE_RATIO"]
+        target_apnea_percentage = config["TARGET_APNEA_PERCENTAGE"]
+        ie_ratios = np.where(mean_phases[..., 0] > 0, mean_phases[..., 2] / mean_phases[..., 0], 0)
+        ie_ratio_scores = np.maximum(0, 1 - np.abs(ie_ratios - target_ie_ratio) / target_ie_ratio) * 100
+        apnea_percentages = np.where(mean_cycle > 0, (mean_phases[..., 1] + mean_phases[..., 3]) / mean_cycle, 0)
+        apnea_control_scores = np.maximum(0, 1 - np.abs(apnea_percentages - target_apnea_percentage) / target_apnea_percentage) * 100
+        balance_scores = balance_weights['ie_ratio'] * ie_ratio_scores + balance_weights['apnea_control'] * apnea_control_scores
+
+    weights = config["PILLAR_WEIGHTS"]
+    final_scores = (weights['depth'] * depth_scores +
+                    weights['stability'] * stability_scores +
+                    weights['balance'] * balance_scores)
+    return depth_scores, stability_scores, balance_scores, final_scores
+
+def _respiration_analyses(depth_scores, stability_scores, balance_scores, final_scores, counts):
+    """
+    Formats pillar scores as respiration analyses: one dictionary for scalar scores, a list for arrays.
+    """
+    pillars = ['Depth', 'Stability', 'Internal Balance']
+    scores = np.broadcast_arrays(depth_scores, stability_scores, balance_scores, final_scores, counts)
+    # argmin keeps the first of equal scores, as min() does over the pillars in order
+    weakest = np.argmin(np.stack(scores[:3], axis=-1), axis=-1)
+    analyses = []
+    for depth, stability, balance, final, num_cycles, weakest_index in zip(
+            *(np.atleast_1d(values).tolist() for values in scores), np.atleast_1d(weakest).tolist()):
+        weakest_pillar = pillars[weakest_index]
+        analyses.append({
+            "scores": {'Depth': f"{depth:.2f}", 'Stability': f"{stability:.2f}",
+                       'Internal Balance': f"{balance:.2f}", 'Final': f"{final:.2f}"},
+            "num_cycles": int(num_cycles),
+            "weakest_pillar": weakest_pillar,
+            "recommendation": RECOMMENDATIONS[weakest_pillar]
+        })
+    return analyses if np.ndim(scores[0]) else analyses[0]
 
 def generate_cycles_html_table(events):
     """
     Generates the HTML code for the respiratory cycles table and returns cycle events.
 
     Args:
-        events (list): A list of event dictionaries.
+        events (EventStore or list): The phase events.
 
     Returns:
         tuple: A tuple containing:
             - str: HTML string of the cycles table.
             - list: A list of cycle event dictionaries.
     """
-    if not events:
+    if len(events) == 0:
         return "<p>No phase data available to generate the table.</p>", []
     df_table, cycle_events = build_respiratory_cycles_table(events)
     if df_table.empty:
         return "<p>No complete respiratory cycles detected.</p>", []
     return df_table.to_html(classes='table table-striped', index=False), cycle_events
 
-def calculate_waveshow_data(y, sr, num_vis_points=1000):
+def calculate_waveshow_from_frames(frame_min, frame_max, hop_seconds=ENVELOPE_HOP_SECONDS, num_vis_points=1000):
+    """
+    Builds the waveshow (min/max envelope) from the per-frame extremes of `calculate_frame_features`.
+
+    Consecutive frames are grouped into at most `num_vis_points` points, so the samples
+    do not have to be scanned a second time. With fewer frames than `num_vis_points`,
+    there is one point per frame; `_build_features` then uses the finer waveform bins.
+
+    Each point covers whole frames, and its time is the start of its first frame, so
+    the extremes of a point lie in [t, next t). The former `calculate_waveshow_data`
+    spread the times evenly from 0 to the duration (`np.linspace`) instead, which put
+    them slightly after the start of their samples; plots are unchanged at this scale.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: Time axis for the waveshow (start time of each point, in seconds).
+            - list: Minimum amplitude values for each point.
+            - list: Maximum amplitude values for each point.
+    """
+    n_frames = len(frame_min)
+    if n_frames == 0:
+        return [], [], []
+    point_starts = np.unique((np.arange(num_vis_points) * n_frames) // num_vis_points)
+    t_wave = point_starts * float(hop_seconds)
+    y_min = np.minimum.reduceat(frame_min, point_starts)
+    y_max = np.maximum.reduceat(frame_max, point_starts)
+    return t_wave.tolist(), y_min.tolist(), y_max.tolist()
+
+def _build_features(duration, sr, hop_seconds, frame_features, waveform_bins, num_vis_points=1000):
+    """
+    Packs per-frame features into the dictionary shared by the analysis and the feature cache.
+
+    `waveform_bins` holds the finest level of the waveform pyramid; it is written to its
+    own file by `get_audio_features` and is not part of the feature cache.
     """
-    Calculates data for a waveshow-like visualization (min/max envelope).
+    positive_mean, negative_mean, frame_min, frame_max = frame_features
+    if len(frame_min) < num_vis_points and len(waveform_bins[0]) > len(frame_min):
+        # Recordings shorter than num_vis_points envelope frames (e.g. under 1000 s at a 1 s hop)
+        # take the waveshow from the pyramid's finest level instead, so they still get num_vis_points
+        t_wave, y_min, y_max = calculate_waveshow_from_frames(*waveform_bins, WAVEFORM_BIN_SAMPLES / sr, num_vis_points)
+    else:
+        t_wave, y_min, y_max = calculate_waveshow_from_frames(frame_min, frame_max, hop_seconds, num_vis_points)
+    return {
+        'duration': duration,
+        'sampling_rate': sr,
+        'hop_seconds': _normalize_hop(hop_seconds),
+        'signal': {'t': t_wave, 'min': y_min, 'max': y_max},
+        'envelope': _envelope_frame(positive_mean, negative_mean, hop_seconds),
+        'waveform_bins': waveform_bins
+    }
+
+def calculate_minmax_bins(y, bin_samples=WAVEFORM_BIN_SAMPLES, workers=None):
+    """
+    Computes the minimum and maximum of every `bin_samples` samples, including a trailing partial bin.
 
     Args:
         y (np.ndarray): The audio time series.
+        bin_samples (int): Samples per bin.
+        workers (int, optional): Threads reducing chunks of bins at the same time. Defaults to FEATURE_WORKERS.
+
+    Returns:
+        tuple: Minimum and maximum per bin (float32 arrays).
+    """
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    full_bins = len(y) // bin_samples
+    bins = y[:full_bins * bin_samples].reshape((full_bins, bin_samples))
+    bin_min = np.empty(full_bins, dtype=np.float32)
+    bin_max = np.empty(full_bins, dtype=np.float32)
+    bins_per_chunk = max(1, FEATURE_CHUNK_SAMPLES // bin_samples)
+
+    def reduce_chunk(first):
+        last = min(first + bins_per_chunk, full_bins)
+        np.min(bins[first:last], axis=1, out=bin_min[first:last])
+        np.max(bins[first:last], axis=1, out=bin_max[first:last])
+
+    _map_chunks(reduce_chunk, range(0, full_bins, bins_per_chunk), workers)
+    if len(y) % bin_samples:
+        tail = y[full_bins * bin_samples:]
+        bin_min = np.append(bin_min, tail.min())
+        bin_max = np.append(bin_max, tail.max())
+    return bin_min, bin_max
+
+def build_waveform_pyramid(bin_min, bin_max):
+    """
+    Builds the min/max pyramid: every level merges pairs of bins of the level below.
+
+    Args:
+        bin_min (np.ndarray): Minimum per bin at the finest level.
+        bin_max (np.ndarray): Maximum per bin at the finest level.
+
+    Returns:
+        list: (min, max) float32 arrays per level, from finest to a single bin.
+    """
+    levels = [(np.asarray(bin_min, dtype=np.float32), np.asarray(bin_max, dtype=np.float32))]
+    while len(levels[-1][0]) > 1:
+        level_min, level_max = levels[-1]
+        paired = len(level_min) // 2 * 2
+        next_min = np.minimum(level_min[0:paired:2], level_min[1:paired:2])
+        next_max = np.maximum(level_max[0:paired:2], level_max[1:paired:2])
+        if paired < len(level_min):
+            next_min = np.append(next_min, level_min[-1])
+            next_max = np.append(next_max, level_max[-1])
+        levels.append((next_min, next_max))
+    return levels
+
+def save_waveform_pyramid(waveform_path, sr, waveform_bins, bin_samples=WAVEFORM_BIN_SAMPLES):
+    """
+    Writes the waveform pyramid to a binary file that `read_waveform_window` memory-maps.
+
+    Layout: a WAVEFORM_HEADER followed by every level, finest first, as float32 (min, max) pairs.
+
+    Args:
+        waveform_path (str): Destination file, usually WAVEFORM_FILENAME inside the session folder.
         sr (int): The sampling rate of the audio.
+        waveform_bins (tuple): Minimum and maximum per bin at the finest level.
+        bin_samples (int): Samples per bin at the finest level.
+    """
+    levels = build_waveform_pyramid(*waveform_bins)
+    tmp_path = waveform_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(WAVEFORM_HEADER.pack(WAVEFORM_MAGIC, WAVEFORM_VERSION, int(sr), int(bin_samples), len(levels[0][0]), len(levels)))
+        for level_min, level_max in levels:
+            np.column_stack((level_min, level_max)).astype('<f4').tofile(f)
+    os.replace(tmp_path, waveform_path)
+
+def read_waveform_window(waveform_path, start, end, px):
+    """
+    Reads the min/max bins covering [start, end) from the coarsest level that still has
+    at least one bin per pixel, so the result never holds more than about `px` bins.
+
+    Args:
+        waveform_path (str): File written by `save_waveform_pyramid`.
+        start (float): Window start in seconds.
+        end (float): Window end in seconds.
+        px (int): Width of the viewer in pixels.
+
+    Returns:
+        dict: 'level', 'bin_seconds', 'start' (time of the first bin), and 'min' and 'max'
+              float32 arrays, or None if the file is missing or was written by another
+              WAVEFORM_VERSION.
+    """
+    if not os.path.exists(waveform_path):
+        return None
+    with open(waveform_path, 'rb') as f:
+        magic, version, sr, bin_samples, n_base, n_levels = WAVEFORM_HEADER.unpack(f.read(WAVEFORM_HEADER.size))
+    if magic != WAVEFORM_MAGIC or version != WAVEFORM_VERSION:
+        return None
+
+    sizes = [n_base]
+    for _ in range(n_levels - 1):
+        sizes.append((sizes[-1] + 1) // 2)
+    base_bin_seconds = bin_samples / sr
+    start = max(0.0, start)
+    end = max(start, end)
+    window_bins = (end - start) / base_bin_seconds
+    level = 0 if window_bins <= px else min(n_levels - 1, int(np.ceil(np.log2(window_bins / px))))
+
+    bin_seconds = base_bin_seconds * 2 ** level
+    first = min(sizes[level], int(start // bin_seconds))
+    last = min(sizes[level], max(first + 1, int(np.ceil(end / bin_seconds))))
+    pyramid = np.memmap(waveform_path, dtype='<f4', mode='r', offset=WAVEFORM_HEADER.size, shape=(sum(sizes), 2))
+    offset = sum(sizes[:level])
+    window = np.array(pyramid[offset + first:offset + last])
+    del pyramid
+    return {
+        'level': level,
+        'bin_seconds': bin_seconds,
+        'start': first * bin_seconds,
+        'min': window[:, 0],
+        'max': window[:, 1]
+    }
+
+def calculate_streaming_features(audio_file_path, block_seconds=STREAMING_BLOCK_SECONDS, hop_seconds=ENVELOPE_HOP_SECONDS, num_vis_points=1000, progress=None):
+    """
+    Computes the waveshow data and the amplitude envelope reading the file block by block.
+
+    Produces the same values as running `calculate_frame_features` on the fully loaded
+    signal, but peak memory depends on `block_seconds` instead of the length of the
+    recording.
+
+    Args:
+        audio_file_path (str): The path to the audio file.
+        block_seconds (int): Seconds of audio decoded per block.
+        hop_seconds (float): Envelope frame length in seconds.
         num_vis_points (int): The number of visualization points for the waveshow.
+        progress (callable, optional): Called as progress('decoding', fraction) after each block.
 
     Returns:
-        tuple: A tuple containing:
-            - list: Time axis for the waveshow.
-            - list: Minimum amplitude values for each frame.
-            - list: Maximum amplitude values for each frame.
+        dict: Duration, sampling rate, hop, waveshow 'signal' lists and 'envelope' DataFrame.
     """
-    # Ensure y is a numpy array for easier reshaping
-    y = np.array(y)
-    
-    # Calculate the size of each frame
-    frame_size = len(y) // num_vis_points
-    
-    # Truncate y so it's divisible by the number of points
-    y_truncated = y[:num_vis_points * frame_size]
-    
-    # Reshape to group into frames
-    y_frames = y_truncated.reshape(num_vis_points, frame_size)
-    
-    # Calculate min and max for each frame
-    y_min = y_frames.min(axis=1)
-    y_max = y_frames.max(axis=1)
-    
-    # Create the corresponding time axis
-    t_wave = np.linspace(0, len(y) / sr, num_vis_points)
-    
-    return t_wave.tolist(), y_min.tolist(), y_max.tolist()
+    sr, blocks = _open_audio_stream(audio_file_path, block_seconds, hop_seconds)
+    # The expected length is only needed to report progress (and is an estimate for MP3)
+    expected_samples = _audio_duration(audio_file_path) * sr if progress else 0
+
+    # Blocks hold a whole number of frames and of waveform bins, so neither straddles two blocks.
+    block_features = []
+    block_bins = []
+    n_samples = 0
+    for block in blocks:
+        block_features.append(calculate_frame_features(block, sr, hop_seconds))
+        block_bins.append(calculate_minmax_bins(block))
+        n_samples += len(block)
+        if progress and expected_samples > 0:
+            progress('decoding', min(1.0, n_samples / expected_samples))
+
+    if block_features:
+        frame_features = tuple(np.concatenate(parts) for parts in zip(*block_features))
+        waveform_bins = tuple(np.concatenate(parts) for parts in zip(*block_bins))
+    else:
+        frame_features = tuple(np.zeros(0, dtype=np.float32) for _ in range(4))
+        waveform_bins = (np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32))
+    return _build_features(n_samples / sr, sr, hop_seconds, frame_features, waveform_bins, num_vis_points)
 
 def save_analysis_results(output_dir, events, df_table, analysis_data, respiration_analysis, export_format='all'):
     """
@@ -382,13 +934,14 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
 
     Args:
         output_dir (str): The directory to save the results.
-        events (list): The list of phase events (current/adjusted).
+        events (EventStore or list): The phase events (current/adjusted).
         df_table (pd.DataFrame): The respiratory cycles table.
         analysis_data (dict): The dictionary with all analysis data.
         respiration_analysis (dict): The dictionary with respiration analysis scores.
         export_format (str): Export format - 'pdf', 'png', 'csv', 'excel', or 'all'.
     """
     os.makedirs(output_dir, exist_ok=True)
+    events = EventStore.from_records(events)
 
     # Check if we have sufficient data for analysis
     has_cycle_data = not df_table.empty and len(df_table) > 0
@@ -401,13 +954,7 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
             df_table.to_csv(table_path, index=False)
         else:
             # Create a basic table with available events
-            simple_df = pd.DataFrame([{
-                'Event_ID': event['id'],
-                'Type': event['type'], 
-                'Start_Time': event['start'],
-                'End_Time': event['end'],
-                'Duration': event['end'] - event['start']
-            } for event in events])
+            simple_df = events.to_frame()
             simple_df.to_csv(table_path, index=False)
     
     if export_format in ['excel', 'all']:
@@ -416,13 +963,7 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
             if has_cycle_data:
                 df_table.to_excel(excel_path, index=False, sheet_name='Respiratory_Cycles')
             else:
-                simple_df = pd.DataFrame([{
-                    'Event_ID': event['id'],
-                    'Type': event['type'], 
-                    'Start_Time': event['start'],
-                    'End_Time': event['end'],
-                    'Duration': event['end'] - event['start']
-                } for event in events])
+                simple_df = events.to_frame()
                 simple_df.to_excel(excel_path, index=False, sheet_name='Events')
         except ImportError:
             # Fallback to CSV if openpyxl is not available
@@ -431,13 +972,7 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
                 if has_cycle_data:
                     df_table.to_csv(table_path, index=False)
                 else:
-                    simple_df = pd.DataFrame([{
-                        'Event_ID': event['id'],
-                        'Type': event['type'], 
-                        'Start_Time': event['start'],
-                        'End_Time': event['end'],
-                        'Duration': event['end'] - event['start']
-                    } for event in events])
+                    simple_df = events.to_frame()
                     simple_df.to_csv(table_path, index=False)
 
     # --- Handle cycle events safely ---
@@ -447,17 +982,10 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
         cycle_events = []
 
     # --- Enrich events with cycle number and save for ML ---
-    enriched_events = []
-    for event in events:
-        enriched_event = event.copy()
-        # Find which cycle this event belongs to
-        for cycle in cycle_events:
-            if cycle['start'] <= event['start'] and event['end'] <= cycle['end']:
-                enriched_event['cycle_number'] = cycle['cycle_number']
-                break
-        if 'cycle_number' not in enriched_event:
-            enriched_event['cycle_number'] = None
-        enriched_events.append(enriched_event)
+    # Each event belongs to the first cycle that contains it, found by binary search
+    cycle_index = IntervalIndex([cycle['start'] for cycle in cycle_events], [cycle['end'] for cycle in cycle_events])
+    event_cycles = [cycle_events[c]['cycle_number'] if c >= 0 else None
+                    for c in cycle_index.containing(events.starts, events.ends).tolist()]
 
     segmentation_data = {
         "audio_metadata": {
@@ -469,11 +997,11 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
         },
         "segmentation_events": [
             {
-                "start_time": float(event['start']),
-                "end_time": float(event['end']),
-                "label": event['type'],
-                "cycle_number": event.get('cycle_number', None)
-            } for event in enriched_events
+                "start_time": start,
+                "end_time": end,
+                "label": phase,
+                "cycle_number": cycle_number
+            } for start, end, phase, cycle_number in zip(events.starts.tolist(), events.ends.tolist(), events.types, event_cycles)
         ]
     }
     
@@ -490,7 +1018,7 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
     }
 
     # --- Generate Original and Adjusted Spectrograms ---
-    original_events = analysis_data.get('original_events', events)  # Fallback to current if no original stored
+    original_events = EventStore.from_records(analysis_data.get('original_events', events))  # Fallback to current if no original stored
     
     def create_spectrogram_plot(events_to_plot, title_suffix, ax1, ax2):
         """Helper function to create consistent spectrogram plots"""
@@ -519,11 +1047,11 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
             if len(events_to_plot) > 0:
                 ylim = ax2.get_ylim()
                 if ylim[1] > ylim[0]:  # Valid y-limits
-                    for event in events_to_plot:
-                        ax2.add_patch(Rectangle((event['start'], ylim[0]), 
-                                               event['end'] - event['start'], 
+                    for start, end, phase in zip(events_to_plot.starts.tolist(), events_to_plot.ends.tolist(), events_to_plot.types):
+                        ax2.add_patch(Rectangle((start, ylim[0]), 
+                                               end - start, 
                                                ylim[1] - ylim[0], 
-                                               color=phase_colors.get(event['type'], 'gray'), 
+                                               color=phase_colors.get(phase, 'gray'), 
                                                alpha=0.3))
 
             # Add cycle numbers if available
@@ -653,9 +1181,133 @@ def save_analysis_results(output_dir, events, df_table, analysis_data, respirati
         plt.savefig(chart_path, dpi=300, bbox_inches='tight')
         plt.close(fig)
 
+def _probe_audio(audio_file_path):
+    """
+    Reads the sampling rate, channel count and duration of a file's first audio stream with ffprobe.
+
+    Returns:
+        tuple: Sampling rate (int), number of channels (int) and duration in seconds (float,
+               an estimate for formats without an exact length in their header).
+    """
+    result = subprocess.run(
+        [FFPROBE_BINARY, '-v', 'error', '-select_streams', 'a:0',
+         '-show_entries', 'stream=sample_rate,channels:format=duration', '-of', 'json', audio_file_path],
+        capture_output=True, text=True, check=True
+    )
+    info = json.loads(result.stdout)
+    if not info.get('streams'):
+        raise ValueError("No audio stream found in the file.")
+    stream = info['streams'][0]
+    duration = float(info.get('format', {}).get('duration', 0) or 0)
+    return int(stream['sample_rate']), int(stream['channels']), duration
+
+def create_audio_preview(audio_file_path, preview_path, preview_format='opus', bitrate=PREVIEW_BITRATE):
+    """
+    Transcodes a recording with ffmpeg into a small mono file for playback.
+
+    Args:
+        audio_file_path (str): The original recording.
+        preview_path (str): Where to write the preview; it only appears once it is complete.
+        preview_format (str): A key of PREVIEW_FORMATS.
+        bitrate (str): Target bit rate, in ffmpeg notation.
+
+    Raises:
+        RuntimeError: If ffmpeg fails.
+    """
+    encoder, muxer, _, _ = PREVIEW_FORMATS[preview_format]
+    tmp_path = preview_path + '.tmp'
+    result = subprocess.run(
+        [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-y', '-i', audio_file_path, '-vn', '-ac', '1',
+         '-c:a', encoder, '-b:a', bitrate, '-f', muxer, tmp_path],
+        capture_output=True
+    )
+    if result.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise RuntimeError(f"ffmpeg failed to create the preview: {result.stderr.decode(errors='replace').strip()}")
+    os.replace(tmp_path, preview_path)
+
+def _block_samples(sr, block_seconds, hop_seconds):
+    """Returns a block length close to `block_seconds` that holds a whole number of frames and waveform bins."""
+    step = np.lcm(_hop_samples(sr, hop_seconds), WAVEFORM_BIN_SAMPLES)
+    return int(step * max(1, int(round(block_seconds * sr / step))))
+
+def _open_ffmpeg_stream(audio_file_path, block_seconds=STREAMING_BLOCK_SECONDS, hop_seconds=ENVELOPE_HOP_SECONDS, mono=DECODE_MONO, target_sr=DECODE_SAMPLE_RATE):
+    """
+    Decodes a file with ffmpeg, reading float32 samples straight from its output pipe.
+
+    Args:
+        audio_file_path (str): The path to the audio file.
+        block_seconds (int): Approximate seconds of audio per yielded block.
+        hop_seconds (float): Envelope frame length; blocks hold a whole number of frames.
+        mono (bool): Let ffmpeg downmix to a single channel while decoding.
+        target_sr (int, optional): Let ffmpeg decimate to this sampling rate while decoding.
+
+    Returns:
+        tuple: A tuple containing:
+            - int: The sampling rate of the decoded samples.
+            - generator: Mono float32 blocks of whole frames (the last one may be shorter).
+    """
+    native_sr, channels, _ = _probe_audio(audio_file_path)
+    sr = int(target_sr) if target_sr else native_sr
+    if mono:
+        channels = 1
+
+    command = [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-i', audio_file_path, '-vn',
+               '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(channels), '-ar', str(sr), 'pipe:1']
+
+    def blocks():
+        # stderr goes to a file: a full stderr pipe would block ffmpeg while we wait on stdout
+        stderr_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        block_bytes = _block_samples(sr, block_seconds, hop_seconds) * channels * 4
+        try:
+            while True:
+                raw = process.stdout.read(block_bytes)
+                if not raw:
+                    break
+                block = np.frombuffer(raw, dtype='<f4')
+                if channels > 1:
+                    # Same downmix as librosa.load, so results match the in-memory WAV path
+                    block = librosa.to_mono(block.reshape(-1, channels).T)
+                yield block
+            if process.wait() != 0:
+                stderr_file.seek(0)
+                error = stderr_file.read()
+                raise RuntimeError(f"ffmpeg failed to decode the file: {error.decode(errors='replace').strip()}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            stderr_file.close()
+
+    return sr, blocks()
+
+def _open_audio_stream(audio_file_path, block_seconds=STREAMING_BLOCK_SECONDS, hop_seconds=ENVELOPE_HOP_SECONDS):
+    """
+    Opens an audio file for block-wise reading with the decoder suited to its format.
+
+    Returns:
+        tuple: A tuple containing:
+            - int: The sampling rate (sr).
+            - iterable: Mono float32 blocks holding a whole number of frames (except the last one).
+    """
+    if audio_file_path.lower().endswith('.mp3'):
+        return _open_ffmpeg_stream(audio_file_path, block_seconds, hop_seconds)
+
+    sr = sf.info(audio_file_path).samplerate
+    block_size = _block_samples(sr, block_seconds, hop_seconds)
+
+    def blocks():
+        for block in sf.blocks(audio_file_path, blocksize=block_size, dtype='float32'):
+            yield librosa.to_mono(block.T) if block.ndim > 1 else block
+
+    return sr, blocks()
+
 def _load_audio_file(audio_file_path):
     """
-    Loads an audio file, converting MP3 to WAV in memory if necessary.
+    Loads an audio file. MP3 files are decoded by ffmpeg straight into float32 samples.
 
     Args:
         audio_file_path (str): The path to the audio file.
@@ -666,18 +1318,211 @@ def _load_audio_file(audio_file_path):
             - int: The sampling rate (sr).
     """
     if audio_file_path.lower().endswith('.mp3'):
-        # Convert MP3 to WAV in memory to ensure compatibility
-        audio = AudioSegment.from_mp3(audio_file_path)
-        wav_io = io.BytesIO()
-        audio.export(wav_io, format="wav")
-        wav_io.seek(0)
-        y, sr = librosa.load(wav_io, sr=None)
+        sr, blocks = _open_ffmpeg_stream(audio_file_path)
+        decoded = list(blocks)
+        y = np.concatenate(decoded) if decoded else np.zeros(0, dtype=np.float32)
     else:
         # Load other formats directly
         y, sr = librosa.load(audio_file_path, sr=None)
     return y, sr
 
-def perform_initial_analysis(audio_file_path, apnea_threshold_factor=APNEA_THRESHOLD_FACTOR):
+def _audio_duration(audio_file_path):
+    """
+    Returns the duration of a recording in seconds, read from its header, or 0 if it cannot be read.
+    """
+    try:
+        if audio_file_path.lower().endswith('.mp3'):
+            return _probe_audio(audio_file_path)[2]
+        return sf.info(audio_file_path).duration
+    except (RuntimeError, ValueError, OSError, subprocess.CalledProcessError, sf.SoundFileError):
+        return 0
+
+def _should_stream(audio_file_path):
+    """
+    Decides whether a file is long enough to be analyzed block by block.
+    """
+    return _audio_duration(audio_file_path) >= STREAMING_MIN_DURATION
+
+def _compute_audio_features(audio_file_path, streaming=None, hop_seconds=ENVELOPE_HOP_SECONDS, progress=None):
+    """
+    Extracts the duration, sampling rate, waveshow data and amplitude envelope of a recording.
+
+    Args:
+        audio_file_path (str): The path to the audio file.
+        streaming (bool, optional): Force (True) or disable (False) block-wise processing.
+            By default long recordings are streamed.
+        hop_seconds (float): Envelope frame length in seconds.
+        progress (callable, optional): Progress callback, see `perform_initial_analysis`.
+
+    Returns:
+        dict: Duration, sampling rate, hop, waveshow 'signal' lists and 'envelope' DataFrame.
+    """
+    if streaming is None:
+        streaming = _should_stream(audio_file_path)
+    if streaming:
+        return calculate_streaming_features(audio_file_path, hop_seconds=hop_seconds, progress=progress)
+
+    y, sr = _load_audio_file(audio_file_path)
+    # A single pass gives both the envelope and the waveshow extremes
+    frame_features = calculate_frame_features(y, sr, hop_seconds)
+    return _build_features(len(y) / sr, sr, hop_seconds, frame_features, calculate_minmax_bins(y))
+
+def calculate_amplitude_max(df_envelope):
+    """
+    Returns the largest absolute mean amplitude of the envelope, the reference for the apnea threshold.
+    """
+    positive_mean_max = df_envelope['Positive_Mean'].dropna().max()
+    negative_mean_min = df_envelope['Negative_Mean'].dropna().min()
+    return max(positive_mean_max if pd.notna(positive_mean_max) else 0, abs(negative_mean_min) if pd.notna(negative_mean_min) else 0)
+
+def detect_events(df_envelope, amplitude_max, apnea_threshold_factor=APNEA_THRESHOLD_FACTOR, hop_seconds=ENVELOPE_HOP_SECONDS):
+    """
+    Segments the amplitude envelope into inhalation, exhalation and apnea events.
+
+    Args:
+        df_envelope (pd.DataFrame): The amplitude envelope.
+        amplitude_max (float): The value returned by `calculate_amplitude_max` for this envelope.
+        apnea_threshold_factor (float): The factor to determine the apnea detection threshold.
+        hop_seconds (float): Frame length of the envelope.
+
+    Returns:
+        EventStore: The events in start order, numbered by `EventStore.from_phases`.
+    """
+    # Apnea detection based on threshold
+    apnea_threshold = amplitude_max * apnea_threshold_factor
+
+    apnea_mask = (df_envelope['Positive_Mean'].fillna(0) < apnea_threshold) & \
+                 (np.abs(df_envelope['Negative_Mean'].fillna(0)) < apnea_threshold)
+
+    # Run-length segment the mask; phases come out already in time order
+    _, starts, ends, codes = segment_apnea_masks(apnea_mask.to_numpy()[None, :], df_envelope['Time'].to_numpy(), hop_seconds)
+    return EventStore.from_phases(starts, ends, codes)
+
+def sweep_apnea_thresholds(df_envelope, amplitude_max, factors, custom_config=None, hop_seconds=ENVELOPE_HOP_SECONDS):
+    """
+    Segments the envelope with many apnea threshold factors at once and scores every result.
+
+    All apnea masks are built as one 2-D boolean matrix (factors x frames) and run-length
+    segmented together by `segment_apnea_masks`.
+
+    Args:
+        df_envelope (pd.DataFrame): The amplitude envelope.
+        amplitude_max (float): The value returned by `calculate_amplitude_max` for this envelope.
+        factors (list): Apnea threshold factors to evaluate.
+        custom_config (dict, optional): Scoring parameters passed to `analyze_respiration`.
+        hop_seconds (float): Frame length of the envelope.
+
+    Returns:
+        list: One dictionary per factor with 'apnea_threshold_factor', 'num_events',
+              'num_cycles' and 'respiration_analysis' (None when no cycle was found).
+    """
+    factors = np.asarray(factors, dtype=np.float64)
+    thresholds = amplitude_max * factors
+    positive_mean = df_envelope['Positive_Mean'].fillna(0).to_numpy()
+    negative_mean = np.abs(df_envelope['Negative_Mean'].fillna(0).to_numpy())
+    apnea_masks = (positive_mean[None, :] < thresholds[:, None]) & (negative_mean[None, :] < thresholds[:, None])
+
+    rows, starts, ends, codes = segment_apnea_masks(apnea_masks, df_envelope['Time'].to_numpy(), hop_seconds)
+    row_bounds = np.searchsorted(rows, np.arange(len(factors) + 1))
+
+    results = []
+    for i, factor in enumerate(factors):
+        lo, hi = row_bounds[i], row_bounds[i + 1]
+        events = EventStore.from_phases(starts[lo:hi], ends[lo:hi], codes[lo:hi])
+        df_table, cycle_events = build_respiratory_cycles_table(events)
+        results.append({
+            'apnea_threshold_factor': float(factor),
+            'num_events': len(events),
+            'num_cycles': len(cycle_events),
+            'respiration_analysis': analyze_respiration(df_table, custom_config=custom_config)
+        })
+    return results
+
+def save_audio_features(features_path, features):
+    """
+    Stores the audio features of a recording in a compact binary (.npz) sidecar.
+
+    Args:
+        features_path (str): Destination file, usually FEATURES_FILENAME inside the session folder.
+        features (dict): Features as returned by `_compute_audio_features`.
+    """
+    df_envelope = features['envelope']
+    tmp_path = features_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(
+            f,
+            version=FEATURES_VERSION,
+            duration=features['duration'],
+            sampling_rate=features['sampling_rate'],
+            hop_seconds=features['hop_seconds'],
+            amplitude_max=calculate_amplitude_max(df_envelope),
+            signal_t=np.asarray(features['signal']['t'], dtype=np.float64),
+            signal_min=np.asarray(features['signal']['min'], dtype=np.float32),
+            signal_max=np.asarray(features['signal']['max'], dtype=np.float32),
+            envelope_time=df_envelope['Time'].to_numpy(),
+            envelope_positive_mean=df_envelope['Positive_Mean'].to_numpy(),
+            envelope_negative_mean=df_envelope['Negative_Mean'].to_numpy()
+        )
+    os.replace(tmp_path, features_path)
+
+def load_audio_features(features_path, hop_seconds=ENVELOPE_HOP_SECONDS):
+    """
+    Reads a sidecar written by `save_audio_features`.
+
+    Returns:
+        tuple: The features dictionary and the stored amplitude maximum, or None if the file
+               is missing, was written by another FEATURES_VERSION or uses another hop.
+    """
+    if not os.path.exists(features_path):
+        return None
+    with np.load(features_path) as data:
+        if int(data['version']) != FEATURES_VERSION or _normalize_hop(data['hop_seconds']) != _normalize_hop(hop_seconds):
+            return None
+        features = {
+            'duration': float(data['duration']),
+            'sampling_rate': int(data['sampling_rate']),
+            'hop_seconds': _normalize_hop(data['hop_seconds']),
+            'signal': {
+                't': data['signal_t'].tolist(),
+                'min': data['signal_min'].tolist(),
+                'max': data['signal_max'].tolist()
+            },
+            'envelope': pd.DataFrame({
+                'Time': data['envelope_time'],
+                'Positive_Mean': data['envelope_positive_mean'],
+                'Negative_Mean': data['envelope_negative_mean']
+            })
+        }
+        return features, float(data['amplitude_max'])
+
+def get_audio_features(audio_file_path, features_path=None, streaming=None, hop_seconds=ENVELOPE_HOP_SECONDS, waveform_path=None, progress=None):
+    """
+    Returns the audio features of a recording, from its sidecar when available.
+
+    Args:
+        audio_file_path (str): The path to the audio file.
+        features_path (str, optional): Feature sidecar to read, or to write after computing.
+        streaming (bool, optional): Passed to `_compute_audio_features` on a cache miss.
+        hop_seconds (float): Envelope frame length in seconds.
+        waveform_path (str, optional): Waveform pyramid file to write when computing. If it
+            does not exist yet (sessions created before the pyramid), the audio is decoded
+            again to create it.
+        progress (callable, optional): Progress callback, see `perform_initial_analysis`.
+
+    Returns:
+        tuple: The features dictionary and the amplitude maximum of its envelope.
+    """
+    cached = load_audio_features(features_path, hop_seconds) if features_path else None
+    if cached and (not waveform_path or os.path.exists(waveform_path)):
+        return cached
+    features = _compute_audio_features(audio_file_path, streaming, hop_seconds, progress)
+    if features_path:
+        save_audio_features(features_path, features)
+    if waveform_path:
+        save_waveform_pyramid(waveform_path, features['sampling_rate'], features['waveform_bins'])
+    return features, calculate_amplitude_max(features['envelope'])
+
+def perform_initial_analysis(audio_file_path, apnea_threshold_factor=APNEA_THRESHOLD_FACTOR, streaming=None, features_path=None, hop_seconds=ENVELOPE_HOP_SECONDS, waveform_path=None, progress=None):
     """
     Main function to analyze the audio. It does not generate visualizations,
     only extracts the necessary data for the interface.
@@ -685,6 +1530,15 @@ def perform_initial_analysis(audio_file_path, apnea_threshold_factor=APNEA_THRES
     Args:
         audio_file_path (str): The absolute path to the audio file.
         apnea_threshold_factor (float): The factor to determine the apnea detection threshold.
+        streaming (bool, optional): Read the file block by block instead of loading it whole.
+            Defaults to streaming recordings longer than STREAMING_MIN_DURATION.
+        features_path (str, optional): Feature sidecar of the session. When it exists the audio
+            is not decoded again and only the segmentation runs; otherwise it is written.
+        hop_seconds (float): Envelope frame length; sub-second values give finer event timing.
+        waveform_path (str, optional): Where to write the waveform pyramid served by /waveform.
+        progress (callable, optional): Called as progress(stage, fraction) while the analysis
+            runs, with stage 'decoding' (reported per block when streaming) or 'segmenting',
+            and fraction the completed part of that stage, from 0 to 1.
 
     Returns:
         tuple: A tuple containing:
@@ -692,49 +1546,35 @@ def perform_initial_analysis(audio_file_path, apnea_threshold_factor=APNEA_THRES
             - str: An error message if an error occurred, otherwise None.
     """
     try:
-        y, sr = _load_audio_file(audio_file_path)
+        if progress:
+            progress('decoding', 0.0)
+        features, amplitude_max = get_audio_features(audio_file_path, features_path, streaming, hop_seconds, waveform_path, progress)
+        df_envelope = features['envelope']
+        if progress:
+            progress('segmenting', 0.0)
         filename = os.path.basename(audio_file_path)
-        duration = len(y) / sr
 
-        # Generate data for waveshow visualization
-        t_wave, y_min, y_max = calculate_waveshow_data(y, sr)
-
-        df_envelope = calculate_amplitude_envelope(y, sr)
         if df_envelope.empty:
             return None, "Audio duration is too short to be analyzed."
 
-        # Apnea detection based on threshold
-        positive_mean_max = df_envelope['Positive_Mean'].dropna().max()
-        negative_mean_min = df_envelope['Negative_Mean'].dropna().min()
-        amplitude_max = max(positive_mean_max if pd.notna(positive_mean_max) else 0, abs(negative_mean_min) if pd.notna(negative_mean_min) else 0)
-        apnea_threshold = amplitude_max * apnea_threshold_factor
-        
-        apnea_mask = (df_envelope['Positive_Mean'].fillna(0) < apnea_threshold) & \
-                     (np.abs(df_envelope['Negative_Mean'].fillna(0)) < apnea_threshold)
-
-        # Get phases and convert them to a list of events
-        detected_phases = identify_phase_intervals(apnea_mask, df_envelope['Time'])
-        events = phases_to_events(detected_phases)
+        events = detect_events(df_envelope, amplitude_max, apnea_threshold_factor, features['hop_seconds'])
 
         # Generate table and get cycle events
         _, cycle_events = build_respiratory_cycles_table(events)
 
         # Prepare data to send as JSON
         analysis_data = {
-            "duration": duration,
-            "sampling_rate": sr,
+            "duration": features['duration'],
+            "sampling_rate": features['sampling_rate'],
+            "hop_seconds": features['hop_seconds'],
             "filename": filename,
-            "signal": {
-                "t": t_wave,
-                "min": y_min,
-                "max": y_max
-            },
+            "signal": features['signal'],
             "envelope": {
                 "time": df_envelope['Time'].tolist(),
                 "positive_mean": df_envelope['Positive_Mean'].tolist(),
                 "negative_mean": df_envelope['Negative_Mean'].tolist()
             },
-            "events": events,
+            "events": events.to_records(),
             "cycle_events": cycle_events
         }
         
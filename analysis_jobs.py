@@ -0,0 +1,295 @@
+"""
+Background analysis of uploaded recordings.
+
+An upload is saved to its session folder and queued as a job, and the request returns
+the job id at once. A bounded pool of worker processes runs the analysis and the
+database insert. Every job is a row of the `analysis_jobs` SQLite table, which the
+worker updates as it goes and `GET /jobs/<job_id>` reads:
+
+    status    queued, running, done or failed
+    stage     queued, decoding, segmenting, saving or done
+    progress  percentage of the whole job (decoding is reported per block for long recordings)
+
+At most ANALYSIS_WORKERS jobs run at the same time and at most MAX_PENDING_JOBS are
+accepted (running or waiting); beyond that uploads are refused until a job finishes.
+Like the session cache, the queue lives in the single server process.
+
+Recordings whose analysis is in the content store's cache (see content_store.py) are
+not queued: their session is created from the cached results within the request. They
+still take one of the MAX_PENDING_JOBS places while that happens, and a failure is
+recorded on their job like any other.
+"""
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from analisis_audio import perform_initial_analysis, analyze_respiration, build_respiratory_cycles_table, APNEA_THRESHOLD_FACTOR, FEATURES_FILENAME, WAVEFORM_FILENAME
+from content_store import load_cached_analysis, store_cached_analysis
+from database import create_job, update_job, get_job, save_analysis_to_db
+from session_store import save_session, without_arrays
+
+ANALYSIS_WORKERS = 2  # Worker processes analyzing uploads at the same time
+MAX_PENDING_JOBS = 8  # Jobs running or waiting beyond which new uploads are refused
+STAGE_PROGRESS = {  # Stage -> (progress at its start, progress at its end), in percent
+    'queued': (0, 0),
+    'decoding': (0, 80),
+    'segmenting': (80, 90),
+    'saving': (90, 100),
+    'done': (100, 100)
+}
+
+
+def analyze_session(session_folder_path, filename, apnea_threshold_factor=APNEA_THRESHOLD_FACTOR, progress=None, audio_hash=None):
+    """
+    Analyzes a recording saved in its session folder and writes the session files.
+
+    The database row is left to the caller, which adds the db_id to the session document
+    once it has one.
+
+    Args:
+        session_folder_path (str): The session folder holding the recording.
+        filename (str): The name of the audio file inside the folder.
+        apnea_threshold_factor (float): The factor to determine the apnea detection threshold.
+        progress (callable, optional): Progress callback, see `perform_initial_analysis`.
+        audio_hash (str, optional): SHA-256 of the recording. When given, a cached analysis
+            is used instead of decoding the audio, and a new analysis is added to the cache.
+
+    Returns:
+        tuple: A tuple containing:
+            - dict: 'analysis_data' (without arrays), 'df_table' and 'respiration_analysis' if successful.
+            - str: An error message if an error occurred, otherwise None.
+    """
+    if audio_hash:
+        session = restore_cached_session(session_folder_path, filename, audio_hash, apnea_threshold_factor)
+        if session:
+            return session, None
+
+    audio_filepath = os.path.join(session_folder_path, filename)
+    features_path = os.path.join(session_folder_path, FEATURES_FILENAME)
+    waveform_path = os.path.join(session_folder_path, WAVEFORM_FILENAME)
+    analysis_data, error = perform_initial_analysis(audio_filepath, apnea_threshold_factor, features_path=features_path, waveform_path=waveform_path, progress=progress)
+    if error:
+        return None, error
+
+    if progress:
+        progress('saving', 0.0)
+    # Store original events for comparison in export
+    analysis_data['original_events'] = analysis_data['events'].copy()
+    analysis_data['session_folder'] = session_folder_path
+    analysis_data['audio_filename'] = filename
+
+    save_session(session_folder_path, analysis_data)
+
+    if audio_hash:
+        try:
+            store_cached_analysis(audio_hash, apnea_threshold_factor, session_folder_path, analysis_data)
+        except Exception as e:
+            # The session itself is complete; only later uploads lose the shortcut
+            print(f"Failed to cache the analysis of {audio_hash}: {e}")
+
+    df_table, cycle_events = build_respiratory_cycles_table(analysis_data['events'])
+    respiration_analysis = analyze_respiration(df_table)
+    analysis_data['cycle_events'] = cycle_events
+    return {'analysis_data': without_arrays(analysis_data), 'df_table': df_table, 'respiration_analysis': respiration_analysis}, None
+
+
+def restore_cached_session(session_folder_path, filename, audio_hash, apnea_threshold_factor=APNEA_THRESHOLD_FACTOR):
+    """
+    Writes the session files of a recording from its cached analysis, without decoding it.
+
+    Returns:
+        dict: Same as `analyze_session`, or None if the analysis is not cached.
+    """
+    analysis_data = load_cached_analysis(audio_hash, apnea_threshold_factor, session_folder_path)
+    if analysis_data is None:
+        return None
+    analysis_data['filename'] = filename
+    analysis_data['session_folder'] = session_folder_path
+    analysis_data['audio_filename'] = filename
+
+    df_table, cycle_events = build_respiratory_cycles_table(analysis_data['events'])
+    analysis_data['cycle_events'] = cycle_events
+    save_session(session_folder_path, analysis_data)
+    return {'analysis_data': analysis_data, 'df_table': df_table, 'respiration_analysis': analyze_respiration(df_table)}
+
+
+def save_session_row(session_folder_path, session, participant_name, audio_hash=None):
+    """
+    Inserts the database row of an analyzed session and adds its db_id to the session document.
+
+    Returns:
+        int: The db_id, or None if the row could not be saved.
+    """
+    analysis_data = session['analysis_data']
+    db_id = save_analysis_to_db(session_folder_path, analysis_data, session['df_table'], session['respiration_analysis'], participant_name, audio_hash)
+    if db_id is None:
+        return None
+    analysis_data['db_id'] = db_id
+    save_session(session_folder_path, analysis_data)
+    return db_id
+
+
+def run_analysis_job(job_id, session_folder_path, filename, participant_name, audio_hash=None):
+    """
+    Analyzes an uploaded recording and stores the session, in a worker process.
+
+    Args:
+        job_id (str): The job to report progress to.
+        session_folder_path (str): The session folder holding the upload.
+        filename (str): The name of the audio file inside the folder.
+        participant_name (str): The participant, stored with the session.
+        audio_hash (str, optional): SHA-256 of the recording, to cache the analysis under.
+
+    Returns:
+        int: The db_id of the new session, or None if the analysis failed.
+    """
+    report = _ProgressReporter(job_id)
+    try:
+        session, error = analyze_session(session_folder_path, filename, progress=report, audio_hash=audio_hash)
+        if error:
+            update_job(job_id, 'failed', report.stage, report.percent, error=error)
+            return None
+
+        db_id = save_session_row(session_folder_path, session, participant_name, audio_hash)
+        if db_id is None:
+            update_job(job_id, 'failed', 'saving', report.percent, error="The analysis could not be saved to the database.")
+            return None
+
+        update_job(job_id, 'done', 'done', 100, db_id=db_id)
+        return db_id
+    except Exception as e:
+        update_job(job_id, 'failed', report.stage, report.percent, error=f"An error occurred while processing the file: {e}")
+        return None
+
+
+def run_cached_job(job_id, session_folder_path, filename, participant_name, audio_hash):
+    """
+    Completes a job from the cached analysis of its recording, in the calling thread.
+
+    Returns:
+        bool: False if the analysis is not cached (the job still has to be analyzed),
+              True once the job is done or failed.
+    """
+    try:
+        session = restore_cached_session(session_folder_path, filename, audio_hash)
+        if not session:
+            return False
+        update_job(job_id, 'running', 'saving', STAGE_PROGRESS['saving'][0])
+        db_id = save_session_row(session_folder_path, session, participant_name, audio_hash)
+        if db_id is None:
+            update_job(job_id, 'failed', 'saving', STAGE_PROGRESS['saving'][0], error="The analysis could not be saved to the database.")
+        else:
+            update_job(job_id, 'done', 'done', 100, db_id=db_id)
+    except Exception as e:
+        update_job(job_id, 'failed', 'saving', STAGE_PROGRESS['saving'][0], error=f"An error occurred while restoring the cached analysis: {e}")
+    return True
+
+
+class _ProgressReporter:
+    """
+    Progress callback of one job; writes to SQLite only when the percentage or stage changes.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stage = 'queued'
+        self.percent = 0
+
+    def __call__(self, stage, fraction):
+        low, high = STAGE_PROGRESS[stage]
+        percent = int(low + (high - low) * min(max(fraction, 0.0), 1.0))
+        if stage == self.stage and percent == self.percent:
+            return
+        self.stage, self.percent = stage, percent
+        update_job(self.job_id, 'running', stage, percent)
+
+
+class AnalysisQueue:
+    """
+    Bounded queue of analysis jobs run by a process pool.
+
+    Args:
+        max_workers (int): Jobs analyzed at the same time.
+        max_pending (int): Jobs accepted at the same time, running or waiting.
+    """
+
+    def __init__(self, max_workers=ANALYSIS_WORKERS, max_pending=MAX_PENDING_JOBS):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._jobs = set()  # Ids of the jobs accepted by this process and not finished yet
+        self._lock = threading.Lock()
+
+    def submit(self, session_folder_path, filename, participant_name, audio_hash=None):
+        """
+        Queues the analysis of a recording already saved in its session folder.
+
+        A recording whose analysis is cached is not queued: its session is created at once
+        and the job returned is already done (or failed).
+
+        Returns:
+            str: The job id, or None if the queue is full.
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if len(self._jobs) >= self.max_pending:
+                return None
+            self._jobs.add(job_id)
+        try:
+            if not create_job(job_id, session_folder_path, filename, participant_name):
+                raise RuntimeError("The job could not be recorded.")
+            if audio_hash and run_cached_job(job_id, session_folder_path, filename, participant_name, audio_hash):
+                with self._lock:
+                    self._jobs.discard(job_id)
+                return job_id
+            future = self._get_executor().submit(run_analysis_job, job_id, session_folder_path, filename, participant_name, audio_hash)
+        except Exception:
+            with self._lock:
+                self._jobs.discard(job_id)
+            raise
+        future.add_done_callback(lambda done: self._finished(job_id, done))
+        return job_id
+
+    def status(self, job_id):
+        """
+        Returns the job's status, stage, progress, db_id and error, or None if it does not exist.
+        """
+        job = get_job(job_id)
+        if job and job['status'] in ('queued', 'running'):
+            with self._lock:
+                orphaned = job_id not in self._jobs
+            # A job of this process may have finished between the two reads
+            job = get_job(job_id) if orphaned else job
+            if orphaned and job['status'] in ('queued', 'running'):
+                # Accepted by a server process that has stopped since; it will never finish
+                job.update(status='failed', error="The server stopped before the analysis finished. Please upload the file again.")
+                update_job(job_id, job['status'], job['stage'], job['progress'], error=job['error'])
+        return job
+
+    def stats(self):
+        """Returns the number of jobs accepted and the queue limits."""
+        with self._lock:
+            return {'pending': len(self._jobs), 'max_pending': self.max_pending, 'workers': self.max_workers}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Worker processes are spawned rather than forked: the server has threads running
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _finished(self, job_id, future):
+        error = future.exception()
+        if error is not None:
+            # The worker died (killed, out of memory) without reporting the failure itself
+            job = get_job(job_id) or {'stage': 'queued', 'progress': 0}
+            update_job(job_id, 'failed', job['stage'], job['progress'], error=f"The analysis worker stopped unexpectedly: {error}")
+        with self._lock:
+            self._jobs.discard(job_id)
+        if isinstance(error, BrokenProcessPool):
+            with self._lock:
+                self._executor = None
@@ -1,11 +1,20 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, send_file
-import os
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, send_file, make_response
 import json
+import os
 import shutil
+import struct
+import threading
+import numpy as np
 from werkzeug.utils import secure_filename
-from analisis_audio import perform_initial_analysis, analyze_respiration, build_respiratory_cycles_table, save_analysis_results, CONFIG
+from analisis_audio import perform_initial_analysis, analyze_respiration, build_respiratory_cycles_table, find_respiratory_cycles, cycle_durations, cycle_averages, cycles_dataframe, cycle_event_items, CYCLES_TABLE_HEADER, save_analysis_results, get_audio_features, sweep_apnea_thresholds, read_waveform_window, create_audio_preview, cycle_statistics, update_cycle_statistics, score_statistics, score_config_variants, CONFIG, FEATURES_FILENAME, WAVEFORM_FILENAME, PREVIEW_FILENAME, PREVIEW_FORMATS, MAX_SWEEP_FACTORS
+from event_store import EventStore, IntervalIndex, CYCLE_PATTERN, PHASE_TYPES
+from session_store import save_session_arrays, load_session_arrays, read_session_array, without_arrays, SESSION_ARRAY_KEYS, SESSION_ARRAYS_FILENAME
+from session_cache import SessionCache
+from operation_log import edit_operation, document_operation, event_patch, first_changed_event
+from analysis_jobs import AnalysisQueue
+from content_store import save_audio_stream, link_audio
+from database import create_tables, get_participants, get_participant_trends, CYCLE_BIN_SECONDS, CYCLE_TABLE_COLUMNS, SCORE_TABLE_COLUMNS
 from datetime import datetime
-from database import save_analysis_to_db, update_analysis_in_db, get_analysis_details
 
 app = Flask(__name__)
 
@@ -13,11 +22,27 @@ app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
 RESULTS_FOLDER = 'results'
 ALLOWED_EXTENSIONS = {'wav', 'mp3'}
+MAX_WAVEFORM_PIXELS = 8000  # Upper bound on the bins returned by one /waveform request
+FLOAT32_ARRAYS_MAGIC = b'F32A'  # First bytes of the binary array responses
+AUDIO_MAX_AGE = 24 * 3600  # Seconds browsers may reuse session audio without revalidating; it never changes
+MAX_SCORE_VARIANTS = 10000  # Upper bound on the scoring configurations evaluated by one /score_variants request
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
+create_tables()
+
+# Decoded sessions kept in memory between requests; edits are written to disk and SQLite in the background
+session_cache = SessionCache()
+# One lock per preview file being transcoded, so concurrent requests for it do not run ffmpeg
+# twice while previews of other sessions go ahead
+preview_locks = {}
+preview_locks_guard = threading.Lock()
+# Uploads are analyzed by a bounded pool of worker processes
+analysis_queue = AnalysisQueue()
+QUEUE_FULL_ERROR = "The server is busy analyzing other recordings. Please try again in a minute."
+QUEUE_RETRY_SECONDS = 30  # Retry-After sent with uploads refused because the queue is full
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -27,85 +52,425 @@ def relabel_events(events):
     Sorts events and re-labels them to enforce a strict cyclical pattern:
     inhalation -> apnea -> exhalation -> apnea.
     """
-    events.sort(key=lambda x: x['start'])
-    
-    # Define the target 4-phase cycle
-    phase_cycle = ['inhalation', 'apnea', 'exhalation', 'apnea']
-    
-    for i, event in enumerate(events):
-        # Assign the type based on the position in the cycle
-        event['type'] = phase_cycle[i % 4]
-        
-    return events
-
-def _get_updated_data_response(analysis_data, db_id):
-    """Helper function to generate the full JSON response for UI updates."""
-    df_table, cycle_events = build_respiratory_cycles_table(analysis_data['events'])
-    table_html = df_table.to_html(classes='table table-striped', index=False)
-    respiration_analysis = analyze_respiration(df_table)
-    
-    update_analysis_in_db(db_id, analysis_data, df_table, respiration_analysis)
-    
-    analysis_data['cycle_events'] = cycle_events
+    # The store only re-sorts when an edit broke the start order
+    return events.relabel(CYCLE_PATTERN)
+
+def _float32_response(arrays, **metadata):
+    """
+    Sends equally long arrays as a single little-endian float32 buffer, which the page reads
+    as Float32Arrays without parsing any JSON numbers.
+
+    Layout: FLOAT32_ARRAYS_MAGIC, the header length as a little-endian uint32, a JSON header
+    ({"fields": [...], "length": n, **metadata}) padded with spaces to a multiple of 4 bytes,
+    then the n values of every field in the order of "fields".
+    """
+    fields = list(arrays)
+    length = len(arrays[fields[0]]) if fields else 0
+    header = json.dumps(dict(metadata, fields=fields, length=length)).encode()
+    header += b' ' * (-len(header) % 4)
+    body = b''.join(np.asarray(arrays[field], dtype='<f4').tobytes() for field in fields)
+    response = make_response(FLOAT32_ARRAYS_MAGIC + struct.pack('<I', len(header)) + header + body)
+    response.mimetype = 'application/octet-stream'
+    return response
+
+def _store_edit(entry, name, before, events):
+    """Saves the edited events in the cached session and logs the edit for undo/redo."""
+    entry.analysis_data['events'] = events.to_records()
+    operation = edit_operation(name, before, events, CYCLE_PATTERN)
+    session_cache.record(entry, operation)
+    return operation
+
+def _cycle_view(version, events, previous=None, first_event=0):
+    """
+    Keeps the cycles of one session version (the events they start at, their durations,
+    bounds and cycle events) with the sufficient statistics the scores are computed from.
+
+    Given the `previous` view of the session and the position of the first event an edit
+    changed, only the cycles from there on are found again: a cycle spans
+    len(CYCLE_PATTERN) consecutive events, so the cycles ending before that event are
+    kept, and the statistics are updated with the cycles after it. The rows and cycle
+    events that changed since `previous` are kept as 'changes', for the edit's delta.
+    """
+    if previous is None:
+        first_event = 0
+    scan_from = max(first_event - len(CYCLE_PATTERN) + 1, 0)
+    kept = int(np.searchsorted(previous['positions'], scan_from)) if previous is not None else 0
+    positions = find_respiratory_cycles(events.codes, scan_from)
+    durations = cycle_durations(events, positions)
+    bounds = np.column_stack([events.starts[positions], events.ends[positions + len(CYCLE_PATTERN) - 1]])
+    cycle_events = cycle_event_items(events, positions, kept + 1)
+    if previous is None:
+        statistics = cycle_statistics(durations)
+    else:
+        statistics = update_cycle_statistics(previous['statistics'], previous['durations'][kept:], durations)
+        positions, durations, bounds = (np.concatenate([previous[key][:kept], tail]) for key, tail in
+                                        (('positions', positions), ('durations', durations), ('bounds', bounds)))
+        cycle_events = previous['cycle_events'][:kept] + cycle_events
+    view = {'version': version, 'positions': positions, 'durations': durations, 'bounds': bounds,
+            'cycle_events': cycle_events, 'statistics': statistics, 'averages': cycle_averages(statistics)}
+    if previous is not None:
+        # Only the cycles from `kept` on (and the 'avg' row after them) can differ
+        rows = _changed_range(_row_values(previous, kept), _row_values(view, kept))
+        cycles = _changed_range(_cycle_values(previous, kept), _cycle_values(view, kept))
+        view['changes'] = {'rows': tuple(kept + index for index in rows), 'cycles': tuple(kept + index for index in cycles)}
+    return view
+
+def _row_values(view, start):
+    """Returns the cycle table rows from `start` on as numbers, the 'avg' row numbered 0."""
+    count = len(view['durations'])
+    rows = np.column_stack([np.arange(start + 1, count + 1), view['durations'][start:]])
+    if count:
+        rows = np.vstack([rows, np.append(0, view['averages'])])
+    return rows
+
+def _cycle_values(view, start):
+    """Returns the cycle events from `start` on as (number, start, end) rows."""
+    return np.column_stack([np.arange(start + 1, len(view['bounds']) + 1), view['bounds'][start:]])
+
+def _cycle_rows(view, start=0, stop=None):
+    """Returns rows start:stop of the cycle table, the 'avg' row closing a table with cycles."""
+    count = len(view['durations'])
+    stop = count + 1 if stop is None else stop
+    rows = [[number + 1] + durations for number, durations in
+            zip(range(start, min(stop, count)), view['durations'][start:stop].tolist())]
+    if count and start <= count < stop:
+        rows.append(['avg'] + view['averages'].tolist())
+    return rows
+
+def _cycle_frame(view):
+    """Builds the cycles DataFrame of a view, for the page, the exports and SQLite."""
+    return cycles_dataframe(view['durations'], view['averages'])
+
+def _current_view(entry):
+    """Returns the view of the session's current version, building it if the session changed since."""
+    if entry.view is None or entry.view['version'] != entry.history.version:
+        events = EventStore.from_records(entry.analysis_data['events'])
+        entry.view = _cycle_view(entry.history.version, events)
+    return entry.view
+
+def _client_view(entry, client_version):
+    """
+    Brings the view of the session up to date before a change, and returns it if the client
+    holds that version; None if it does not (a delta against it could not be applied).
+    """
+    view = _current_view(entry)
+    return view if client_version is not None and client_version == view['version'] else None
 
+def _changed_range(old, new):
+    """
+    Compares two arrays of rows from both ends.
+
+    Returns:
+        tuple: (start, old_stop, new_stop) such that replacing old[start:old_stop] with
+               new[start:new_stop] turns `old` into `new`.
+    """
+    common = min(len(old), len(new))
+    differs = np.flatnonzero((old[:common] != new[:common]).any(axis=1))
+    start = int(differs[0]) if len(differs) else common
+    tail = common - start
+    differs = np.flatnonzero((old[len(old) - tail:] != new[len(new) - tail:]).any(axis=1))
+    suffix = tail - 1 - int(differs[-1]) if len(differs) else tail
+    return start, len(old) - suffix, len(new) - suffix
+
+def _cycle_table(view):
+    return {'columns': CYCLES_TABLE_HEADER, 'rows': _cycle_rows(view)}
+
+def _get_updated_data_response(entry, events=None, base=None, patch=None, first_event=None):
+    """
+    Helper function to generate the JSON response for UI updates.
+
+    When the client holds the previous version (`base`) and the change is an event edit
+    (`patch`), only the delta is sent: the events removed and added, the cycle table rows
+    and cycle events that changed, and the new scores. Otherwise the whole session is sent.
+    `first_event` is the position of the first event the change touched: the cycles are
+    found again from there on, against the view `_client_view` refreshed before the
+    change. Without it, they are all found again.
+    """
+    analysis_data = entry.analysis_data
+    if events is None:
+        events = EventStore.from_records(analysis_data['events'])
+    previous = entry.view if first_event is not None else None
+    view = entry.view = _cycle_view(entry.history.version, events, previous, first_event)
+    respiration_analysis = score_statistics(view['statistics'])
+
+    analysis_data['cycle_events'] = view['cycle_events']
+
+    # The session document and the database record are written by the cache's background flush;
+    # the cycles DataFrame is only built then
+    session_cache.mark_dirty(entry, lambda: _cycle_frame(view), respiration_analysis)
+    if base is None or patch is None or base is not previous:
+        # The signal and envelope do not change on edits (and the signal view is served by
+        # /waveform), so only the events and metadata are sent back
+        return jsonify({
+            'success': True,
+            'version': view['version'],
+            'analysis_data': without_arrays(analysis_data),
+            'cycle_table': _cycle_table(view),
+            'respiration_analysis': respiration_analysis
+        })
+
+    row_start, old_row_stop, new_row_stop = view['changes']['rows']
+    cycle_start, old_cycle_stop, new_cycle_stop = view['changes']['cycles']
     return jsonify({
         'success': True,
-        'analysis_data': analysis_data,
-        'table_html': table_html,
+        'version': view['version'],
+        'base_version': base['version'],
+        'delta': {
+            'events': dict(patch, pattern=[PHASE_TYPES[code] for code in CYCLE_PATTERN]),
+            'cycle_rows': {'start': row_start, 'delete_count': old_row_stop - row_start,
+                           'rows': _cycle_rows(view, row_start, new_row_stop)},
+            'cycle_events': {'start': cycle_start, 'delete_count': old_cycle_stop - cycle_start,
+                             'items': view['cycle_events'][cycle_start:new_cycle_stop]}
+        },
         'respiration_analysis': respiration_analysis
     })
 
+def _preview_lock(preview_path):
+    """Returns the lock held while the preview at `preview_path` is transcoded."""
+    with preview_locks_guard:
+        return preview_locks.setdefault(preview_path, threading.Lock())
+
+def _send_session_audio(session_folder, filename, mimetype=None):
+    """Sends an audio file of a session with range, ETag and conditional GET support."""
+    response = send_from_directory(session_folder, filename, mimetype=mimetype, conditional=True, etag=True, max_age=AUDIO_MAX_AGE)
+    # Recordings are personal data: browsers may cache them, shared proxies may not
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
 @app.route('/get_audio/<int:db_id>/<filename>')
 def get_audio(db_id, filename):
-    details = get_analysis_details(db_id)
-    if not details:
+    """
+    Serves the uploaded recording. Range requests get 206 partial responses, so seeking only
+    downloads what is played; the strong ETag and Last-Modified answer conditional requests with 304.
+    """
+    entry = session_cache.get(db_id)
+    if not entry:
+        return "Audio not found!", 404
+    session_folder = entry.session_folder
+    return _send_session_audio(session_folder, filename)
+
+@app.route('/get_audio_preview/<int:db_id>')
+def get_audio_preview(db_id):
+    """
+    Serves a low bit rate mono copy of the recording ('format' is 'opus' or 'mp3'), with the
+    same range and conditional support as /get_audio. It is transcoded on the first request
+    and kept in the session folder.
+    """
+    preview_format = request.args.get('format', 'opus')
+    if preview_format not in PREVIEW_FORMATS:
+        return jsonify({'success': False, 'error': f"format must be one of {', '.join(PREVIEW_FORMATS)}"}), 400
+    entry = session_cache.get(db_id)
+    if not entry:
         return "Audio not found!", 404
+
+    _, _, extension, mimetype = PREVIEW_FORMATS[preview_format]
+    preview_filename = f'{PREVIEW_FILENAME}.{extension}'
+    preview_path = os.path.join(entry.session_folder, preview_filename)
+    if not os.path.exists(preview_path):
+        lock = _preview_lock(preview_path)
+        try:
+            with lock:
+                if not os.path.exists(preview_path):
+                    create_audio_preview(os.path.join(entry.session_folder, entry.details['audio_filename']), preview_path, preview_format)
+        except (RuntimeError, OSError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 500
+        finally:
+            # Requests arriving from now on find the file, so the lock is no longer needed
+            with preview_locks_guard:
+                if preview_locks.get(preview_path) is lock:
+                    del preview_locks[preview_path]
+    return _send_session_audio(entry.session_folder, preview_filename, mimetype)
+
+@app.route('/waveform/<int:db_id>')
+def waveform(db_id):
+    """
+    Returns the min/max waveform of the window [start, end) at a resolution of about `px` bins.
+
+    The bins come from the session's precomputed pyramid, so the payload size depends only
+    on `px`, whatever the zoom level.
+    """
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    details = entry.details
+    try:
+        window_start = float(request.args.get('start', 0))
+        window_end = float(request.args['end'])
+        px = int(request.args.get('px', 1000))
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'error': 'end is required; start, end and px must be numbers'}), 400
+    if window_end <= window_start or not 0 < px <= MAX_WAVEFORM_PIXELS:
+        return jsonify({'success': False, 'error': f'end must be after start and px between 1 and {MAX_WAVEFORM_PIXELS}'}), 400
+
     session_folder = details['session_folder_path']
-    return send_from_directory(session_folder, filename)
+    waveform_path = os.path.join(session_folder, WAVEFORM_FILENAME)
+    window = read_waveform_window(waveform_path, window_start, window_end, px)
+    if window is None:
+        # Sessions analyzed before the pyramid existed get it built on first use
+        try:
+            get_audio_features(os.path.join(session_folder, details['audio_filename']),
+                               os.path.join(session_folder, FEATURES_FILENAME), waveform_path=waveform_path)
+        except Exception as e:
+            return jsonify({'success': False, 'error': str(e)}), 500
+        window = read_waveform_window(waveform_path, window_start, window_end, px)
+
+    if request.args.get('format') == 'binary':
+        return _float32_response({'min': window['min'], 'max': window['max']},
+                                 level=window['level'], bin_seconds=window['bin_seconds'], start=window['start'])
+    return jsonify({'success': True, **window, 'min': window['min'].tolist(), 'max': window['max'].tolist()})
+
+@app.route('/arrays/<int:db_id>/<name>')
+def session_arrays(db_id, name):
+    """
+    Returns the 'signal' or 'envelope' arrays of a session as a float32 buffer (see `_float32_response`).
+    """
+    if name not in SESSION_ARRAY_KEYS:
+        return jsonify({'success': False, 'error': f'Unknown array {name}'}), 404
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    arrays = read_session_array(entry.session_folder, name)
+    if arrays is None:
+        return jsonify({'success': False, 'error': 'Session arrays not found'}), 404
+
+    # The arrays only change on /recalculate, so the browser can revalidate its copy with the ETag
+    response = _float32_response(arrays)
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/events/<int:db_id>')
+def events_in_window(db_id):
+    """
+    Returns the phase and cycle events overlapping the time window [start, end).
+
+    Query parameters `start` and `end` are in seconds and default to the whole recording.
+    """
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    try:
+        window_start = float(request.args.get('start', '-inf'))
+        window_end = float(request.args.get('end', 'inf'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'start and end must be numbers'}), 400
+    if window_end < window_start:
+        return jsonify({'success': False, 'error': 'end must not be before start'}), 400
+
+    with entry.lock:
+        events = EventStore.from_records(entry.analysis_data['events'])
+    _, cycle_events = build_respiratory_cycles_table(events)
+    cycle_index = IntervalIndex([cycle['start'] for cycle in cycle_events], [cycle['end'] for cycle in cycle_events])
+
+    return jsonify({
+        'success': True,
+        'events': events.subset(events.overlapping(window_start, window_end)).to_records(),
+        'cycle_events': [cycle_events[i] for i in cycle_index.overlapping(window_start, window_end).tolist()]
+    })
+
+def _queue_upload():
+    """
+    Saves the uploaded recording to a new session folder and queues its analysis.
+
+    Returns:
+        tuple: (job_id, None) if queued, or (None, (error message, HTTP status)).
+    """
+    if 'audio_file' not in request.files: return None, ("No file part", 400)
+    file = request.files['audio_file']
+    if file.filename == '': return None, ("No selected file", 400)
+    if not allowed_file(file.filename): return None, ("Only .wav and .mp3 files can be analyzed", 400)
+
+    filename = secure_filename(file.filename)
+    participant_name = secure_filename(request.form.get('participantName', 'unknown_participant'))
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    session_folder_name = f"{participant_name}_{os.path.splitext(filename)[0]}_{timestamp}"
+    session_folder_path = os.path.join(app.config['RESULTS_FOLDER'], session_folder_name)
+    os.makedirs(session_folder_path, exist_ok=True)
+    # The recording is stored once per content; the session folder links to it
+    audio_hash, blob_path = save_audio_stream(file.stream, file.filename.rsplit('.', 1)[1], app.config['UPLOAD_FOLDER'])
+    link_audio(blob_path, os.path.join(session_folder_path, filename))
+
+    job_id = analysis_queue.submit(session_folder_path, filename, participant_name, audio_hash)
+    if job_id is None:
+        shutil.rmtree(session_folder_path, ignore_errors=True)
+        return None, (QUEUE_FULL_ERROR, 503)
+    return job_id, None
+
+def _render_session(entry):
+    """Renders the results page of a stored session."""
+    with entry.lock:
+        analysis_data = dict(entry.analysis_data, db_id=entry.db_id)
+        view = _current_view(entry)
+        df_table = _cycle_frame(view)
+        analysis_data['cycle_events'] = view['cycle_events']
+        analysis_data['version'] = view['version']
+        analysis_data['cycle_table'] = _cycle_table(view)
+        respiration_analysis = score_statistics(view['statistics'])
+
+    initial_table_html = df_table.to_html(classes='table table-striped', index=False)
+    # The page loads the envelope as a float32 buffer and the signal view from /waveform
+    analysis_data['arrays'] = {'envelope': url_for('session_arrays', db_id=entry.db_id, name='envelope')}
+    return render_template('index.html', filename=entry.details['audio_filename'], analysis_data=analysis_data, initial_table=initial_table_html, respiration_analysis=respiration_analysis, default_config=CONFIG)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        if 'audio_file' not in request.files: return render_template('index.html', error="No file part")
-        file = request.files['audio_file']
-        if file.filename == '': return render_template('index.html', error="No selected file")
-            
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            participant_name = secure_filename(request.form.get('participantName', 'unknown_participant'))
-            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-            session_folder_name = f"{participant_name}_{os.path.splitext(filename)[0]}_{timestamp}"
-            session_folder_path = os.path.join(app.config['RESULTS_FOLDER'], session_folder_name)
-            os.makedirs(session_folder_path, exist_ok=True)
-
-            audio_filepath = os.path.join(session_folder_path, filename)
-            file.save(audio_filepath)
-            
-            analysis_data, error = perform_initial_analysis(audio_filepath)
-            if error: return render_template('index.html', error=error)
-            
-            # Store original events for comparison in export
-            analysis_data['original_events'] = analysis_data['events'].copy()
-            analysis_data['session_folder'] = session_folder_path
-            analysis_data['audio_filename'] = filename
-
-            json_path = os.path.join(session_folder_path, 'segmentation_data.json')
-            with open(json_path, 'w') as f: json.dump(analysis_data, f, indent=4)
-
-            df_table, cycle_events = build_respiratory_cycles_table(analysis_data['events'])
-            initial_table_html = df_table.to_html(classes='table table-striped', index=False)
-            respiration_analysis = analyze_respiration(df_table)
-            analysis_data['cycle_events'] = cycle_events
-
-            db_id = save_analysis_to_db(session_folder_path, analysis_data, df_table, respiration_analysis, participant_name)
-            analysis_data['db_id'] = db_id
-
-            with open(json_path, 'w') as f: json.dump(analysis_data, f, indent=4)
-
-            return render_template('index.html', filename=filename, analysis_data=analysis_data, initial_table=initial_table_html, respiration_analysis=respiration_analysis, default_config=CONFIG)
+        job_id, error = _queue_upload()
+        if error:
+            message, status = error
+            response = make_response(render_template('index.html', error=message), status)
+            if status == 503:
+                response.headers['Retry-After'] = str(QUEUE_RETRY_SECONDS)
+            return response
+        job = analysis_queue.status(job_id)
+        if job['status'] == 'done':
+            # A recording analyzed before: its session was created from the cached results
+            return redirect(url_for('analysis_page', db_id=job['db_id']))
+        # The page follows the job and opens the results when the analysis is done
+        return render_template('index.html', filename=None, job_id=job_id)
 
     return render_template('index.html', filename=None)
 
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queues the analysis of an uploaded recording and returns the job id at once."""
+    job_id, error = _queue_upload()
+    if error:
+        message, status = error
+        response = make_response(jsonify({'success': False, 'error': message}), status)
+        if status == 503:
+            response.headers['Retry-After'] = str(QUEUE_RETRY_SECONDS)
+        return response
+    return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Returns the status, stage and progress (percent) of an analysis job."""
+    job = analysis_queue.status(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+
+    response = {
+        'success': True,
+        'job_id': job_id,
+        'status': job['status'],
+        'stage': job['stage'],
+        'progress': job['progress'],
+        'db_id': job['db_id'],
+        'error': job['error']
+    }
+    if job['status'] == 'done':
+        response['result_url'] = url_for('analysis_page', db_id=job['db_id'])
+    return jsonify(response)
+
+@app.route('/analysis/<int:db_id>')
+def analysis_page(db_id):
+    """Shows the results page of a session."""
+    entry = session_cache.get(db_id)
+    if not entry:
+        return render_template('index.html', error="Analysis not found"), 404
+    return _render_session(entry)
+
 @app.route('/save_results', methods=['POST'])
 def save_results_endpoint():
     data = request.get_json()
@@ -115,19 +480,20 @@ def save_results_endpoint():
     if not db_id:
         return jsonify({'success': False, 'error': 'Database ID is required'}), 400
 
-    details = get_analysis_details(db_id)
-    if not details:
+    entry = session_cache.get(db_id)
+    if not entry:
         return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    details = entry.details
 
     session_folder_path = details['session_folder_path']
     participant_name = details.get('participant_name', 'participant')
-    json_path = os.path.join(session_folder_path, 'segmentation_data.json')
 
     try:
-        with open(json_path, 'r') as f:
-            analysis_data = json.load(f)
+        # The exports plot the signal and envelope, so the sidecar is loaded as well
+        with entry.lock:
+            analysis_data = dict(entry.analysis_data, **load_session_arrays(session_folder_path))
 
-        events = analysis_data.get('events', [])
+        events = EventStore.from_records(analysis_data.get('events', []))
         df_table, _ = build_respiratory_cycles_table(events)
         respiration_analysis = analyze_respiration(df_table)
 
@@ -163,97 +529,160 @@ def save_results_endpoint():
 def recalculate():
     data = request.get_json()
     db_id = data.get('db_id')
-    details = get_analysis_details(db_id)
-    session_folder, audio_filename = details['session_folder_path'], details['audio_filename']
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    session_folder, audio_filename = entry.session_folder, entry.details['audio_filename']
     audio_filepath = os.path.join(session_folder, audio_filename)
-    json_path = os.path.join(session_folder, 'segmentation_data.json')
-    
-    if os.path.exists(json_path): shutil.copy(json_path, json_path + '.bak')
 
     apnea_threshold_factor = float(data.get('apnea_threshold', 0.1))
-    analysis_data, error = perform_initial_analysis(audio_filepath, apnea_threshold_factor=apnea_threshold_factor)
+    # The envelope is read from the session's feature cache, so the audio is not decoded again
+    features_path = os.path.join(session_folder, FEATURES_FILENAME)
+    analysis_data, error = perform_initial_analysis(audio_filepath, apnea_threshold_factor=apnea_threshold_factor, features_path=features_path)
     if error: return jsonify({'error': f'Recalculation failed: {error}'}), 500
 
     # Store original events for comparison in export
     analysis_data['original_events'] = analysis_data['events'].copy()
-    analysis_data.update({'db_id': db_id, 'session_folder': session_folder, 'audio_filename': audio_filename, 'apnea_threshold_factor': apnea_threshold_factor})
-    with open(json_path, 'w') as f: json.dump(analysis_data, f, indent=4)
-    
-    return _get_updated_data_response(analysis_data, db_id)
+    analysis_data.update({'db_id': entry.db_id, 'session_folder': session_folder, 'audio_filename': audio_filename, 'apnea_threshold_factor': apnea_threshold_factor})
+
+    with entry.lock:
+        # The signal and envelope come from the unchanged feature cache and do not depend on the
+        # threshold, so the sidecar written with the session stays valid; it is only written if missing
+        if not os.path.exists(os.path.join(session_folder, SESSION_ARRAYS_FILENAME)):
+            save_session_arrays(session_folder, analysis_data)
+        previous, entry.analysis_data = entry.analysis_data, without_arrays(analysis_data)
+        session_cache.record(entry, document_operation('recalculate', previous, entry.analysis_data))
+        return _get_updated_data_response(entry)
+
+@app.route('/threshold_sweep', methods=['POST'])
+def threshold_sweep():
+    """
+    Evaluates many apnea threshold factors in one request without touching the session.
+    Accepts either a 'factors' list or a 'start'/'stop'/'step' range.
+    """
+    data = request.get_json()
+    db_id = data.get('db_id')
+    custom_config = data.get('config', {})
+
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    details = entry.details
+
+    try:
+        if 'factors' in data:
+            factors = [float(f) for f in data['factors']]
+        else:
+            start, stop, step = float(data['start']), float(data['stop']), float(data['step'])
+            if step <= 0:
+                raise ValueError('step must be positive')
+            factors = [round(start + i * step, 6) for i in range(int((stop - start) / step + 1e-9) + 1)]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Provide a list of factors or a start/stop/step range'}), 400
+
+    if not factors or len(factors) > MAX_SWEEP_FACTORS:
+        return jsonify({'success': False, 'error': f'Between 1 and {MAX_SWEEP_FACTORS} factors are allowed'}), 400
+
+    session_folder, audio_filename = details['session_folder_path'], details['audio_filename']
+    features_path = os.path.join(session_folder, FEATURES_FILENAME)
+    try:
+        features, amplitude_max = get_audio_features(os.path.join(session_folder, audio_filename), features_path)
+        results = sweep_apnea_thresholds(features['envelope'], amplitude_max, factors, custom_config=custom_config, hop_seconds=features['hop_seconds'])
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    return jsonify({'success': True, 'results': results})
 
 @app.route('/undo', methods=['POST'])
 def undo():
     data = request.get_json()
     db_id = data.get('db_id')
-    details = get_analysis_details(db_id)
-    session_folder = details['session_folder_path']
-    json_path = os.path.join(session_folder, 'segmentation_data.json')
-    backup_path = json_path + '.bak'
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+
+    with entry.lock:
+        if data.get('check'):
+            return jsonify({'undo_available': entry.history.can_undo, 'redo_available': entry.history.can_redo})
+
+        base = _client_view(entry, data.get('version'))
+        operation = session_cache.undo(entry)
+        if operation is None: return jsonify({'error': 'No state to undo'}), 404
+
+        return _get_updated_data_response(entry, base=base, patch=event_patch(operation, inverse=True), first_event=first_changed_event(operation))
+
+@app.route('/redo', methods=['POST'])
+def redo():
+    data = request.get_json()
+    db_id = data.get('db_id')
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
 
-    if data.get('check'):
-        return jsonify({'undo_available': os.path.exists(backup_path)})
+    with entry.lock:
+        base = _client_view(entry, data.get('version'))
+        operation = session_cache.redo(entry)
+        if operation is None: return jsonify({'error': 'No state to redo'}), 404
 
-    if not os.path.exists(backup_path): return jsonify({'error': 'No state to undo'}), 404
+        return _get_updated_data_response(entry, base=base, patch=event_patch(operation), first_event=first_changed_event(operation))
 
-    shutil.move(backup_path, json_path)
+@app.route('/session/<int:db_id>')
+def session_state(db_id):
+    """Returns the whole editable state of a session, for clients whose copy is out of date."""
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
 
-    with open(json_path, 'r') as f: analysis_data = json.load(f)
-    
-    return _get_updated_data_response(analysis_data, db_id)
+    with entry.lock:
+        view = _current_view(entry)
+        return jsonify({
+            'success': True,
+            'version': view['version'],
+            'analysis_data': dict(without_arrays(entry.analysis_data), cycle_events=view['cycle_events']),
+            'cycle_table': _cycle_table(view),
+            'respiration_analysis': score_statistics(view['statistics'])
+        })
 
 @app.route('/merge', methods=['POST'])
 def merge():
     data = request.get_json()
     db_id = data.get('db_id')
     segment_ids_to_merge = set(data.get('segment_ids', []))
-    details = get_analysis_details(db_id)
-    session_folder = details['session_folder_path']
-    json_path = os.path.join(session_folder, 'segmentation_data.json')
-
-    shutil.copy(json_path, json_path + '.bak')
-
-    with open(json_path, 'r') as f: analysis_data = json.load(f)
-    
-    events = analysis_data['events']
-    selected_events = sorted([e for e in events if e['id'] in segment_ids_to_merge], key=lambda x: x['start'])
-    if not selected_events: return jsonify({'error': 'Segments not found'}), 404
-
-    new_event_id = max(e['id'] for e in events) + 1
-    new_event = {
-        'id': new_event_id,
-        'start': selected_events[0]['start'],
-        'end': selected_events[-1]['end'],
-        'type': selected_events[0]['type']
-    }
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
 
-    analysis_data['events'] = [e for e in events if e['id'] not in segment_ids_to_merge] + [new_event]
-    
-    analysis_data['events'] = relabel_events(analysis_data['events'])
+    with entry.lock:
+        base = _client_view(entry, data.get('version'))
+        before = EventStore.from_records(entry.analysis_data['events'])
+        events = before.copy()
+        # The merged event spans the selection and takes the place of its first event
+        if events.merge(segment_ids_to_merge) is None: return jsonify({'error': 'Segments not found'}), 404
 
-    with open(json_path, 'w') as f: json.dump(analysis_data, f, indent=4)
+        relabel_events(events)
+        operation = _store_edit(entry, 'merge', before, events)
 
-    return _get_updated_data_response(analysis_data, db_id)
+        return _get_updated_data_response(entry, events, base, event_patch(operation), first_changed_event(operation))
 
 @app.route('/delete', methods=['POST'])
 def delete():
     data = request.get_json()
     db_id = data.get('db_id')
     segment_ids_to_delete = set(data.get('segment_ids', []))
-    details = get_analysis_details(db_id)
-    session_folder = details['session_folder_path']
-    json_path = os.path.join(session_folder, 'segmentation_data.json')
-
-    shutil.copy(json_path, json_path + '.bak')
-
-    with open(json_path, 'r') as f: analysis_data = json.load(f)
-
-    analysis_data['events'] = [e for e in analysis_data['events'] if e['id'] not in segment_ids_to_delete]
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
 
-    analysis_data['events'] = relabel_events(analysis_data['events'])
+    with entry.lock:
+        base = _client_view(entry, data.get('version'))
+        before = EventStore.from_records(entry.analysis_data['events'])
+        events = before.copy()
+        events.delete(segment_ids_to_delete)
 
-    with open(json_path, 'w') as f: json.dump(analysis_data, f, indent=4)
+        relabel_events(events)
+        operation = _store_edit(entry, 'delete', before, events)
 
-    return _get_updated_data_response(analysis_data, db_id)
+        return _get_updated_data_response(entry, events, base, event_patch(operation), first_changed_event(operation))
 
 @app.route('/split', methods=['POST'])
 def split():
@@ -265,60 +694,31 @@ def split():
     if not all([db_id, segment_id_to_split, isinstance(split_time, (int, float))]):
         return jsonify({'success': False, 'error': 'Invalid request data'}), 400
 
-    details = get_analysis_details(db_id)
-    if not details:
+    entry = session_cache.get(db_id)
+    if not entry:
         return jsonify({'success': False, 'error': 'Analysis not found'}), 404
 
-    session_folder = details['session_folder_path']
-    json_path = os.path.join(session_folder, 'segmentation_data.json')
-
-    shutil.copy(json_path, json_path + '.bak')
-
-    with open(json_path, 'r') as f:
-        analysis_data = json.load(f)
-
-    events = analysis_data['events']
-    
-    event_to_split_index = -1
-    for i, event in enumerate(events):
-        if event['id'] == segment_id_to_split:
-            event_to_split_index = i
-            break
-    
-    if event_to_split_index == -1:
-        return jsonify({'success': False, 'error': 'Segment not found'}), 404
-
-    event_to_split = events[event_to_split_index]
-
-    # Ensure the split time is valid and creates two non-zero-length segments
-    if not (event_to_split['start'] < split_time < event_to_split['end']):
-        return jsonify({'success': False, 'error': 'Split time must be within the segment bounds'}), 400
-
-    original_end = event_to_split['end']
-    original_type = event_to_split['type']
-    
-    # 1. Modify original event to be the first half
-    event_to_split['end'] = split_time
-
-    # 2. Create new event for the second half
-    new_event_id = max(e['id'] for e in events) + 1
-    new_event = {
-        'id': new_event_id,
-        'start': split_time,
-        'end': original_end,
-        'type': original_type  # Inherit type, relabel_events will adjust it
-    }
+    with entry.lock:
+        base = _client_view(entry, data.get('version'))
+        before = EventStore.from_records(entry.analysis_data['events'])
+        events = before.copy()
+
+        # The original event becomes the first half; the second half is inserted right after it
+        # and inherits its type until relabel_events adjusts it
+        try:
+            new_event_id = events.split(segment_id_to_split, split_time)
+        except ValueError as e:
+            # The split time must create two non-zero-length segments
+            return jsonify({'success': False, 'error': str(e)}), 400
 
-    # 3. Insert the new event right after the first half
-    analysis_data['events'].insert(event_to_split_index + 1, new_event)
-    
-    # 4. Relabel events to enforce the alternating inhalation/exhalation pattern
-    analysis_data['events'] = relabel_events(analysis_data['events'])
+        if new_event_id is None:
+            return jsonify({'success': False, 'error': 'Segment not found'}), 404
 
-    with open(json_path, 'w') as f:
-        json.dump(analysis_data, f, indent=4)
+        # Relabel events to enforce the alternating inhalation/exhalation pattern
+        relabel_events(events)
+        operation = _store_edit(entry, 'split', before, events)
 
-    return _get_updated_data_response(analysis_data, db_id)
+        return _get_updated_data_response(entry, events, base, event_patch(operation), first_changed_event(operation))
 
 @app.route('/recalculate_scores', methods=['POST'])
 def recalculate_scores():
@@ -326,24 +726,112 @@ def recalculate_scores():
     db_id = data.get('db_id')
     custom_config = data.get('config', {})
 
-    details = get_analysis_details(db_id)
-    if not details:
+    entry = session_cache.get(db_id)
+    if not entry:
         return jsonify({'success': False, 'error': 'Analysis not found'}), 404
 
-    session_folder = details['session_folder_path']
-    json_path = os.path.join(session_folder, 'segmentation_data.json')
+    with entry.lock:
+        # Only the scores change: they are computed from the statistics kept with the cycle table
+        view = _current_view(entry)
+        respiration_analysis = score_statistics(view['statistics'], custom_config=custom_config)
 
-    with open(json_path, 'r') as f:
-        analysis_data = json.load(f)
+        # Optionally, save the new scores to the DB (the session document itself is unchanged)
+        session_cache.mark_dirty(entry, lambda: _cycle_frame(view), respiration_analysis, document=False)
 
-    # We only need to recalculate scores, not the entire analysis
-    df_table, _ = build_respiratory_cycles_table(analysis_data['events'])
-    respiration_analysis = analyze_respiration(df_table, custom_config=custom_config)
+    return jsonify({'success': True, 'respiration_analysis': respiration_analysis})
 
-    # Optionally, save the new scores to the DB
-    update_analysis_in_db(db_id, analysis_data, df_table, respiration_analysis)
+@app.route('/score_variants', methods=['POST'])
+def score_variants():
+    """
+    Scores a session under many scoring configurations at once ('configs', a list of
+    custom configs), without saving anything; used to explore weights and targets.
+    """
+    data = request.get_json()
+    db_id = data.get('db_id')
+    custom_configs = data.get('configs')
 
-    return jsonify({'success': True, 'respiration_analysis': respiration_analysis})
+    if not isinstance(custom_configs, list) or not all(isinstance(config, dict) for config in custom_configs):
+        return jsonify({'success': False, 'error': 'configs must be a list of configurations'}), 400
+    if not custom_configs or len(custom_configs) > MAX_SCORE_VARIANTS:
+        return jsonify({'success': False, 'error': f'Between 1 and {MAX_SCORE_VARIANTS} configurations are allowed'}), 400
+
+    entry = session_cache.get(db_id)
+    if not entry:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+
+    with entry.lock:
+        statistics = _current_view(entry)['statistics']
+    try:
+        results = score_config_variants(statistics, custom_configs)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'Invalid configuration: {e}'}), 400
+    return jsonify({'success': True, 'results': results})
+
+@app.route('/participants')
+def participants():
+    """Lists the participants with saved sessions, with their session counts and dates."""
+    participant_list = get_participants()
+    if participant_list is None:
+        return jsonify({'success': False, 'error': 'Could not read the participants'}), 500
+    return jsonify({'success': True, 'participants': participant_list})
+
+@app.route('/participants/<participant_name>/trends')
+def participant_trends(participant_name):
+    """
+    Returns a participant's progress over their sessions, from the summary tables: the score
+    time series, the distribution of cycle durations and the I:E ratio progress.
+
+    The optional `since` and `until` query parameters (ISO dates) limit the sessions.
+    """
+    try:
+        since, until = (datetime.fromisoformat(request.args[name]) if request.args.get(name) else None
+                        for name in ('since', 'until'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'since and until must be ISO dates'}), 400
+
+    trends = get_participant_trends(participant_name, since, until)
+    if trends is None:
+        return jsonify({'success': False, 'error': 'Could not read the trends'}), 500
+    sessions = trends['sessions']
+    if not sessions and since is None and until is None:
+        return jsonify({'success': False, 'error': 'Participant not found'}), 404
+
+    ie_ratios = [session['ie_ratio'] for session in sessions if session['ie_ratio'] is not None]
+    return jsonify({
+        'success': True,
+        'participant': participant_name,
+        'sessions': [{
+            'db_id': session['session_id'],
+            'timestamp': session['analysis_timestamp'],
+            'num_cycles': session['num_cycles'],
+            'scores': {pillar: session[column] for column, pillar in SCORE_TABLE_COLUMNS.items()},
+            'mean_durations': {column: session[column] for column in CYCLE_TABLE_COLUMNS},
+            'total_std': session['total_std'],
+            'ie_ratio': session['ie_ratio'],
+            'url': url_for('analysis_page', db_id=session['session_id'])
+        } for session in sessions],
+        'cycle_durations': {
+            'bin_seconds': CYCLE_BIN_SECONDS,
+            'bins': [{'start': index * CYCLE_BIN_SECONDS, 'end': (index + 1) * CYCLE_BIN_SECONDS, 'cycles': cycles}
+                     for index, cycles in trends['cycle_durations']]
+        },
+        'ie_ratio': {
+            'target': CONFIG['TARGET_IE_RATIO'],
+            'first': ie_ratios[0] if ie_ratios else None,
+            'last': ie_ratios[-1] if ie_ratios else None,
+            'change': ie_ratios[-1] - ie_ratios[0] if ie_ratios else None
+        }
+    })
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Returns the session cache's hit/miss/eviction/flush counters and memory use."""
+    return jsonify({'success': True, **session_cache.stats()})
+
+@app.route('/job_stats')
+def job_stats():
+    """Returns the number of analysis jobs accepted and the queue limits."""
+    return jsonify({'success': True, **analysis_queue.stats()})
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
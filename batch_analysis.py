@@ -0,0 +1,206 @@
+"""
+Analyzes folders of recordings from the command line, in parallel.
+
+Every recording gets a session folder and a database row, as if it had been uploaded
+through the web form: the audio goes to the content-addressed store and recordings
+analyzed before reuse the cached results (see content_store.py). The analyses run in a pool of worker processes (one per core by
+default) and the rows are inserted in transactions of BATCH_SIZE sessions.
+
+A recording's session folder is named after its path, so running the command again
+skips the recordings already saved and resumes an interrupted run. Run it from the app
+folder, so the sessions are stored where the app looks for them.
+
+Usage:
+    python batch_analysis.py recordings/ "archive/**/*.mp3" [--participant NAME]
+        [--workers N] [--apnea-threshold 0.1] [--batch-size 50] [--results results]
+"""
+import argparse
+import glob
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from werkzeug.utils import secure_filename
+
+from analisis_audio import APNEA_THRESHOLD_FACTOR
+from analysis_jobs import analyze_session
+from content_store import save_audio_file, link_audio
+from database import create_tables, save_analyses_to_db, get_session_folders
+from session_store import save_session
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3')
+BATCH_SIZE = 50  # Sessions inserted per database transaction
+
+
+def find_recordings(patterns):
+    """
+    Lists the recordings matched by directories (searched recursively) and glob patterns.
+
+    Returns:
+        list: Sorted, de-duplicated absolute paths of the .wav and .mp3 files found.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths.update(os.path.join(root, name) for name in files)
+        else:
+            paths.update(glob.glob(pattern, recursive=True))
+    return sorted(os.path.abspath(path) for path in paths
+                  if path.lower().endswith(AUDIO_EXTENSIONS) and os.path.isfile(path))
+
+
+def session_folder_for(recording_path, participant_name, results_folder):
+    """
+    Returns the session folder of a recording.
+
+    The name ends with a digest of the recording's absolute path instead of the upload
+    timestamp, so the same recording always maps to the same folder.
+    """
+    stem = secure_filename(os.path.splitext(os.path.basename(recording_path))[0])
+    digest = hashlib.sha1(recording_path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(results_folder, f"{participant_name}_{stem}_{digest}")
+
+
+def analyze_recording(recording_path, session_folder_path, apnea_threshold_factor):
+    """
+    Stores a recording, links it into its session folder and analyzes it, in a worker process.
+
+    Returns:
+        tuple: The `analyze_session` result, with the recording's 'audio_hash' added, and error message.
+    """
+    try:
+        os.makedirs(session_folder_path, exist_ok=True)
+        filename = secure_filename(os.path.basename(recording_path))
+        audio_hash, blob_path = save_audio_file(recording_path)
+        link_audio(blob_path, os.path.join(session_folder_path, filename))
+        session, error = analyze_session(session_folder_path, filename, apnea_threshold_factor, audio_hash=audio_hash)
+        if session:
+            session['audio_hash'] = audio_hash
+        return session, error
+    except Exception as e:
+        return None, f"An error occurred while processing the file: {e}"
+
+
+def save_batch(batch):
+    """
+    Inserts the rows of finished analyses in one transaction and adds their db_id to the session documents.
+
+    Args:
+        batch (list): (session_folder_path, analysis_data, df_table, respiration_analysis, participant_name, audio_hash) tuples.
+
+    Returns:
+        bool: True if the batch was saved.
+    """
+    if not batch:
+        return True
+    db_ids = save_analyses_to_db(batch)
+    if db_ids is None:
+        return False
+    for (session_folder_path, analysis_data, *_), db_id in zip(batch, db_ids):
+        analysis_data['db_id'] = db_id
+        save_session(session_folder_path, analysis_data)
+    return True
+
+
+def run_batch(recordings, participant_name=None, workers=None, apnea_threshold_factor=APNEA_THRESHOLD_FACTOR,
+              batch_size=BATCH_SIZE, results_folder='results'):
+    """
+    Analyzes recordings in a process pool, skipping those whose session is already saved.
+
+    Args:
+        recordings (list): Absolute paths of the recordings.
+        participant_name (str, optional): Participant of every session; by default the name
+            of the folder holding each recording.
+        workers (int, optional): Worker processes; by default one per core.
+        apnea_threshold_factor (float): The factor to determine the apnea detection threshold.
+        batch_size (int): Sessions inserted per database transaction.
+        results_folder (str): Folder where the session folders are created.
+
+    Returns:
+        dict: Counts of recordings found, skipped, analyzed and failed, the seconds of audio
+              analyzed and the elapsed time.
+    """
+    saved_folders = get_session_folders()
+    if saved_folders is None:
+        raise RuntimeError("Could not read the saved sessions from the database.")
+
+    pending = []
+    for recording_path in recordings:
+        participant = secure_filename(participant_name or os.path.basename(os.path.dirname(recording_path))) or 'unknown_participant'
+        session_folder_path = session_folder_for(recording_path, participant, results_folder)
+        if session_folder_path not in saved_folders:
+            pending.append((recording_path, session_folder_path, participant))
+
+    stats = {'found': len(recordings), 'skipped': len(recordings) - len(pending), 'analyzed': 0,
+             'failed': 0, 'audio_seconds': 0.0, 'elapsed': 0.0}
+    start_time = time.perf_counter()
+    batch = []
+    executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+    try:
+        futures = {executor.submit(analyze_recording, recording_path, session_folder_path, apnea_threshold_factor): (recording_path, session_folder_path, participant)
+                   for recording_path, session_folder_path, participant in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            recording_path, session_folder_path, participant = futures[future]
+            session, error = future.result()
+            if error:
+                stats['failed'] += 1
+                print(f"[{done}/{len(pending)}] FAILED {recording_path}: {error}")
+                continue
+            analysis_data = session['analysis_data']
+            batch.append((session_folder_path, analysis_data, session['df_table'], session['respiration_analysis'], participant, session['audio_hash']))
+            stats['analyzed'] += 1
+            stats['audio_seconds'] += analysis_data['duration']
+            print(f"[{done}/{len(pending)}] {recording_path} ({analysis_data['duration']:.0f} s)")
+            if len(batch) >= batch_size:
+                if not save_batch(batch):
+                    raise RuntimeError("Could not save the analyses to the database.")
+                batch = []
+    finally:
+        # On an interruption the analyses already finished are still saved
+        executor.shutdown(wait=False, cancel_futures=True)
+        if not save_batch(batch):
+            print(f"{len(batch)} finished analyses could not be saved; they will be analyzed again on the next run.")
+        stats['elapsed'] = time.perf_counter() - start_time
+    return stats
+
+
+def print_stats(stats):
+    """Prints the counts and throughput of a batch run."""
+    elapsed = max(stats['elapsed'], 1e-9)
+    audio_hours = stats['audio_seconds'] / 3600
+    print(f"\n{stats['found']} recording(s) found, {stats['skipped']} already analyzed, "
+          f"{stats['analyzed']} analyzed, {stats['failed']} failed in {stats['elapsed']:.1f} s")
+    if stats['analyzed']:
+        print(f"Throughput: {stats['analyzed'] / elapsed:.2f} files/s, {audio_hours / elapsed:.4f} audio-hours/s "
+              f"({stats['audio_seconds'] / elapsed:.0f}x real time, {audio_hours:.2f} audio-hours in total)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze folders of breathing recordings in parallel.")
+    parser.add_argument('inputs', nargs='+', help="Directories (searched recursively) or glob patterns of .wav/.mp3 files")
+    parser.add_argument('--participant', help="Participant name of every session (default: the folder of each recording)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per core)")
+    parser.add_argument('--apnea-threshold', type=float, default=APNEA_THRESHOLD_FACTOR, help="Apnea threshold factor")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Sessions inserted per database transaction")
+    parser.add_argument('--results', default='results', help="Folder where the session folders are created")
+    args = parser.parse_args(argv)
+
+    recordings = find_recordings(args.inputs)
+    if not recordings:
+        print("No .wav or .mp3 recordings found.")
+        return 1
+    create_tables()
+    try:
+        stats = run_batch(recordings, args.participant, args.workers, args.apnea_threshold, max(1, args.batch_size), args.results)
+    except KeyboardInterrupt:
+        print("\nInterrupted; run the same command again to resume.")
+        return 130
+    print_stats(stats)
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
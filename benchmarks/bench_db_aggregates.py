@@ -0,0 +1,108 @@
+"""
+Benchmarks a cross-session question, "average exhalation of participant X this month",
+answered from the JSON columns the sessions used to be stored in (loading and parsing
+every session in Python) and from the indexed cycles table of database.py. Also times
+the migration of the JSON columns into the tables.
+
+Usage:
+    python benchmarks/bench_db_aggregates.py [sessions]
+"""
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timedelta
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import database  # noqa: E402
+from bench_db_concurrency import synthetic_session  # noqa: E402
+
+SESSIONS = 2000
+PARTICIPANTS = 20
+DAYS = 180
+REPEATS = 5
+
+
+def create_legacy_database(db_file, n_sessions):
+    """Writes sessions with the JSON columns and no results tables, as older versions of the app did."""
+    analysis_data, df_table, respiration_analysis = synthetic_session('bench')
+    cycles_json, analysis_json, events_json = (df_table.to_json(orient='records'), json.dumps(respiration_analysis),
+                                               json.dumps(analysis_data['events']))
+    now = datetime.now()
+    rng = np.random.default_rng(0)
+    conn = sqlite3.connect(db_file)
+    conn.execute('''CREATE TABLE analysis_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL,
+                    participant_name TEXT, analysis_timestamp DATETIME NOT NULL, total_duration_seconds REAL NOT NULL,
+                    sampling_rate INTEGER NOT NULL, session_folder TEXT NOT NULL, respiratory_cycles_json TEXT,
+                    respiration_analysis_json TEXT, segmentation_events_json TEXT)''')
+    conn.executemany('''INSERT INTO analysis_sessions (filename, participant_name, analysis_timestamp, total_duration_seconds,
+                        sampling_rate, session_folder, respiratory_cycles_json, respiration_analysis_json, segmentation_events_json)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     [('bench.wav', f'participant_{i % PARTICIPANTS}', now - timedelta(days=float(rng.uniform(0, DAYS))),
+                       analysis_data['duration'], 44100, f'session_{i}', cycles_json, analysis_json, events_json)
+                      for i in range(n_sessions)])
+    conn.commit()
+    conn.close()
+
+
+def legacy_average_exhalation(db_file, participant_name, since):
+    """Loads every session and averages the exhalations of the matching ones in Python."""
+    conn = sqlite3.connect(db_file)
+    try:
+        exhalations = []
+        for participant, timestamp, cycles_json in conn.execute(
+                'SELECT participant_name, analysis_timestamp, respiratory_cycles_json FROM analysis_sessions'):
+            if participant == participant_name and datetime.fromisoformat(timestamp) >= since:
+                exhalations.extend(cycle['Exhalation (s)'] for cycle in json.loads(cycles_json) if cycle['Cycle'] != 'avg')
+        return float(np.mean(exhalations)) if exhalations else None
+    finally:
+        conn.close()
+
+
+def best_of(func):
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else SESSIONS
+    since = datetime.now() - timedelta(days=30)
+    with tempfile.TemporaryDirectory() as workdir:
+        legacy_file = os.path.join(workdir, 'legacy.db')
+        create_legacy_database(legacy_file, n_sessions)
+        legacy_time, legacy_result = best_of(lambda: legacy_average_exhalation(legacy_file, 'participant_3', since))
+
+        database.DATABASE_FILE = os.path.join(workdir, 'migrated.db')
+        create_legacy_database(database.DATABASE_FILE, n_sessions)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            database.create_tables()
+        migration_time = time.perf_counter() - start
+        sql_time, averages = best_of(lambda: database.get_cycle_averages('participant_3', since=since))
+        database._pool.close_all()
+
+    if legacy_result is not None and not np.isclose(legacy_result, averages['exhalation']):
+        raise AssertionError(f"SQL average {averages['exhalation']} differs from the JSON average {legacy_result}")
+    print(f"{n_sessions} sessions, {PARTICIPANTS} participants; {averages['sessions']} sessions "
+          f"({averages['cycles']} cycles) of participant_3 in the last 30 days")
+    print(f"{'query':<30} {'time (ms)':>10}")
+    print(f"{'JSON columns, parsed':<30} {legacy_time * 1000:>10.2f}")
+    print(f"{'cycles table, indexed SQL':<30} {sql_time * 1000:>10.2f}")
+    print(f"Migration of the JSON columns: {migration_time:.2f} s")
+
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+    main()
@@ -0,0 +1,217 @@
+"""
+Benchmarks SQLite access under parallel load.
+
+1. The pooled WAL access layer of database.py against the original layer, which opened
+   a connection (in rollback-journal mode) for every statement: each thread repeatedly
+   reads a session's details and writes its cycles, scores and events, as a cache miss
+   followed by a flush does.
+2. The edit endpoints (/split followed by /undo) called from parallel threads on their
+   own sessions, with a session cache too small to keep them, so every request loads its
+   session from SQLite and every edit is flushed back.
+
+Usage:
+    python benchmarks/bench_db_concurrency.py [threads ...]
+"""
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import database  # noqa: E402
+from analisis_audio import build_respiratory_cycles_table, analyze_respiration  # noqa: E402
+from session_store import save_session  # noqa: E402
+
+THREAD_COUNTS = [1, 4, 16]
+SESSIONS = 32
+EVENTS_PER_SESSION = 400
+OPS_PER_THREAD = 100
+REQUESTS_PER_THREAD = 40
+PHASES = ['inhalation', 'apnea', 'exhalation', 'apnea']
+
+
+def synthetic_events(n_events=EVENTS_PER_SESSION):
+    return [{'id': i, 'start': 5 * i, 'end': 5 * (i + 1), 'type': PHASES[i % 4]} for i in range(n_events)]
+
+
+def synthetic_session(session_folder):
+    events = synthetic_events()
+    df_table, cycle_events = build_respiratory_cycles_table(events)
+    analysis_data = {'duration': 5 * len(events), 'sampling_rate': 44100, 'hop_seconds': 1, 'filename': 'bench.wav',
+                     'audio_filename': 'bench.wav', 'session_folder': session_folder, 'events': events,
+                     'original_events': list(events), 'cycle_events': cycle_events}
+    return analysis_data, df_table, analyze_respiration(df_table)
+
+
+# --- The original access layer, kept here as the reference implementation ---
+
+def legacy_create(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.execute('''CREATE TABLE analysis_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL,
+                    session_folder TEXT NOT NULL, respiratory_cycles_json TEXT, respiration_analysis_json TEXT,
+                    segmentation_events_json TEXT)''')
+    conn.commit()
+    conn.close()
+
+
+def legacy_insert(db_file, session_folder):
+    conn = sqlite3.connect(db_file)
+    cursor = conn.execute('INSERT INTO analysis_sessions (filename, session_folder) VALUES (?, ?)', ('bench.wav', session_folder))
+    conn.commit()
+    conn.close()
+    return cursor.lastrowid
+
+
+def legacy_get_analysis_details(db_file, db_id):
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute('SELECT session_folder, filename FROM analysis_sessions WHERE id = ?', (db_id,)).fetchone()
+        return {'session_folder_path': row['session_folder'], 'audio_filename': row['filename']} if row else None
+    finally:
+        conn.close()
+
+
+def legacy_update_analysis_in_db(db_file, db_id, analysis_data, df_table, respiration_analysis):
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute('''UPDATE analysis_sessions SET respiratory_cycles_json = ?, respiration_analysis_json = ?,
+                        segmentation_events_json = ? WHERE id = ?''',
+                     (df_table.to_json(orient='records'), json.dumps(respiration_analysis),
+                      json.dumps(analysis_data.get('events')), db_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# --- Load generation ---
+
+def run_threads(n_threads, work):
+    """Runs work(thread_index) on n_threads threads; returns the elapsed time, latencies and errors."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(n_threads + 1)
+
+    def target(index):
+        barrier.wait()
+        local_latencies, local_errors = work(index)
+        with lock:
+            latencies.extend(local_latencies)
+            errors.extend(local_errors)
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, np.array(latencies), errors
+
+
+def db_workload(get_details, update, db_ids, session):
+    analysis_data, df_table, respiration_analysis = session
+
+    def work(index):
+        rng = np.random.default_rng(index)
+        latencies, errors = [], []
+        for _ in range(OPS_PER_THREAD):
+            db_id = int(db_ids[rng.integers(len(db_ids))])
+            start = time.perf_counter()
+            try:
+                get_details(db_id)
+                update(db_id, analysis_data, df_table, respiration_analysis)
+            except sqlite3.Error as e:
+                errors.append(str(e))
+            latencies.append(time.perf_counter() - start)
+        return latencies, errors
+    return work
+
+
+def report(label, n_threads, n_ops, elapsed, latencies, errors):
+    p50, p99 = (np.percentile(latencies, [50, 99]) * 1000) if len(latencies) else (0, 0)
+    print(f"{label:<10} {n_threads:>7} {n_ops / elapsed:>10.0f} {p50:>9.2f} {p99:>9.2f} {len(errors):>7}")
+
+
+def bench_access_layer(workdir, thread_counts):
+    print("\nDatabase access layer (one op = read details + write cycles/scores/events)")
+    print(f"{'layer':<10} {'threads':>7} {'ops/s':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} {'errors':>7}")
+    session = synthetic_session('bench')
+    legacy_file = os.path.join(workdir, 'legacy.db')
+    legacy_create(legacy_file)
+    legacy_ids = [legacy_insert(legacy_file, f'session_{i}') for i in range(SESSIONS)]
+    database.DATABASE_FILE = os.path.join(workdir, 'pooled.db')
+    database.create_tables()
+    pooled_ids = [database.save_analysis_to_db(f'session_{i}', *session) for i in range(SESSIONS)]
+
+    for n_threads in thread_counts:
+        work = db_workload(lambda db_id: legacy_get_analysis_details(legacy_file, db_id),
+                           lambda *args: legacy_update_analysis_in_db(legacy_file, *args), legacy_ids, session)
+        report('legacy', n_threads, n_threads * OPS_PER_THREAD, *run_threads(n_threads, work))
+        work = db_workload(database.get_analysis_details, database.update_analysis_in_db, pooled_ids, session)
+        report('pooled', n_threads, n_threads * OPS_PER_THREAD, *run_threads(n_threads, work))
+
+
+def bench_edit_endpoints(workdir, thread_counts):
+    print("\nEdit endpoints (/split + /undo per op, every request loads its session from SQLite)")
+    print(f"{'layer':<10} {'threads':>7} {'ops/s':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} {'errors':>7}")
+    os.chdir(workdir)
+    database.DATABASE_FILE = os.path.join(workdir, 'endpoints.db')
+    import app as appmod
+    from session_cache import SessionCache
+
+    db_ids = []
+    for i in range(max(thread_counts)):
+        session_folder = os.path.join('results', f'bench_{i}')
+        os.makedirs(session_folder, exist_ok=True)
+        analysis_data, df_table, respiration_analysis = synthetic_session(session_folder)
+        save_session(session_folder, analysis_data)
+        db_ids.append(database.save_analysis_to_db(session_folder, analysis_data, df_table, respiration_analysis))
+
+    for n_threads in thread_counts:
+        # A budget of one byte keeps only the most recently used session in memory
+        appmod.session_cache = SessionCache(max_bytes=1, flush_seconds=0.01)
+
+        def work(index):
+            client = appmod.app.test_client()
+            latencies, errors = [], []
+            for _ in range(REQUESTS_PER_THREAD):
+                start = time.perf_counter()
+                for path, payload in (('/split', {'db_id': db_ids[index], 'segment_id': 1, 'split_time': 7}),
+                                      ('/undo', {'db_id': db_ids[index]})):
+                    response = client.post(path, json=payload)
+                    if response.status_code != 200:
+                        errors.append(f"{path}: {response.status_code}")
+                latencies.append(time.perf_counter() - start)
+            return latencies, errors
+
+        report('pooled', n_threads, n_threads * REQUESTS_PER_THREAD, *run_threads(n_threads, work))
+        appmod.session_cache.close()
+
+
+def main():
+    thread_counts = [int(n) for n in sys.argv[1:]] or THREAD_COUNTS
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()) as log:
+        try:
+            bench_access_layer(workdir, thread_counts)
+            bench_edit_endpoints(workdir, thread_counts)
+        finally:
+            os.chdir(ROOT)
+            # Only the result tables are shown; the database layer logs every write
+            results = [line for line in log.getvalue().splitlines()
+                       if not line.startswith(('Successfully', 'Database tables'))]
+            sys.__stdout__.write('\n'.join(results) + '\n')
+
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmarks event edits (merge, split, delete + relabel) on the EventStore against the
+original list-of-dicts implementation used by the edit endpoints.
+
+Usage:
+    python benchmarks/bench_event_store.py [n_events ...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from event_store import EventStore  # noqa: E402
+
+EVENT_COUNTS = [1_000, 10_000, 100_000]
+PHASE_CYCLE = ['inhalation', 'apnea', 'exhalation', 'apnea']
+
+
+def legacy_relabel(events):
+    events.sort(key=lambda x: x['start'])
+    for i, event in enumerate(events):
+        event['type'] = PHASE_CYCLE[i % 4]
+    return events
+
+
+def legacy_merge(events, ids):
+    selected = sorted([e for e in events if e['id'] in ids], key=lambda x: x['start'])
+    new_event = {'id': max(e['id'] for e in events) + 1, 'start': selected[0]['start'],
+                 'end': selected[-1]['end'], 'type': selected[0]['type']}
+    return legacy_relabel([e for e in events if e['id'] not in ids] + [new_event])
+
+
+def legacy_split(events, event_id, split_time):
+    index = next(i for i, e in enumerate(events) if e['id'] == event_id)
+    event = events[index]
+    original_end, event['end'] = event['end'], split_time
+    events.insert(index + 1, {'id': max(e['id'] for e in events) + 1, 'start': split_time,
+                              'end': original_end, 'type': event['type']})
+    return legacy_relabel(events)
+
+
+def legacy_delete(events, ids):
+    return legacy_relabel([e for e in events if e['id'] not in ids])
+
+
+def synthetic_events(n_events, seed=0):
+    rng = np.random.default_rng(seed)
+    bounds = np.concatenate([[0], np.cumsum(rng.integers(1, 8, n_events))])
+    return [{'id': i, 'start': int(bounds[i]), 'end': int(bounds[i + 1]), 'type': PHASE_CYCLE[i % 4]}
+            for i in range(n_events)]
+
+
+def edit_script(events, rng):
+    """A fixed sequence of (operation, arguments) picked from the middle of the recording."""
+    middle = events[len(events) // 2]
+    return [
+        ('merge', ({middle['id'], events[len(events) // 2 + 1]['id']},)),
+        ('split', (events[len(events) // 3]['id'], events[len(events) // 3]['start'] + 0.5)),
+        ('delete', ({events[int(rng.integers(len(events)))]['id']},)),
+    ]
+
+
+def run_legacy(events, script):
+    for operation, args in script:
+        events = {'merge': legacy_merge, 'split': legacy_split, 'delete': legacy_delete}[operation](events, *args)
+    return events
+
+
+def run_store(store, script):
+    for operation, args in script:
+        getattr(store, operation)(*args)
+        store.relabel()
+    return store
+
+
+def main():
+    event_counts = [int(n) for n in sys.argv[1:]] or EVENT_COUNTS
+    print(f"{'events':>8} {'legacy (s)':>11} {'store (s)':>10} {'speedup':>8}")
+    for n_events in event_counts:
+        events = synthetic_events(n_events)
+        script = edit_script(events, np.random.default_rng(1))
+        store = EventStore.from_records(events)
+
+        start = time.perf_counter()
+        legacy_events = run_legacy([dict(e) for e in events], script)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_store(store, script)
+        store_time = time.perf_counter() - start
+
+        if store.to_records() != legacy_events:
+            raise AssertionError(f"EventStore edits differ from the legacy implementation at {n_events} events")
+        print(f"{n_events:>8} {legacy_time:>11.4f} {store_time:>10.4f} {legacy_time / store_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
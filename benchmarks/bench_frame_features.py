@@ -0,0 +1,53 @@
+"""
+Benchmarks the frame features and waveform bins of one recording reduced by 1 to N threads,
+checking that every thread count gives results identical to the serial pass.
+
+Usage:
+    python benchmarks/bench_frame_features.py [minutes] [workers ...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from analisis_audio import calculate_frame_features, calculate_minmax_bins  # noqa: E402
+
+SAMPLING_RATE = 44100
+MINUTES = 60
+
+
+def best_of(func, repeats=3):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def reduce_recording(y, workers):
+    return calculate_frame_features(y, SAMPLING_RATE, workers=workers) + calculate_minmax_bins(y, workers=workers)
+
+
+def main():
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else MINUTES
+    worker_counts = [int(n) for n in sys.argv[2:]] or sorted({1, 2, 4, os.cpu_count() or 1})
+    y = (np.random.default_rng(0).standard_normal(int(minutes * 60 * SAMPLING_RATE)) * 0.3).astype(np.float32)
+
+    print(f"{minutes:g} min at {SAMPLING_RATE} Hz ({len(y):,} samples), {os.cpu_count()} cores")
+    print(f"{'workers':>8} {'time (s)':>9} {'speedup':>8}")
+    serial_time, serial = best_of(lambda: reduce_recording(y, 1))
+    print(f"{1:>8} {serial_time:>9.3f} {1:>7.1f}x")
+    for workers in worker_counts:
+        if workers == 1:
+            continue
+        parallel_time, parallel = best_of(lambda: reduce_recording(y, workers))
+        if not all(np.array_equal(a, b) for a, b in zip(serial, parallel)):
+            raise AssertionError(f"Results with {workers} workers differ from the serial pass")
+        print(f"{workers:>8} {parallel_time:>9.3f} {serial_time / parallel_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
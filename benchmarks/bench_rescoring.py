@@ -0,0 +1,101 @@
+"""
+Benchmarks rescoring a whole database: one `analyze_respiration` DataFrame per session
+against the batched, vectorized pass of rescore_sessions.py, checking that both give
+the same scores.
+
+Usage:
+    python benchmarks/bench_rescoring.py [sessions] [cycles per session]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import database  # noqa: E402
+from analisis_audio import analyze_respiration, build_respiratory_cycles_table, CYCLE_PHASE_COLUMNS  # noqa: E402
+from rescore_sessions import run_rescoring, rescore_batch, scoring_config  # noqa: E402
+
+SESSIONS = 5000
+CYCLES = 100
+INSERT_BATCH = 500
+PHASES = ['inhalation', 'apnea', 'exhalation', 'apnea']
+TUNED_CONFIG = {'TARGET_CYCLE_DURATION': 16.0, 'TARGET_IE_RATIO': 2}
+
+
+def synthetic_events(rng, n_cycles):
+    durations = rng.uniform([3, 0.5, 5, 0.5], [6, 3, 12, 4], size=(n_cycles, 4)).round(2).ravel()
+    ends = np.cumsum(durations).round(2)
+    starts = np.concatenate([[0], ends[:-1]])
+    return [{'id': i, 'start': float(s), 'end': float(e), 'type': PHASES[i % 4]}
+            for i, (s, e) in enumerate(zip(starts, ends))]
+
+
+def fill_database(n_sessions, n_cycles):
+    rng = np.random.default_rng(0)
+    for first in range(0, n_sessions, INSERT_BATCH):
+        batch = []
+        for i in range(first, min(first + INSERT_BATCH, n_sessions)):
+            events = synthetic_events(rng, n_cycles)
+            df_table, _ = build_respiratory_cycles_table(events)
+            analysis_data = {'audio_filename': 'bench.wav', 'duration': events[-1]['end'], 'sampling_rate': 44100, 'events': events}
+            batch.append((f'session_{i}', analysis_data, df_table, analyze_respiration(df_table), f'participant_{i % 20}'))
+        database.save_analyses_to_db(batch)
+
+
+def rescore_one_by_one(custom_config):
+    """Rescores every session with its own DataFrame, as /recalculate_scores does for one session."""
+    analyses = []
+    last_session_id = 0
+    while True:
+        session_ids, cycle_rows = database.get_cycles_batch(last_session_id, 500)
+        if not session_ids:
+            return analyses
+        rows = pd.DataFrame(cycle_rows, columns=['session_id'] + CYCLE_PHASE_COLUMNS + ['Total Cycle (s)'])
+        for db_id, cycles in rows.groupby('session_id', sort=False):
+            df_table = cycles.drop(columns='session_id')
+            df_table.insert(0, 'Cycle', np.arange(1, len(df_table) + 1))
+            df_table = pd.concat([df_table, pd.DataFrame([dict(df_table.drop(columns='Cycle').mean().round(2), Cycle='avg')])],
+                                 ignore_index=True)
+            analyses.append((db_id, analyze_respiration(df_table, custom_config)))
+        last_session_id = session_ids[-1]
+
+
+def main():
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else SESSIONS
+    n_cycles = int(sys.argv[2]) if len(sys.argv) > 2 else CYCLES
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        database.DATABASE_FILE = os.path.join(workdir, 'rescoring.db')
+        database.create_tables()
+        fill_database(n_sessions, n_cycles)
+        final_config = scoring_config(TUNED_CONFIG)
+
+        start = time.perf_counter()
+        expected = rescore_one_by_one(final_config)
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stats = run_rescoring(TUNED_CONFIG)
+        batch_time = time.perf_counter() - start
+
+        session_ids, cycle_rows = database.get_cycles_batch(0, n_sessions)
+        database._pool.close_all()
+
+    if rescore_batch(session_ids, cycle_rows, final_config) != expected:
+        raise AssertionError("The batched scores differ from analyze_respiration")
+    print(f"{stats['sessions']} sessions, {stats['cycles']} cycles")
+    print(f"{'method':<38} {'time (s)':>9} {'sessions/s':>11}")
+    print(f"{'analyze_respiration per session':<38} {loop_time:>9.2f} {n_sessions / loop_time:>11.0f}")
+    print(f"{'rescore_sessions (batched, with writes)':<38} {batch_time:>9.2f} {n_sessions / batch_time:>11.0f}")
+
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmarks session scoring: the pandas pillar functions on the cycles DataFrame against
+scoring from the session's sufficient statistics, one configuration at a time and many
+at once, and updating the statistics after an edit against summing them again.
+
+Usage:
+    python benchmarks/bench_scoring.py [n_cycles ...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from analisis_audio import (calculate_depth_score, calculate_stability_score, calculate_balance_score,  # noqa: E402
+                            cycle_statistics, update_cycle_statistics, score_statistics, score_config_variants,
+                            CONFIG, STATISTICS_COLUMNS)
+
+CYCLE_COUNTS = [100, 1_000, 10_000]
+VARIANTS = 5_000
+REPEATS = 20
+
+
+def synthetic_cycles(rng, n_cycles):
+    phases = rng.uniform([3, 0.5, 5, 0.5], [6, 3, 12, 4], size=(n_cycles, 4)).round(2)
+    return np.column_stack([phases, phases.sum(axis=1).round(2)])
+
+
+def variant_configs(n_variants):
+    """A grid of targets and pillar weights, as a tuning search would try."""
+    ie_ratios = np.linspace(1.2, 2.5, 50)
+    depth_weights = np.linspace(0.2, 0.6, max(1, n_variants // len(ie_ratios)))
+    return [{'TARGET_IE_RATIO': float(ie_ratio),
+             'PILLAR_WEIGHTS': {'depth': float(depth), 'stability': (1 - depth) / 2, 'balance': (1 - depth) / 2}}
+            for depth in depth_weights for ie_ratio in ie_ratios][:n_variants]
+
+
+def pandas_scores(df, config):
+    """The scores as the pillar functions compute them from the DataFrame."""
+    final_config = CONFIG.copy()
+    final_config.update(config)
+    weights = final_config['PILLAR_WEIGHTS']
+    depth = calculate_depth_score(df, final_config)
+    stability = calculate_stability_score(df, final_config)
+    balance = calculate_balance_score(df, final_config)
+    return weights['depth'] * depth + weights['stability'] * stability + weights['balance'] * balance
+
+
+def timed(function, repeats=REPEATS):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = function()
+    return result, (time.perf_counter() - start) / repeats
+
+
+def main():
+    cycle_counts = [int(arg) for arg in sys.argv[1:]] or CYCLE_COUNTS
+    rng = np.random.default_rng(0)
+    configs = variant_configs(VARIANTS)
+    print(f"{'cycles':>7} {'method':<36} {'time (ms)':>10} {'configs/s':>11}")
+    for n_cycles in cycle_counts:
+        durations = synthetic_cycles(rng, n_cycles)
+        df = pd.DataFrame(durations, columns=STATISTICS_COLUMNS)
+        statistics = cycle_statistics(durations)
+
+        expected, pandas_time = timed(lambda: [pandas_scores(df, config) for config in configs[:50]], 1)
+        pandas_time /= 50
+        single, single_time = timed(lambda: score_statistics(statistics, configs[0]))
+        variants, variants_time = timed(lambda: score_config_variants(statistics, configs), 3)
+        if variants[0] != single or any(abs(float(analysis['scores']['Final']) - score) > 0.01
+                                        for analysis, score in zip(variants, expected)):
+            raise AssertionError("Scores from the statistics differ from the pandas scores")
+
+        # An edit replaces a few cycles in the middle of the session
+        middle = n_cycles // 2
+        edited = np.concatenate([durations[:middle], synthetic_cycles(rng, 3), durations[middle + 2:]])
+        _, fresh_time = timed(lambda: cycle_statistics(edited))
+        updated, update_time = timed(lambda: update_cycle_statistics(statistics, durations[middle:middle + 2],
+                                                                     edited[middle:middle + 3]))
+        if updated != cycle_statistics(edited):
+            raise AssertionError("The updated statistics differ from the statistics of the edited cycles")
+
+        print(f"{n_cycles:>7} {'pandas pillar functions':<36} {pandas_time * 1e3:>10.3f} {1 / pandas_time:>11.0f}")
+        print(f"{n_cycles:>7} {'score_statistics':<36} {single_time * 1e3:>10.3f} {1 / single_time:>11.0f}")
+        print(f"{n_cycles:>7} {f'score_config_variants ({len(configs)})':<36} {variants_time * 1e3:>10.3f} "
+              f"{len(configs) / variants_time:>11.0f}")
+        print(f"{n_cycles:>7} {'cycle_statistics after an edit':<36} {fresh_time * 1e3:>10.3f} {'':>11}")
+        print(f"{n_cycles:>7} {'update_cycle_statistics':<36} {update_time * 1e3:>10.3f} {'':>11}")
+
+
+if __name__ == '__main__':
+    main()
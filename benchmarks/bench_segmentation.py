@@ -0,0 +1,111 @@
+"""
+Benchmarks the vectorized phase segmentation against the original iloc loop.
+
+Usage:
+    python benchmarks/bench_segmentation.py [n_frames ...]
+"""
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from analisis_audio import detect_events, calculate_amplitude_max  # noqa: E402
+
+FRAME_COUNTS = [10_000, 100_000, 1_000_000]
+APNEA_THRESHOLD_FACTOR = 0.1
+
+
+def legacy_identify_phase_intervals(apnea_mask, time):
+    """The original loop-based segmentation, kept here as the reference implementation."""
+    details = {'inhalation': [], 'exhalation': [], 'apnea': []}
+    if time.empty:
+        return details
+    changes = np.diff(apnea_mask.astype(int), prepend=apnea_mask.iloc[0])
+    change_points_idx = np.where(changes != 0)[0]
+    start_idx = 0
+    respiration_alternator = True
+    change_indices = list(change_points_idx) + [len(apnea_mask)]
+    for end_idx in change_indices:
+        if end_idx == 0: continue
+        if start_idx >= len(time): break
+        is_apnea = apnea_mask.iloc[start_idx]
+        start_time = time.iloc[start_idx]
+        if end_idx < len(time):
+            end_time = time.iloc[end_idx]
+        else:
+            end_time = time.iloc[-1] + 1
+        if end_time > start_time:
+            if is_apnea:
+                details['apnea'].append([start_time, end_time])
+            else:
+                if respiration_alternator:
+                    details['inhalation'].append([start_time, end_time])
+                else:
+                    details['exhalation'].append([start_time, end_time])
+                respiration_alternator = not respiration_alternator
+        start_idx = end_idx
+    return details
+
+
+def legacy_phases_to_events(phases):
+    """The original dict-building conversion, kept here as the reference implementation."""
+    events = []
+    phase_id = 0
+    for phase_type, intervals in phases.items():
+        for start, end in intervals:
+            events.append({'id': phase_id, 'start': int(start), 'end': int(end), 'type': phase_type})
+            phase_id += 1
+    events.sort(key=lambda x: x['start'])
+    return events
+
+
+def legacy_detect_events(df_envelope, amplitude_max, apnea_threshold_factor):
+    apnea_threshold = amplitude_max * apnea_threshold_factor
+    apnea_mask = (df_envelope['Positive_Mean'].fillna(0) < apnea_threshold) & \
+                 (np.abs(df_envelope['Negative_Mean'].fillna(0)) < apnea_threshold)
+    return legacy_phases_to_events(legacy_identify_phase_intervals(apnea_mask, df_envelope['Time']))
+
+
+def synthetic_envelope(n_frames, seed=0):
+    """Breathing-like envelope: ~20 s cycles with random phase lengths and noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_frames)
+    period = 20 + rng.normal(0, 3, size=n_frames // 10 + 1).repeat(10)[:n_frames]
+    phase = np.cumsum(2 * np.pi / period)
+    positive = np.clip(np.sin(phase), 0, None) + rng.normal(0, 0.03, n_frames)
+    negative = -np.clip(-np.sin(phase + 1), 0, None) - rng.normal(0, 0.03, n_frames)
+    return pd.DataFrame({'Time': t, 'Positive_Mean': positive.astype(np.float32), 'Negative_Mean': negative.astype(np.float32)})
+
+
+def best_of(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    frame_counts = [int(n) for n in sys.argv[1:]] or FRAME_COUNTS
+    print(f"{'frames':>10} {'events':>8} {'legacy (s)':>11} {'vectorized (s)':>15} {'speedup':>8}")
+    for n_frames in frame_counts:
+        df_envelope = synthetic_envelope(n_frames)
+        amplitude_max = calculate_amplitude_max(df_envelope)
+        repeats = 3 if n_frames <= 100_000 else 1
+
+        legacy_time, legacy_events = best_of(lambda: legacy_detect_events(df_envelope, amplitude_max, APNEA_THRESHOLD_FACTOR), repeats)
+        new_time, new_events = best_of(lambda: detect_events(df_envelope, amplitude_max, APNEA_THRESHOLD_FACTOR), repeats)
+        if new_events != legacy_events:
+            raise AssertionError(f"Vectorized events differ from the legacy implementation at {n_frames} frames")
+
+        print(f"{n_frames:>10} {len(new_events):>8} {legacy_time:>11.4f} {new_time:>15.4f} {legacy_time / new_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+    main()
@@ -1,6 +1,5 @@
 
 import sqlite3
-import json
 
 DATABASE_FILE = 'mindfulness_analysis.db'
 
@@ -8,10 +7,16 @@ def view_all_data():
     """Connects to the database and prints all analysis sessions."""
     try:
         conn = sqlite3.connect(DATABASE_FILE)
+        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
         print("--- Querying all analysis sessions. ---")
-        cursor.execute("SELECT * FROM analysis_sessions ORDER BY analysis_timestamp DESC")
+        cursor.execute('''
+            SELECT s.id, s.filename, s.analysis_timestamp, s.total_duration_seconds,
+                   sc.depth, sc.stability, sc.internal_balance, sc.final, sc.recommendation
+            FROM analysis_sessions s LEFT JOIN scores sc ON sc.session_id = s.id
+            ORDER BY s.analysis_timestamp DESC
+        ''')
         
         rows = cursor.fetchall()
 
@@ -20,17 +25,18 @@ def view_all_data():
             return
 
         for row in rows:
-            print(f"\n--- Session ID: {row[0]} ---")
-            print(f"  Filename: {row[1]}")
-            print(f"  Timestamp: {row[2]}")
-            print(f"  Duration: {row[3]:.2f}s")
-            
-            # Parse and print some of the analysis data
-            analysis = json.loads(row[7]) # respiration_analysis_json is at index 7
+            print(f"\n--- Session ID: {row['id']} ---")
+            print(f"  Filename: {row['filename']}")
+            print(f"  Timestamp: {row['analysis_timestamp']}")
+            print(f"  Duration: {row['total_duration_seconds']:.2f}s")
+
+            if row['final'] is None:
+                print("  Scores: not enough cycles")
+                continue
             print("  Scores:")
-            for pillar, score in analysis['scores'].items():
-                print(f"    - {pillar}: {score}")
-            print(f"  Recommendation: {analysis['recommendation']}")
+            for pillar, column in (('Depth', 'depth'), ('Stability', 'stability'), ('Internal Balance', 'internal_balance'), ('Final', 'final')):
+                print(f"    - {pillar}: {row[column]:.2f}")
+            print(f"  Recommendation: {row['recommendation']}")
 
     except sqlite3.Error as e:
         print(f"Database error: {e}")
@@ -3,9 +3,11 @@ import sqlite3
 DATABASE_FILE = 'mindfulness_analysis.db'
 
 def clear_database():
-    """Deletes all data from the analysis_sessions table without dropping the table."""
+    """Deletes all sessions, with their events, cycles and scores, without dropping the tables."""
     try:
         conn = sqlite3.connect(DATABASE_FILE)
+        # The events, cycles and scores of the sessions are deleted with them
+        conn.execute("PRAGMA foreign_keys=ON")
         cursor = conn.cursor()
         
         cursor.execute("DELETE FROM analysis_sessions")
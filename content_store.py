@@ -0,0 +1,161 @@
+"""
+Content-addressed storage of uploaded audio and cache of analysis results.
+
+Uploads are hashed (SHA-256) while they are written to disk and kept once in the audio
+store, named after their hash:
+
+    uploads/<sha256>.<ext>
+
+Session folders get a hard link to the blob (a copy where the file system does not
+support links), so the rest of the app keeps finding the audio next to the session.
+
+Analysis results are cached by audio hash, apnea threshold factor and analysis version
+(FEATURES_VERSION, ANALYSIS_VERSION and the envelope hop):
+
+    analysis_cache/<sha256>/<key>/
+        analysis.json        session document as produced by the analysis, without the
+                             session's own fields
+        features.npz, waveform.bin, session_arrays.npz
+
+A repeat upload of the same recording hard-links these files into its new session
+folder instead of decoding the audio again, so it costs no disk space beyond its own
+session document. Sharing them is safe because they are never modified in place: every
+writer replaces the whole file (a new inode) with `os.replace`.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+from analisis_audio import ANALYSIS_VERSION, ENVELOPE_HOP_SECONDS, FEATURES_FILENAME, FEATURES_VERSION, WAVEFORM_FILENAME
+from session_store import SESSION_ARRAYS_FILENAME, without_arrays
+
+AUDIO_STORE_FOLDER = 'uploads'
+ANALYSIS_CACHE_FOLDER = 'analysis_cache'
+HASH_CHUNK_BYTES = 1 << 20  # Bytes read and hashed at a time while storing audio
+CACHED_ANALYSIS_FILENAME = 'analysis.json'
+CACHED_SESSION_FILES = (FEATURES_FILENAME, WAVEFORM_FILENAME, SESSION_ARRAYS_FILENAME)
+SESSION_KEYS = ('session_folder', 'audio_filename', 'db_id', 'filename')  # Fields that belong to one session, never cached
+
+
+def save_audio_stream(stream, extension, store_folder=AUDIO_STORE_FOLDER):
+    """
+    Writes an audio stream to the store, hashing it on the way.
+
+    Args:
+        stream (file-like): The upload (e.g. `FileStorage.stream`), read in chunks.
+        extension (str): File extension of the recording, such as 'wav'.
+        store_folder (str): The audio store.
+
+    Returns:
+        tuple: The SHA-256 hex digest of the audio and the path of its blob. When the
+               store already held the recording, the new copy is discarded.
+    """
+    os.makedirs(store_folder, exist_ok=True)
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(store_folder, f'.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(HASH_CHUNK_BYTES), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        audio_hash = digest.hexdigest()
+        blob_path = audio_blob_path(audio_hash, extension, store_folder)
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, blob_path)
+        return audio_hash, blob_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_audio_file(path, store_folder=AUDIO_STORE_FOLDER):
+    """Copies an audio file into the store; see `save_audio_stream`."""
+    with open(path, 'rb') as f:
+        return save_audio_stream(f, os.path.splitext(path)[1].lstrip('.').lower(), store_folder)
+
+
+def audio_blob_path(audio_hash, extension, store_folder=AUDIO_STORE_FOLDER):
+    """Returns the path of a recording in the store."""
+    return os.path.join(store_folder, f'{audio_hash}.{extension.lower()}')
+
+
+def link_audio(blob_path, destination):
+    """
+    Makes a stored recording appear at `destination` (a session folder's audio file) without copying it.
+    """
+    _link_file(blob_path, destination)
+
+
+def analysis_cache_key(apnea_threshold_factor, hop_seconds=ENVELOPE_HOP_SECONDS):
+    """Returns the part of the cache key that depends on the analysis settings and version."""
+    return f"t{float(apnea_threshold_factor)!r}_h{float(hop_seconds)!r}_f{FEATURES_VERSION}_a{ANALYSIS_VERSION}"
+
+
+def load_cached_analysis(audio_hash, apnea_threshold_factor, session_folder, cache_folder=ANALYSIS_CACHE_FOLDER):
+    """
+    Links the cached analysis files of a recording into a session folder.
+
+    Args:
+        audio_hash (str): SHA-256 of the recording.
+        apnea_threshold_factor (float): The factor the analysis used.
+        session_folder (str): The session folder receiving the feature, waveform and array files.
+        cache_folder (str): The analysis cache.
+
+    Returns:
+        dict: The cached session document (without the session's own fields), or None on a miss.
+    """
+    entry_folder = _cache_entry_folder(audio_hash, apnea_threshold_factor, cache_folder)
+    document_path = os.path.join(entry_folder, CACHED_ANALYSIS_FILENAME)
+    if not os.path.exists(document_path):
+        return None
+    try:
+        for name in CACHED_SESSION_FILES:
+            _link_file(os.path.join(entry_folder, name), os.path.join(session_folder, name))
+        with open(document_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cached analysis {entry_folder}: {e}")
+        return None
+
+
+def store_cached_analysis(audio_hash, apnea_threshold_factor, session_folder, analysis_data, cache_folder=ANALYSIS_CACHE_FOLDER):
+    """
+    Caches the analysis of a recording from the session folder it was just written to.
+
+    The entry is assembled in a temporary folder and renamed into place, so readers never
+    see half of it; when two analyses of the same recording finish together, the first one wins.
+    """
+    entry_folder = _cache_entry_folder(audio_hash, apnea_threshold_factor, cache_folder)
+    if os.path.exists(entry_folder):
+        return
+    tmp_folder = f'{entry_folder}.{uuid.uuid4().hex}.tmp'
+    os.makedirs(tmp_folder)
+    try:
+        for name in CACHED_SESSION_FILES:
+            _link_file(os.path.join(session_folder, name), os.path.join(tmp_folder, name))
+        document = {key: value for key, value in without_arrays(analysis_data).items() if key not in SESSION_KEYS}
+        with open(os.path.join(tmp_folder, CACHED_ANALYSIS_FILENAME), 'w') as f:
+            json.dump(document, f)
+        os.rename(tmp_folder, entry_folder)
+    except OSError:
+        # Another analysis of the recording was cached first, or the session lacks a file
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def _link_file(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # File systems without hard links (or a store on another device) get a copy
+        shutil.copy2(source, destination)
+
+
+def _cache_entry_folder(audio_hash, apnea_threshold_factor, cache_folder):
+    return os.path.join(cache_folder, audio_hash, analysis_cache_key(apnea_threshold_factor))
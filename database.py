@@ -1,22 +1,163 @@
+"""
+SQLite access for analysis sessions and jobs.
+
+Connections are pooled: every function borrows an open connection, runs its
+statements in one transaction and returns the connection to the pool, so the
+statements each connection has prepared are reused by later calls. Connections use
+WAL journaling, so readers never block the writer (and the other way round), with
+`synchronous=NORMAL` and a busy timeout instead of failing at once with "database is
+locked" while another connection (a thread, a job worker process or the batch CLI)
+commits.
+
+The schema is not created on import: the app and the batch CLI call `create_tables()`
+once at startup (or run `python database.py`).
+
+A session's results are stored in normalized tables, so questions that span sessions
+are answered by indexed SQL instead of parsing every session in Python:
+
+    events    one row per phase event          (session_id, event_id)
+    cycles    one row per respiratory cycle    (session_id, cycle_number)
+    scores    one row per scored session       (session_id)
+
+Participant dashboards read summaries maintained alongside them, so they never go back
+to the raw rows: every write of a session (`save_analysis_to_db`,
+`update_analysis_in_db`) also rewrites that session's
+
+    session_summaries      mean phase durations, I:E ratio and scores  (session_id)
+    cycle_duration_bins    histogram of its cycle durations            (session_id, bin)
+
+Databases created before these tables kept the results as JSON text columns of
+`analysis_sessions`; `create_tables()` moves them into the tables once (tracked by
+`PRAGMA user_version`) and clears the old columns.
+"""
 import sqlite3
 import json
+import os
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
+import numpy as np
+
 DATABASE_FILE = 'mindfulness_analysis.db'
+BUSY_TIMEOUT_MS = 5000  # How long a statement waits for another connection's lock before failing
+SYNCHRONOUS = 'NORMAL'  # With WAL, commits survive application crashes; a power cut may lose the last ones
+STATEMENT_CACHE_SIZE = 64  # Prepared statements kept by each connection
+POOL_SIZE = 8  # Idle connections kept open; more are opened (and closed afterwards) under load
+SCHEMA_VERSION = 3  # Stored in PRAGMA user_version; bump with a new step in _migrate
+EVENT_COLUMNS = ('event_id', 'type', 'start_time', 'end_time')  # Key first
+CYCLE_COLUMNS = ('cycle_number', 'inhalation', 'apnea_1', 'exhalation', 'apnea_2', 'total')  # Key first
+CYCLE_TABLE_COLUMNS = {  # Column of the cycles table -> column of the cycles DataFrame
+    'inhalation': 'Inhalation (s)',
+    'apnea_1': 'Apnea 1 (s)',
+    'exhalation': 'Exhalation (s)',
+    'apnea_2': 'Apnea 2 (s)',
+    'total': 'Total Cycle (s)'
+}
+SCORE_TABLE_COLUMNS = {  # Column of the scores table -> pillar of the respiration analysis
+    'depth': 'Depth',
+    'stability': 'Stability',
+    'internal_balance': 'Internal Balance',
+    'final': 'Final'
+}
+SCORE_COLUMNS = (*SCORE_TABLE_COLUMNS, 'num_cycles', 'weakest_pillar', 'recommendation')
+SUMMARY_COLUMNS = ('num_cycles', *CYCLE_TABLE_COLUMNS, 'total_std', 'ie_ratio', *SCORE_TABLE_COLUMNS)
+CYCLE_BIN_SECONDS = 2  # Width of the cycle-duration histogram bins kept per session
+LEGACY_JSON_COLUMNS = ('respiratory_cycles_json', 'respiration_analysis_json', 'segmentation_events_json')
 
 def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DATABASE_FILE)
+    """Opens a new connection to the SQLite database, configured for WAL and concurrent access."""
+    # Pooled connections are handed from thread to thread, one at a time
+    conn = sqlite3.connect(DATABASE_FILE, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={SYNCHRONOUS}')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    # Deleting a session deletes its events, cycles and scores
+    conn.execute('PRAGMA foreign_keys=ON')
     return conn
 
+class ConnectionPool:
+    """
+    Pool of open connections shared by the threads of one process.
+
+    Args:
+        max_idle (int): Connections kept open between uses.
+    """
+
+    def __init__(self, max_idle=POOL_SIZE):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._owner = None
+
+    @contextmanager
+    def connection(self):
+        """Lends an open connection; it goes back to the pool when the block ends."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close_all(self):
+        """Closes the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _acquire(self):
+        with self._lock:
+            # Connections must not cross into a forked process, and follow DATABASE_FILE
+            owner = (os.getpid(), DATABASE_FILE)
+            if self._owner != owner:
+                self._idle, self._owner = [], owner
+            if self._idle:
+                return self._idle.pop()
+        return get_db_connection()
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if self._owner == (os.getpid(), DATABASE_FILE) and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+_pool = ConnectionPool()
+
+@contextmanager
+def transaction():
+    """
+    Runs a block of statements in one transaction on a pooled connection.
+
+    Yields:
+        sqlite3.Cursor: The cursor to execute on; the transaction is committed when the
+        block ends and rolled back if it raises.
+    """
+    with _pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
 def create_tables():
     """
     Creates the necessary tables in the database if they don't already exist.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    with transaction() as cursor:
+        _create_schema(cursor)
+    print("Database tables checked/created successfully!")
+
+def _create_schema(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS analysis_sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -25,10 +166,7 @@ def create_tables():
             analysis_timestamp DATETIME NOT NULL,
             total_duration_seconds REAL NOT NULL,
             sampling_rate INTEGER NOT NULL,
-            session_folder TEXT NOT NULL,
-            respiratory_cycles_json TEXT,
-            respiration_analysis_json TEXT,
-            segmentation_events_json TEXT
+            session_folder TEXT NOT NULL
         );
     ''')
     # Add participant_name column if it doesn't exist
@@ -40,83 +178,346 @@ def create_tables():
         cursor.execute('''
             ALTER TABLE analysis_sessions ADD COLUMN participant_name TEXT;
         ''')
-    
-    conn.commit()
-    conn.close()
-    print("Database tables checked/created successfully!")
+    # SHA-256 of the recording, naming its blob in the audio store (see content_store.py)
+    if 'audio_hash' not in columns:
+        cursor.execute('''
+            ALTER TABLE analysis_sessions ADD COLUMN audio_hash TEXT;
+        ''')
+
+    # Uploads analyzed in the background (see analysis_jobs.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            progress INTEGER NOT NULL DEFAULT 0,
+            filename TEXT NOT NULL,
+            participant_name TEXT,
+            session_folder TEXT NOT NULL,
+            db_id INTEGER,
+            error TEXT,
+            created_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL
+        );
+    ''')
 
-def save_analysis_to_db(session_folder_path, analysis_data, df_table, respiration_analysis, participant_name=None):
+    # Analysis results, one row per event, cycle and scored session
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            session_id INTEGER NOT NULL REFERENCES analysis_sessions(id) ON DELETE CASCADE,
+            event_id INTEGER NOT NULL,
+            type TEXT,
+            start_time REAL NOT NULL,
+            end_time REAL NOT NULL,
+            PRIMARY KEY (session_id, event_id)
+        ) WITHOUT ROWID;
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cycles (
+            session_id INTEGER NOT NULL REFERENCES analysis_sessions(id) ON DELETE CASCADE,
+            cycle_number INTEGER NOT NULL,
+            inhalation REAL NOT NULL,
+            apnea_1 REAL NOT NULL,
+            exhalation REAL NOT NULL,
+            apnea_2 REAL NOT NULL,
+            total REAL NOT NULL,
+            PRIMARY KEY (session_id, cycle_number)
+        ) WITHOUT ROWID;
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scores (
+            session_id INTEGER PRIMARY KEY REFERENCES analysis_sessions(id) ON DELETE CASCADE,
+            depth REAL NOT NULL,
+            stability REAL NOT NULL,
+            internal_balance REAL NOT NULL,
+            final REAL NOT NULL,
+            num_cycles INTEGER NOT NULL,
+            weakest_pillar TEXT,
+            recommendation TEXT
+        );
+    ''')
+    # Per-session summaries for participant trends, written with every session update
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id INTEGER PRIMARY KEY REFERENCES analysis_sessions(id) ON DELETE CASCADE,
+            participant_name TEXT,
+            analysis_timestamp DATETIME NOT NULL,
+            num_cycles INTEGER NOT NULL,
+            inhalation REAL,
+            apnea_1 REAL,
+            exhalation REAL,
+            apnea_2 REAL,
+            total REAL,
+            total_std REAL,
+            ie_ratio REAL,
+            depth REAL,
+            stability REAL,
+            internal_balance REAL,
+            final REAL
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cycle_duration_bins (
+            session_id INTEGER NOT NULL REFERENCES analysis_sessions(id) ON DELETE CASCADE,
+            bin INTEGER NOT NULL,
+            cycles INTEGER NOT NULL,
+            PRIMARY KEY (session_id, bin)
+        ) WITHOUT ROWID;
+    ''')
+    # Bulk rescoring runs (see rescore_sessions.py); the last session rescored is where a run resumes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rescoring_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            config_key TEXT NOT NULL,
+            config_json TEXT NOT NULL,
+            last_session_id INTEGER NOT NULL DEFAULT 0,
+            sessions_rescored INTEGER NOT NULL DEFAULT 0,
+            started_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL,
+            finished_at DATETIME
+        );
+    ''')
+    # Sessions are selected by participant and date; the child tables are keyed by session
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_summaries_participant_timestamp
+        ON session_summaries (participant_name, analysis_timestamp);
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_participant_timestamp
+        ON analysis_sessions (participant_name, analysis_timestamp);
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON analysis_sessions (analysis_timestamp);
+    ''')
+
+    cursor.execute('PRAGMA user_version')
+    version = cursor.fetchone()[0]
+    if version < SCHEMA_VERSION:
+        _migrate(cursor, version, columns)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+def _migrate(cursor, version, session_columns):
     """
-    Saves the complete analysis result to the SQLite database.
+    Brings the data of a database created by an older version of the app up to date.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the schema transaction.
+        version (int): The database's PRAGMA user_version.
+        session_columns (list): Columns of analysis_sessions before this update.
+    """
+    if version < 1 and all(column in session_columns for column in LEGACY_JSON_COLUMNS):
+        # Version 1: the JSON text columns become the events, cycles and scores tables
+        cursor.execute(f'SELECT id, {", ".join(LEGACY_JSON_COLUMNS)} FROM analysis_sessions')
+        migrated = 0
+        for row in cursor.fetchall():
+            cycles_json, analysis_json, events_json = (row[column] for column in LEGACY_JSON_COLUMNS)
+            _insert_results(cursor, row['id'],
+                            _event_rows(json.loads(events_json) if events_json else []),
+                            _cycle_rows(json.loads(cycles_json) if cycles_json else []),
+                            _score_row(json.loads(analysis_json) if analysis_json else None))
+            migrated += 1
+        cursor.execute(f'UPDATE analysis_sessions SET {", ".join(f"{column} = NULL" for column in LEGACY_JSON_COLUMNS)}')
+        print(f"Migrated the results of {migrated} session(s) to the events, cycles and scores tables.")
+    if version < 3:
+        # Version 2: summaries of the sessions saved before they were maintained.
+        # Version 3: total_std is the sample standard deviation, as the scores use it
+        cursor.execute('SELECT id FROM analysis_sessions')
+        session_ids = [row['id'] for row in cursor.fetchall()]
+        for db_id in session_ids:
+            cursor.execute(f'SELECT {", ".join(CYCLE_COLUMNS)} FROM cycles WHERE session_id = ? ORDER BY cycle_number', (db_id,))
+            cycle_rows = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute(f'SELECT {", ".join(SCORE_COLUMNS)} FROM scores WHERE session_id = ?', (db_id,))
+            score_row = cursor.fetchone()
+            _update_summary(cursor, db_id, cycle_rows, tuple(score_row) if score_row else None)
+        if session_ids:
+            print(f"Summarized {len(session_ids)} session(s) for the participant trends.")
+
+def _event_rows(events):
+    """Returns the events table values (without session_id) of a session's event dictionaries."""
+    return [(int(event['id']), event['type'], float(event['start']), float(event['end'])) for event in events or []]
+
+def _cycle_rows(cycle_records):
+    """Returns the cycles table values (without session_id) of the records of a cycles table, skipping the 'avg' row."""
+    return [(int(record['Cycle']), *(float(record[column]) for column in CYCLE_TABLE_COLUMNS.values()))
+            for record in cycle_records if record['Cycle'] != 'avg']
+
+def _score_row(respiration_analysis):
+    """Returns the scores table values (without session_id) of a respiration analysis, or None if it has no scores."""
+    if not respiration_analysis:
+        return None
+    scores = respiration_analysis['scores']
+    return (*(float(scores[pillar]) for pillar in SCORE_TABLE_COLUMNS.values()),
+            respiration_analysis['num_cycles'], respiration_analysis['weakest_pillar'], respiration_analysis['recommendation'])
+
+def _cycle_records(df_table):
+    return df_table.to_dict('records') if df_table is not None else []
+
+def _upsert_sql(table, columns):
+    return f'INSERT OR REPLACE INTO {table} (session_id, {", ".join(columns)}) VALUES (?{", ?" * len(columns)})'
+
+def _insert_results(cursor, db_id, event_rows, cycle_rows, score_row):
+    """Inserts the events, cycles and scores of a session that has none stored yet."""
+    cursor.executemany(_upsert_sql('events', EVENT_COLUMNS), [(db_id, *row) for row in event_rows])
+    cursor.executemany(_upsert_sql('cycles', CYCLE_COLUMNS), [(db_id, *row) for row in cycle_rows])
+    if score_row:
+        cursor.execute(_upsert_sql('scores', SCORE_COLUMNS), (db_id, *score_row))
+
+def _update_summary(cursor, db_id, cycle_rows, score_row):
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    Rewrites the summary and cycle-duration histogram of one session from its new rows.
 
-    cycles_json = df_table.to_json(orient='records')
-    analysis_json = json.dumps(respiration_analysis)
-    events_json = json.dumps(analysis_data.get("events"))
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction writing the session.
+        db_id (int): The session, already in analysis_sessions.
+        cycle_rows (list): The session's cycles table values, in the order of CYCLE_COLUMNS.
+        score_row (tuple): The session's scores table values, or None if it is not scored.
+    """
+    durations = np.array([row[1:] for row in cycle_rows], dtype=float).reshape(-1, len(CYCLE_TABLE_COLUMNS))
+    if len(durations):
+        means = durations.mean(axis=0)
+        mean_by_column = dict(zip(CYCLE_TABLE_COLUMNS, means.tolist()))
+        # Exhalation over inhalation, as the balance score defines it
+        ie_ratio = mean_by_column['exhalation'] / mean_by_column['inhalation'] if mean_by_column['inhalation'] > 0 else None
+        # The sample standard deviation, as the stability score uses; undefined for a single cycle
+        total_std = float(durations[:, -1].std(ddof=1)) if len(durations) > 1 else None
+        cycle_stats = (len(durations), *means.tolist(), total_std, ie_ratio)
+    else:
+        cycle_stats = (0,) + (None,) * (len(CYCLE_TABLE_COLUMNS) + 2)
+    pillar_scores = tuple(score_row[:len(SCORE_TABLE_COLUMNS)]) if score_row else (None,) * len(SCORE_TABLE_COLUMNS)
+
+    # Participant and date are copied from the session, so trends are read from this table alone
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO session_summaries (session_id, participant_name, analysis_timestamp, {", ".join(SUMMARY_COLUMNS)})
+        SELECT id, participant_name, analysis_timestamp{", ?" * len(SUMMARY_COLUMNS)} FROM analysis_sessions WHERE id = ?
+    ''', (*cycle_stats, *pillar_scores, db_id))
+
+    bins = np.bincount((durations[:, -1] // CYCLE_BIN_SECONDS).astype(np.int64)) if len(durations) else np.zeros(0, dtype=np.int64)
+    bin_rows = [(int(index), int(count)) for index, count in enumerate(bins.tolist()) if count]
+    _sync_rows(cursor, 'cycle_duration_bins', ('bin', 'cycles'), db_id, bin_rows)
+
+def _sync_rows(cursor, table, columns, db_id, rows):
+    """
+    Makes a session's rows of a child table equal to `rows`, writing only the rows that differ.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the update transaction.
+        table (str): A table keyed by session_id and one more column, such as 'events'.
+        columns (tuple): The table's columns after session_id, key first.
+        db_id (int): The session.
+        rows (list): The new values of the rows, in the order of `columns`.
 
+    Returns:
+        int: Rows inserted, replaced or deleted.
+    """
+    key = columns[0]
+    cursor.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE session_id = ?', (db_id,))
+    stored = {row[0]: tuple(row) for row in cursor.fetchall()}
+    rows = {row[0]: row for row in rows}
+    changed = [(db_id, *row) for row_key, row in rows.items() if stored.get(row_key) != row]
+    removed = [(db_id, row_key) for row_key in stored.keys() - rows.keys()]
+    cursor.executemany(_upsert_sql(table, columns), changed)
+    cursor.executemany(f'DELETE FROM {table} WHERE session_id = ? AND {key} = ?', removed)
+    return len(changed) + len(removed)
+
+INSERT_SESSION_SQL = '''
+    INSERT INTO analysis_sessions (
+        filename, participant_name, analysis_timestamp, total_duration_seconds, sampling_rate,
+        session_folder, audio_hash
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+def _insert_session(cursor, session_folder_path, analysis_data, df_table, respiration_analysis, participant_name=None, audio_hash=None):
+    """Inserts an analysis_sessions row with its events, cycles and scores, and returns its id."""
+    cursor.execute(INSERT_SESSION_SQL, (
+        analysis_data.get("audio_filename"),
+        participant_name,
+        datetime.now(),
+        analysis_data.get("duration"),
+        analysis_data.get("sampling_rate"),
+        session_folder_path,
+        audio_hash
+    ))
+    db_id = cursor.lastrowid
+    cycle_rows = _cycle_rows(_cycle_records(df_table))
+    score_row = _score_row(respiration_analysis)
+    _insert_results(cursor, db_id, _event_rows(analysis_data.get("events")), cycle_rows, score_row)
+    _update_summary(cursor, db_id, cycle_rows, score_row)
+    return db_id
+
+def save_analysis_to_db(session_folder_path, analysis_data, df_table, respiration_analysis, participant_name=None, audio_hash=None):
+    """
+    Saves the complete analysis result to the SQLite database.
+    """
     try:
-        cursor.execute('''
-            INSERT INTO analysis_sessions (
-                filename, participant_name, analysis_timestamp, total_duration_seconds, sampling_rate, 
-                session_folder, respiratory_cycles_json, respiration_analysis_json, segmentation_events_json
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            analysis_data.get("audio_filename"),
-            participant_name,
-            datetime.now(),
-            analysis_data.get("duration"),
-            analysis_data.get("sampling_rate"),
-            session_folder_path,
-            cycles_json,
-            analysis_json,
-            events_json
-        ))
-        
-        conn.commit()
-        inserted_id = cursor.lastrowid
+        with transaction() as cursor:
+            inserted_id = _insert_session(cursor, session_folder_path, analysis_data, df_table, respiration_analysis, participant_name, audio_hash)
         print(f"Successfully saved analysis to SQLite with ID: {inserted_id}")
         return inserted_id
     except sqlite3.Error as e:
         print(f"Failed to save analysis to SQLite: {e}")
         return None
-    finally:
-        conn.close()
+
+def save_analyses_to_db(sessions):
+    """
+    Saves several analysis results in a single transaction.
+
+    Args:
+        sessions (list): Tuples of the `save_analysis_to_db` arguments (session_folder_path,
+            analysis_data, df_table, respiration_analysis, participant_name[, audio_hash]).
+
+    Returns:
+        list: The inserted ids, in the order of `sessions`, or None if the transaction failed
+              (then none of them is saved).
+    """
+    try:
+        with transaction() as cursor:
+            inserted_ids = [_insert_session(cursor, *session) for session in sessions]
+        return inserted_ids
+    except sqlite3.Error as e:
+        print(f"Failed to save {len(sessions)} analyses to SQLite: {e}")
+        return None
+
+def get_session_folders():
+    """
+    Returns the set of session folders of all the analyses saved in the database,
+    or None if the query failed.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.execute('SELECT session_folder FROM analysis_sessions')
+            return {row['session_folder'] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        print(f"Failed to retrieve session folders: {e}")
+        return None
 
 def update_analysis_in_db(db_id, analysis_data, df_table, respiration_analysis):
     """
     Updates an existing analysis record in the SQLite database.
+
+    Only the events and cycles that changed are written: an edit touching one event
+    rewrites that event and the cycles whose durations moved, not the whole session.
     """
     if not db_id:
         return False
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cycles_json = df_table.to_json(orient='records')
-    analysis_json = json.dumps(respiration_analysis)
-    events_json = json.dumps(analysis_data.get("events"))
+    cycle_rows = _cycle_rows(_cycle_records(df_table))
+    score_row = _score_row(respiration_analysis)
 
     try:
-        cursor.execute('''
-            UPDATE analysis_sessions
-            SET 
-                respiratory_cycles_json = ?,
-                respiration_analysis_json = ?,
-                segmentation_events_json = ?
-            WHERE id = ?
-        ''', (cycles_json, analysis_json, events_json, db_id))
-        
-        conn.commit()
-        print(f"Successfully updated analysis in SQLite for ID: {db_id}")
+        with transaction() as cursor:
+            written = _sync_rows(cursor, 'events', EVENT_COLUMNS, db_id, _event_rows(analysis_data.get("events")))
+            written += _sync_rows(cursor, 'cycles', CYCLE_COLUMNS, db_id, cycle_rows)
+            if score_row:
+                cursor.execute(_upsert_sql('scores', SCORE_COLUMNS), (db_id, *score_row))
+            else:
+                cursor.execute('DELETE FROM scores WHERE session_id = ?', (db_id,))
+            _update_summary(cursor, db_id, cycle_rows, score_row)
+        print(f"Successfully updated analysis in SQLite for ID: {db_id} ({written} event/cycle rows written)")
         return True
     except sqlite3.Error as e:
         print(f"Failed to update analysis in SQLite for ID {db_id}: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_analysis_details(db_id):
     """
@@ -124,27 +525,302 @@ def get_analysis_details(db_id):
     """
     if not db_id:
         return None
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+
     try:
-        cursor.execute(
-            'SELECT session_folder, filename FROM analysis_sessions WHERE id = ?',
-            (db_id,)
-        )
-        row = cursor.fetchone()
-        if row:
-            return {
-                'session_folder_path': row['session_folder'],
-                'audio_filename': row['filename']
-            }
-        return None
+        with transaction() as cursor:
+            cursor.execute(
+                'SELECT session_folder, filename FROM analysis_sessions WHERE id = ?',
+                (db_id,)
+            )
+            row = cursor.fetchone()
+            if row:
+                return {
+                    'session_folder_path': row['session_folder'],
+                    'audio_filename': row['filename']
+                }
+            return None
     except sqlite3.Error as e:
         print(f"Failed to retrieve analysis details for ID {db_id}: {e}")
         return None
-    finally:
-        conn.close()
 
-# --- Initialize the database --- 
-create_tables()
\ No newline at end of file
+def get_cycle_averages(participant_name=None, since=None, until=None):
+    """
+    Averages the respiratory cycles and scores of a set of sessions in SQL.
+
+    Args:
+        participant_name (str, optional): Only this participant's sessions.
+        since (datetime, optional): Only sessions analyzed at or after this time.
+        until (datetime, optional): Only sessions analyzed before this time.
+
+    Returns:
+        dict: 'sessions' and 'cycles' counts, the average of every phase column of the
+              cycles table and of every score column, or None if the query failed.
+    """
+    conditions, params = [], []
+    if participant_name is not None:
+        conditions.append('participant_name = ?')
+        params.append(participant_name)
+    if since is not None:
+        conditions.append('analysis_timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('analysis_timestamp < ?')
+        params.append(until)
+    selected = f"SELECT id FROM analysis_sessions{' WHERE ' + ' AND '.join(conditions) if conditions else ''}"
+
+    try:
+        with transaction() as cursor:
+            cursor.execute(f'''
+                SELECT COUNT(DISTINCT session_id) AS sessions, COUNT(*) AS cycles,
+                       {", ".join(f"AVG({column}) AS {column}" for column in CYCLE_TABLE_COLUMNS)}
+                FROM cycles WHERE session_id IN ({selected})
+            ''', params)
+            averages = dict(cursor.fetchone())
+            cursor.execute(f'''
+                SELECT {", ".join(f"AVG({column}) AS {column}" for column in SCORE_TABLE_COLUMNS)}
+                FROM scores WHERE session_id IN ({selected})
+            ''', params)
+            averages.update(cursor.fetchone())
+            return averages
+    except sqlite3.Error as e:
+        print(f"Failed to average the cycles of {participant_name or 'all participants'}: {e}")
+        return None
+
+def get_participants():
+    """
+    Lists the participants with saved sessions.
+
+    Returns:
+        list: Dictionaries with 'participant_name', 'sessions', 'first_session' and
+              'last_session', by name, or None if the query failed.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+                SELECT participant_name, COUNT(*) AS sessions,
+                       MIN(analysis_timestamp) AS first_session, MAX(analysis_timestamp) AS last_session
+                FROM session_summaries
+                GROUP BY participant_name
+                ORDER BY participant_name
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Failed to list the participants: {e}")
+        return None
+
+def get_participant_trends(participant_name, since=None, until=None):
+    """
+    Reads a participant's session summaries and cycle-duration histogram.
+
+    Only the summary tables are read, through their (participant, timestamp) index.
+
+    Args:
+        participant_name (str): The participant.
+        since (datetime, optional): Only sessions analyzed at or after this time.
+        until (datetime, optional): Only sessions analyzed before this time.
+
+    Returns:
+        dict: A dictionary containing:
+            - 'sessions': list of summaries (session_id, analysis_timestamp and the
+              SUMMARY_COLUMNS), oldest first.
+            - 'cycle_durations': list of (bin, cycles) pairs over all those sessions; bin
+              `b` counts the cycles lasting from b * CYCLE_BIN_SECONDS to (b + 1) * CYCLE_BIN_SECONDS seconds.
+        None if the query failed.
+    """
+    conditions, params = ['participant_name = ?'], [participant_name]
+    if since is not None:
+        conditions.append('analysis_timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('analysis_timestamp < ?')
+        params.append(until)
+    where = ' AND '.join(conditions)
+
+    try:
+        with transaction() as cursor:
+            cursor.execute(f'''
+                SELECT session_id, analysis_timestamp, {", ".join(SUMMARY_COLUMNS)}
+                FROM session_summaries
+                WHERE {where}
+                ORDER BY analysis_timestamp
+            ''', params)
+            sessions = [dict(row) for row in cursor.fetchall()]
+            cursor.execute(f'''
+                SELECT bin, SUM(cycles) AS cycles
+                FROM cycle_duration_bins
+                WHERE session_id IN (SELECT session_id FROM session_summaries WHERE {where})
+                GROUP BY bin
+                ORDER BY bin
+            ''', params)
+            cycle_durations = [(row['bin'], row['cycles']) for row in cursor.fetchall()]
+            return {'sessions': sessions, 'cycle_durations': cycle_durations}
+    except sqlite3.Error as e:
+        print(f"Failed to read the trends of {participant_name}: {e}")
+        return None
+
+def start_rescoring_run(config_key, config_json, restart=False):
+    """
+    Returns the unfinished rescoring run of a scoring configuration, or starts one.
+
+    Args:
+        config_key (str): Digest identifying the scoring configuration.
+        config_json (str): The configuration, kept for reference.
+        restart (bool): Start a new run even if an unfinished one exists.
+
+    Returns:
+        dict: The run's columns, or None if it could not be read or started.
+    """
+    now = datetime.now()
+
+    try:
+        with transaction() as cursor:
+            if not restart:
+                cursor.execute('''
+                    SELECT * FROM rescoring_runs WHERE config_key = ? AND finished_at IS NULL
+                    ORDER BY id DESC LIMIT 1
+                ''', (config_key,))
+                row = cursor.fetchone()
+                if row:
+                    return dict(row)
+            cursor.execute('''
+                INSERT INTO rescoring_runs (config_key, config_json, started_at, updated_at) VALUES (?, ?, ?, ?)
+            ''', (config_key, config_json, now, now))
+            cursor.execute('SELECT * FROM rescoring_runs WHERE id = ?', (cursor.lastrowid,))
+            return dict(cursor.fetchone())
+    except sqlite3.Error as e:
+        print(f"Failed to start a rescoring run: {e}")
+        return None
+
+def get_cycles_batch(after_session_id, limit):
+    """
+    Reads the next sessions of a bulk pass over the database, in id order.
+
+    Only `limit` sessions are read at a time; the caller passes the last id it received
+    to get the next batch.
+
+    Args:
+        after_session_id (int): The last session of the previous batch (0 to start).
+        limit (int): Sessions in the batch.
+
+    Returns:
+        tuple: The session ids of the batch, and the (session_id, *CYCLE_TABLE_COLUMNS) rows of
+               their cycles ordered by session and cycle number, or None if the query failed.
+               Sessions without cycles appear only in the ids.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.execute('SELECT id FROM analysis_sessions WHERE id > ? ORDER BY id LIMIT ?', (after_session_id, limit))
+            session_ids = [row['id'] for row in cursor.fetchall()]
+            if not session_ids:
+                return [], []
+            cursor.execute(f'''
+                SELECT session_id, {", ".join(CYCLE_TABLE_COLUMNS)} FROM cycles
+                WHERE session_id BETWEEN ? AND ?
+                ORDER BY session_id, cycle_number
+            ''', (session_ids[0], session_ids[-1]))
+            return session_ids, [tuple(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Failed to read the sessions after ID {after_session_id}: {e}")
+        return None
+
+def save_rescored_batch(run_id, last_session_id, analyses):
+    """
+    Writes the new scores of a batch of sessions and the run's progress in one transaction.
+
+    Args:
+        run_id (int): The rescoring run.
+        last_session_id (int): The last session of the batch, where the run resumes.
+        analyses (list): (db_id, respiration_analysis) pairs; None removes a session's scores.
+
+    Returns:
+        bool: True if the batch was saved.
+    """
+    score_rows = [(db_id, _score_row(respiration_analysis)) for db_id, respiration_analysis in analyses]
+
+    try:
+        with transaction() as cursor:
+            cursor.executemany(_upsert_sql('scores', SCORE_COLUMNS), [(db_id, *row) for db_id, row in score_rows if row])
+            cursor.executemany('DELETE FROM scores WHERE session_id = ?', [(db_id,) for db_id, row in score_rows if not row])
+            cursor.executemany(f'''
+                UPDATE session_summaries SET {", ".join(f"{column} = ?" for column in SCORE_TABLE_COLUMNS)}
+                WHERE session_id = ?
+            ''', [(*(row[:len(SCORE_TABLE_COLUMNS)] if row else (None,) * len(SCORE_TABLE_COLUMNS)), db_id)
+                  for db_id, row in score_rows])
+            cursor.execute('''
+                UPDATE rescoring_runs
+                SET last_session_id = ?, sessions_rescored = sessions_rescored + ?, updated_at = ?
+                WHERE id = ?
+            ''', (last_session_id, len(analyses), datetime.now(), run_id))
+        return True
+    except sqlite3.Error as e:
+        print(f"Failed to save the rescored sessions up to ID {last_session_id}: {e}")
+        return False
+
+def finish_rescoring_run(run_id):
+    """Marks a rescoring run as finished."""
+    now = datetime.now()
+
+    try:
+        with transaction() as cursor:
+            cursor.execute('UPDATE rescoring_runs SET finished_at = ?, updated_at = ? WHERE id = ?', (now, now, run_id))
+        return True
+    except sqlite3.Error as e:
+        print(f"Failed to finish rescoring run {run_id}: {e}")
+        return False
+
+def create_job(job_id, session_folder_path, filename, participant_name=None):
+    """
+    Records a queued analysis job.
+
+    Returns:
+        bool: True if the job was recorded.
+    """
+    now = datetime.now()
+
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO analysis_jobs (
+                    id, status, stage, progress, filename, participant_name, session_folder, created_at, updated_at
+                )
+                VALUES (?, 'queued', 'queued', 0, ?, ?, ?, ?, ?)
+            ''', (job_id, filename, participant_name, session_folder_path, now, now))
+        return True
+    except sqlite3.Error as e:
+        print(f"Failed to create analysis job {job_id}: {e}")
+        return False
+
+def update_job(job_id, status, stage, progress, db_id=None, error=None):
+    """
+    Updates the status, stage and progress (0-100) of an analysis job.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+                UPDATE analysis_jobs
+                SET status = ?, stage = ?, progress = ?, db_id = COALESCE(?, db_id), error = ?, updated_at = ?
+                WHERE id = ?
+            ''', (status, stage, progress, db_id, error, datetime.now(), job_id))
+        return True
+    except sqlite3.Error as e:
+        print(f"Failed to update analysis job {job_id}: {e}")
+        return False
+
+def get_job(job_id):
+    """
+    Retrieves an analysis job.
+
+    Returns:
+        dict: The job's columns, or None if it does not exist.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.execute('SELECT * FROM analysis_jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Failed to retrieve analysis job {job_id}: {e}")
+        return None
+
+if __name__ == '__main__':
+    create_tables()
\ No newline at end of file
@@ -0,0 +1,465 @@
+import numpy as np
+import pandas as pd
+
+# Phase types in the order `identify_phase_intervals` reports them; codes index into this list
+PHASE_TYPES = ['inhalation', 'exhalation', 'apnea']
+PHASE_CODES = {phase: code for code, phase in enumerate(PHASE_TYPES)}
+CYCLE_PATTERN = [PHASE_CODES['inhalation'], PHASE_CODES['apnea'], PHASE_CODES['exhalation'], PHASE_CODES['apnea']]  # Phases of one respiratory cycle
+MIN_CAPACITY = 64  # Events the column buffers hold at least once a store grows
+GROWTH_FACTOR = 1.5  # Capacity growth when an insert does not fit, so reallocations are amortized
+
+
+class EventStore:
+    """
+    Respiratory phase events held in parallel arrays instead of a list of dictionaries.
+
+    Events keep the order they were given in (start order for everything produced by
+    the segmentation and by `relabel`). Times are stored as float64; whole-second
+    values are written back as integers, so `to_records` reproduces the JSON shape
+    the frontend and the session files use: [{'id', 'start', 'end', 'type'}, ...].
+
+    The columns are views of buffers with spare capacity. Edits work in place: a merge,
+    split or delete only moves the events after the first position it changes (one pass
+    per column), and the buffers are only reallocated when an insert does not fit. The
+    id index, the start order and the labels are kept up to date from that position on,
+    so an edit costs O(events after it) rather than O(all events).
+
+    Attributes:
+        ids (np.ndarray): Event ids (int64).
+        starts (np.ndarray): Start times in seconds (float64).
+        ends (np.ndarray): End times in seconds (float64).
+        codes (np.ndarray): Phase codes indexing into PHASE_TYPES (int8).
+    """
+
+    def __init__(self, ids=(), starts=(), ends=(), codes=()):
+        # The columns are copied, since edits write into them
+        self._assign(np.array(ids, dtype=np.int64), np.array(starts, dtype=np.float64),
+                     np.array(ends, dtype=np.float64), np.array(codes, dtype=np.int8))
+
+    @classmethod
+    def from_records(cls, events):
+        """
+        Builds a store from a list of event dictionaries (or returns `events` if it already is one).
+
+        Args:
+            events (list): Event dictionaries with 'id', 'start', 'end' and 'type' keys.
+
+        Returns:
+            EventStore: The events in the same order.
+        """
+        if isinstance(events, cls):
+            return events
+        return cls(
+            [event['id'] for event in events],
+            [event['start'] for event in events],
+            [event['end'] for event in events],
+            [PHASE_CODES.get(event['type'], -1) for event in events]
+        )
+
+    @classmethod
+    def from_phases(cls, starts, ends, codes):
+        """
+        Builds a store from segmented phases sorted by start time.
+
+        Ids are assigned grouping the phases by type (all inhalations, then all
+        exhalations, then all apneas, each in time order), the numbering sessions
+        have always used.
+        """
+        ids = np.empty(len(starts), dtype=np.int64)
+        ids[np.lexsort((starts, codes))] = np.arange(len(starts))
+        return cls(ids, starts, ends, codes)
+
+    def to_records(self):
+        """
+        Serializes the events to the list of dictionaries stored in the session JSON.
+
+        Returns:
+            list: Dictionaries with 'id', 'start', 'end' and 'type' keys.
+        """
+        types = [PHASE_TYPES[code] if code >= 0 else None for code in self.codes.tolist()]
+        return [{'id': i, 'start': s, 'end': e, 'type': t}
+                for i, s, e, t in zip(self.ids.tolist(), json_times(self.starts), json_times(self.ends), types)]
+
+    def to_frame(self):
+        """Returns the events as a DataFrame with one row per event, as used by the exports."""
+        return pd.DataFrame({
+            'Event_ID': self.ids,
+            'Type': self.types,
+            'Start_Time': json_times(self.starts),
+            'End_Time': json_times(self.ends),
+            'Duration': json_times(self.ends - self.starts)
+        })
+
+    @property
+    def ids(self):
+        return self._ids[:self._size]
+
+    @property
+    def starts(self):
+        return self._starts[:self._size]
+
+    @property
+    def ends(self):
+        return self._ends[:self._size]
+
+    @property
+    def codes(self):
+        return self._codes[:self._size]
+
+    @codes.setter
+    def codes(self, codes):
+        self._codes[:self._size] = codes
+        self._labeled_until = 0
+
+    @property
+    def types(self):
+        """Phase type name of every event."""
+        return [PHASE_TYPES[code] if code >= 0 else None for code in self.codes.tolist()]
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return iter(self.to_records())
+
+    def __eq__(self, other):
+        if not isinstance(other, EventStore):
+            other = EventStore.from_records(other)
+        return (np.array_equal(self.ids, other.ids) and np.array_equal(self.starts, other.starts)
+                and np.array_equal(self.ends, other.ends) and np.array_equal(self.codes, other.codes))
+
+    def copy(self):
+        return EventStore(self.ids, self.starts, self.ends, self.codes)
+
+    # --- Lookups ---
+
+    def position(self, event_id):
+        """
+        Returns the position of the event with `event_id`, or None if there is no such event.
+
+        The id index is a dense id -> position array, built on first use (one vectorized
+        scatter) and updated by every edit, so lookups are O(1).
+        """
+        if self._positions is None:
+            self._positions = np.full(self.next_id(), -1, dtype=np.int64)
+            self._positions[self.ids] = np.arange(self._size)
+        if not isinstance(event_id, (int, np.integer)) or not 0 <= event_id < len(self._positions):
+            return None
+        position = int(self._positions[event_id])
+        return position if position >= 0 else None
+
+    def get(self, event_id):
+        """Returns the event with `event_id` as a dictionary, or None if there is no such event."""
+        position = self.position(event_id)
+        if position is None:
+            return None
+        return {
+            'id': int(self.ids[position]),
+            'start': json_times(self.starts[position:position + 1])[0],
+            'end': json_times(self.ends[position:position + 1])[0],
+            'type': PHASE_TYPES[self.codes[position]] if self.codes[position] >= 0 else None
+        }
+
+    def interval_index(self):
+        """Returns the IntervalIndex of the events, built on first use and kept until the next edit."""
+        if self._interval_index is None:
+            self._interval_index = IntervalIndex(self.starts, self.ends)
+        return self._interval_index
+
+    def find_at(self, time):
+        """Returns the position of the event containing `time` in O(log n), or None."""
+        return self.interval_index().containing_point(time)
+
+    def overlapping(self, window_start, window_end):
+        """Returns the positions of the events overlapping [window_start, window_end), in order."""
+        return self.interval_index().overlapping(window_start, window_end)
+
+    def subset(self, positions):
+        """Returns a new store with the events at `positions`."""
+        return EventStore(self.ids[positions], self.starts[positions], self.ends[positions], self.codes[positions])
+
+    def next_id(self):
+        """Returns an id not used by any event (one above the current maximum)."""
+        if self._next_id is None:
+            self._next_id = int(self.ids.max()) + 1 if self._size else 0
+        return self._next_id
+
+    # --- Edits ---
+
+    def delete(self, event_ids):
+        """
+        Removes the events whose ids are in `event_ids`.
+
+        Returns:
+            int: The number of events removed.
+        """
+        removed = self._positions_of(event_ids)
+        if len(removed):
+            self._edit(removed, ())
+        return len(removed)
+
+    def merge(self, event_ids):
+        """
+        Replaces the events whose ids are in `event_ids` with a single event.
+
+        The new event spans from the earliest start to the end of the last selected
+        event (in start order), keeps the type of the first one and is placed where
+        a stable sort by start time would put it.
+
+        Returns:
+            int: The id of the merged event, or None if none of the ids exist.
+        """
+        selected = self._positions_of(event_ids)
+        if not len(selected):
+            return None
+        order = selected[np.argsort(self.starts[selected], kind='stable')]
+        first, last = order[0], order[-1]
+        new_id = self.next_id()
+        new_start, new_end, new_code = self.starts[first], self.ends[last], self.codes[first]
+
+        if self._is_sorted():
+            # After the events that remain and start at or before it; no selected event starts earlier
+            position = int(np.searchsorted(self.starts, new_start, side='right'))
+            position -= int(np.count_nonzero(self.starts[selected] <= new_start))
+        else:
+            position = self._size - len(selected)
+        self._edit(selected, [position], [new_id], [new_start], [new_end], [new_code])
+        return new_id
+
+    def split(self, event_id, split_time):
+        """
+        Splits an event in two at `split_time`; the second half gets a new id and the same type.
+
+        Returns:
+            int: The id of the second half, or None if there is no event with `event_id`.
+
+        Raises:
+            ValueError: If `split_time` is not strictly inside the event.
+        """
+        position = self.position(event_id)
+        if position is None:
+            return None
+        if not (self.starts[position] < split_time < self.ends[position]):
+            raise ValueError('Split time must be within the segment bounds')
+        new_id = self.next_id()
+        original_end = self.ends[position]
+        self.ends[position] = split_time
+        self._edit((), [position + 1], [new_id], [split_time], [original_end], [self.codes[position]])
+        return new_id
+
+    def relabel(self, pattern=CYCLE_PATTERN):
+        """
+        Sorts the events by start time and assigns types repeating `pattern`.
+
+        The sort is stable and skipped when the events are already in order, which
+        is the case after every edit above on a store that was in order.
+        """
+        if not self._is_sorted():
+            self._take(np.argsort(self.starts, kind='stable'))
+        # Events before the first edit since the last relabel with this pattern keep their types
+        pattern = np.asarray(pattern, dtype=np.int8)
+        labeled = self._labeled_until if np.array_equal(pattern, self._labeled_pattern) else 0
+        self._codes[labeled:self._size] = pattern[np.arange(labeled, self._size) % len(pattern)]
+        self._labeled_pattern, self._labeled_until = pattern, self._size
+        return self
+
+    def is_labeled(self, pattern=CYCLE_PATTERN):
+        """Returns whether the events are in start order and their types already repeat `pattern`."""
+        return self._is_sorted() and np.array_equal(self.codes, _tile_pattern(pattern, self._size))
+
+    def splice(self, remove_positions, insert_positions, inserted):
+        """
+        Removes the events at `remove_positions`, then inserts the events of `inserted` so
+        that they end up at `insert_positions` (ascending) of the resulting store.
+        """
+        self._edit(remove_positions, insert_positions, inserted.ids, inserted.starts, inserted.ends, inserted.codes)
+        return self
+
+    def _is_sorted(self):
+        # Only the events from the first one edited since the last check are compared
+        checked = max(self._sorted_until - 1, 0)
+        starts = self.starts[checked:]
+        if not np.all(starts[1:] >= starts[:-1]):
+            return False
+        self._sorted_until = self._size
+        return True
+
+    def _positions_of(self, event_ids):
+        """Returns the sorted positions of the events whose ids are in `event_ids`, ignoring unknown ids."""
+        positions = [self.position(event_id) for event_id in event_ids]
+        return np.array(sorted(position for position in positions if position is not None), dtype=np.int64)
+
+    def _assign(self, ids, starts, ends, codes):
+        self._ids, self._starts, self._ends, self._codes = ids, starts, ends, codes
+        self._size = len(ids)
+        self._positions = None
+        self._interval_index = None
+        self._next_id = None
+        self._sorted_until = 0
+        self._labeled_pattern, self._labeled_until = None, 0
+
+    def _take(self, index):
+        self._assign(self.ids[index], self.starts[index], self.ends[index], self.codes[index])
+
+    def _edit(self, remove_positions, insert_positions, ids=(), starts=(), ends=(), codes=()):
+        """
+        Removes the events at `remove_positions` and inserts new ones at `insert_positions`
+        (positions in the resulting store, ascending), in place.
+
+        Only the events from the first position affected onwards are moved, in one pass per column.
+        """
+        remove_positions = np.unique(np.asarray(remove_positions, dtype=np.int64))
+        insert_positions = np.asarray(insert_positions, dtype=np.int64)
+        if not len(remove_positions) and not len(insert_positions):
+            return
+        first = int(min(remove_positions[:1].tolist() + insert_positions[:1].tolist()))
+        kept = np.ones(self._size - first, dtype=bool)
+        kept[remove_positions - first] = False
+        new_size = self._size - len(remove_positions) + len(insert_positions)
+        inserted = np.zeros(new_size - first, dtype=bool)
+        inserted[insert_positions - first] = True
+
+        removed_ids = self._ids[remove_positions]
+        if new_size > len(self._ids):
+            capacity = max(MIN_CAPACITY, int(len(self._ids) * GROWTH_FACTOR), new_size)
+            self._ids, self._starts, self._ends, self._codes = (
+                _grown(buffer, self._size, capacity) for buffer in (self._ids, self._starts, self._ends, self._codes))
+        for buffer, values in ((self._ids, ids), (self._starts, starts), (self._ends, ends), (self._codes, codes)):
+            tail = np.empty(new_size - first, dtype=buffer.dtype)
+            tail[inserted] = values
+            tail[~inserted] = buffer[first:self._size][kept]
+            buffer[first:new_size] = tail
+        self._size = new_size
+        self._interval_index = None
+        self._sorted_until = min(self._sorted_until, first)
+        self._labeled_until = min(self._labeled_until, first)
+
+        if self._next_id is not None:
+            if len(removed_ids) and int(removed_ids.max()) + 1 == self._next_id:
+                self._next_id = None  # The highest id is gone; found again by the next call
+            elif len(ids):
+                self._next_id = max(self._next_id, int(np.max(ids)) + 1)
+        if self._positions is not None:
+            self._positions[removed_ids] = -1
+            moved = self.ids[first:]
+            if len(ids) and int(np.max(ids)) >= len(self._positions):
+                capacity = max(int(np.max(ids)) + 1, int(len(self._positions) * GROWTH_FACTOR))
+                self._positions = _grown(self._positions, len(self._positions), capacity, fill=-1)
+            self._positions[moved] = np.arange(first, new_size)
+
+
+
+class IntervalIndex:
+    """
+    Static index over [start, end) intervals for logarithmic time queries.
+
+    Intervals are kept sorted by start together with the running maximum of their
+    ends. Any interval that can reach a time t lies between the first position whose
+    running maximum passes t and the last position starting before t, and both
+    bounds are found by binary search. For non-overlapping intervals (the normal
+    case for events and cycles) that range holds at most one or two candidates, so
+    queries take O(log n). Positions returned refer to the order the intervals were
+    given in, and ties go to the earliest one.
+
+    Args:
+        starts (array-like): Interval start times.
+        ends (array-like): Interval end times.
+    """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        self._order = np.argsort(starts, kind='stable')
+        self._starts = starts[self._order]
+        self._ends = ends[self._order]
+        self._max_ends = np.maximum.accumulate(self._ends) if len(ends) else self._ends
+        self._disjoint = bool(np.all(self._starts[1:] >= self._ends[:-1]) and np.all(self._ends > self._starts))
+
+    def __len__(self):
+        return len(self._order)
+
+    def containing_point(self, time):
+        """
+        Returns the position of the first interval with start <= time < end, or None.
+        """
+        lo = int(np.searchsorted(self._max_ends, time, side='right'))
+        hi = int(np.searchsorted(self._starts, time, side='right'))
+        candidates = lo + np.flatnonzero(self._ends[lo:hi] > time)
+        if len(candidates) == 0:
+            return None
+        return int(self._order[candidates].min())
+
+    def overlapping(self, window_start, window_end):
+        """
+        Returns the positions of the intervals overlapping [window_start, window_end), sorted.
+        """
+        lo = int(np.searchsorted(self._max_ends, window_start, side='right'))
+        hi = int(np.searchsorted(self._starts, window_end, side='left'))
+        candidates = lo + np.flatnonzero(self._ends[lo:hi] > window_start)
+        return np.sort(self._order[candidates])
+
+    def containing(self, starts, ends):
+        """
+        For every query interval, finds the first indexed interval that fully contains it.
+
+        Args:
+            starts (array-like): Query start times.
+            ends (array-like): Query end times.
+
+        Returns:
+            np.ndarray: Position of the containing interval per query, -1 where there is none.
+        """
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        result = np.full(len(starts), -1, dtype=np.int64)
+        if len(self._order) == 0 or len(starts) == 0:
+            return result
+
+        if self._disjoint:
+            # Only the last interval starting at or before the query can contain it, or the
+            # one before it when that one ends exactly where a zero-length query starts
+            last = np.searchsorted(self._starts, starts, side='right') - 1
+            for candidate in (last, last - 1):
+                valid = candidate >= 0
+                safe = np.where(valid, candidate, 0)
+                found = valid & (self._starts[safe] <= starts) & (ends <= self._ends[safe])
+                position = np.where(found, self._order[safe], -1)
+                result = np.where((position >= 0) & ((result < 0) | (position < result)), position, result)
+            return result
+
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            lo = int(np.searchsorted(self._max_ends, end, side='left'))
+            hi = int(np.searchsorted(self._starts, start, side='right'))
+            candidates = lo + np.flatnonzero(self._ends[lo:hi] >= end)
+            if len(candidates):
+                result[i] = self._order[candidates].min()
+        return result
+
+
+def _grown(buffer, size, capacity, fill=None):
+    """Returns a buffer of `capacity` elements starting with the first `size` of `buffer`."""
+    grown = np.empty(capacity, dtype=buffer.dtype) if fill is None else np.full(capacity, fill, dtype=buffer.dtype)
+    grown[:size] = buffer[:size]
+    return grown
+
+
+def _tile_pattern(pattern, length):
+    pattern = np.asarray(pattern, dtype=np.int8)
+    return np.tile(pattern, length // len(pattern) + 1)[:length]
+
+
+def json_times(times):
+    """
+    Converts an array of times to a list, writing whole seconds as integers.
+
+    Args:
+        times (np.ndarray): Times in seconds.
+
+    Returns:
+        list: Python ints for whole values and floats otherwise.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    whole = np.mod(times, 1) == 0
+    if whole.all():
+        return times.astype(np.int64).tolist()
+    return [int(t) if w else t for t, w in zip(times.tolist(), whole.tolist())]
@@ -0,0 +1,382 @@
+"""
+Append-only operation log of a session's edits, used for undo and redo.
+
+Each edit is recorded as a small delta (the events it removed and added, with their
+positions) instead of a copy of the whole session document. The session cache keeps
+the log in memory and appends new entries to `operations.jsonl` in the session folder
+when it flushes the session. There is one JSON object per line:
+
+    {"op": "snapshot", "document": {...}, ...}      the whole document (events stored column-wise),
+                                                    the undo/redo stacks and the version
+    {"op": "edit", "name": "merge", ...}             events removed and added by /merge, /delete or /split
+    {"op": "document", "name": "recalculate", ...}   document keys replaced by /recalculate
+    {"op": "undo"}, {"op": "redo"}
+
+A snapshot is written when the log starts and then every SNAPSHOT_INTERVAL entries.
+It holds everything the entries before it did, so the file is started again from each
+snapshot: loading a session reads and replays at most SNAPSHOT_INTERVAL entries, and
+the file does not grow with the session's history. The undo history keeps the last
+MAX_UNDO_DEPTH operations, so the memory and disk used by a session stay bounded.
+"""
+import json
+import os
+
+import numpy as np
+
+from event_store import EventStore, CYCLE_PATTERN, json_times
+from session_store import without_arrays
+
+OPERATIONS_FILENAME = 'operations.jsonl'
+SNAPSHOT_INTERVAL = 50  # Log entries between two snapshots of the session document
+MAX_UNDO_DEPTH = 100  # Operations that can be undone; older ones are forgotten
+EVENT_LIST_KEYS = ('events', 'original_events')
+DERIVED_KEYS = ('cycle_events',)  # Rebuilt from the events by every edit response, so never logged
+
+
+def operations_path(session_folder):
+    """Returns the path of the session's operation log."""
+    return os.path.join(session_folder, OPERATIONS_FILENAME)
+
+
+def edit_operation(name, before, after, pattern=CYCLE_PATTERN):
+    """
+    Describes an event edit as the events it removed and added.
+
+    Events present in both stores with the same bounds are left out, so a merge, split
+    or delete only records the handful of events it touched. Types are not stored for
+    the other events: the edit endpoints relabel with `pattern`, and the previous types
+    are only kept when they did not follow it yet (the first edit after a detection).
+
+    Args:
+        name (str): Name of the edit, for reading the log.
+        before (EventStore): The events before the edit.
+        after (EventStore): The events after the edit (relabeled).
+        pattern (list): The cycle pattern `after` was relabeled with.
+
+    Returns:
+        dict: The log entry.
+    """
+    order = np.argsort(after.ids, kind='stable')
+    found = np.minimum(np.searchsorted(after.ids[order], before.ids), max(len(after) - 1, 0))
+    match_positions = order[found] if len(after) else np.zeros(len(before), dtype=np.int64)
+    kept = np.zeros(len(before), dtype=bool)
+    if len(after):
+        kept = ((after.ids[match_positions] == before.ids)
+                & (after.starts[match_positions] == before.starts) & (after.ends[match_positions] == before.ends))
+    kept_after = match_positions[kept]
+    if np.any(np.diff(kept_after) <= 0):
+        # The edit reordered the events it kept, so it is recorded as a full replacement
+        kept[:] = False
+        kept_after = kept_after[:0]
+    added = np.ones(len(after), dtype=bool)
+    added[kept_after] = False
+
+    operation = {
+        'op': 'edit',
+        'name': name,
+        'removed': _positioned_events(before, np.flatnonzero(~kept)),
+        'added': _positioned_events(after, np.flatnonzero(added))
+    }
+    if not before.is_labeled(pattern):
+        operation['types_before'] = before.codes.tolist()
+    return operation
+
+
+def document_operation(name, before, after):
+    """
+    Describes a change of whole document keys (as made by /recalculate).
+
+    Args:
+        name (str): Name of the change, for reading the log.
+        before (dict): The session document before the change.
+        after (dict): The session document after the change.
+
+    Returns:
+        dict: The log entry, holding the new and previous value of every key that changed.
+    """
+    before, after = _loggable(before), _loggable(after)
+    changed = [key for key in set(before) | set(after) if before.get(key, _MISSING) != after.get(key, _MISSING)]
+    return {
+        'op': 'document',
+        'name': name,
+        'set': {key: after[key] for key in changed if key in after},
+        'previous': {key: before[key] for key in changed if key in before}
+    }
+
+
+def apply_operation(analysis_data, operation, inverse=False, pattern=CYCLE_PATTERN):
+    """
+    Applies a logged operation (or undoes it, with `inverse`) to a session document in place.
+    """
+    if operation['op'] == 'document':
+        new, old = (operation['previous'], operation['set']) if inverse else (operation['set'], operation['previous'])
+        for key in old:
+            if key not in new:
+                analysis_data.pop(key, None)
+        analysis_data.update(new)
+        return
+
+    drop, insert = (operation['added'], operation['removed']) if inverse else (operation['removed'], operation['added'])
+    events = EventStore.from_records(analysis_data['events']).copy()
+    events.splice(drop['positions'], insert['positions'], EventStore.from_records(insert['events']))
+    if inverse and 'types_before' in operation:
+        events.codes = np.asarray(operation['types_before'], dtype=np.int8)
+    else:
+        events.relabel(pattern)
+    analysis_data['events'] = events.to_records()
+
+
+def event_patch(operation, inverse=False):
+    """
+    Returns the change an operation (or its inverse) makes to the event list, for clients
+    holding a copy of it.
+
+    Returns:
+        dict: 'removed' positions (before the change) and 'added' {'positions', 'events'}
+              (after it); the types of all events then follow the cycle pattern. None when
+              the change is not an event edit or does not end with relabeled events.
+    """
+    if operation['op'] != 'edit' or (inverse and 'types_before' in operation):
+        return None
+    drop, insert = (operation['added'], operation['removed']) if inverse else (operation['removed'], operation['added'])
+    return {'removed': drop['positions'], 'added': insert}
+
+
+def event_delta(operation, inverse=False):
+    """
+    Returns how many events an operation (or its inverse) adds to the event list, or None
+    when it replaces the document's event lists (they must be counted again).
+    """
+    if operation['op'] != 'edit':
+        return None
+    delta = len(operation['added']['events']) - len(operation['removed']['events'])
+    return -delta if inverse else delta
+
+
+def first_changed_event(operation):
+    """
+    Returns the position of the first event an operation (or its inverse) changes: the
+    events before it keep their position, bounds and type.
+    """
+    if operation['op'] != 'edit' or 'types_before' in operation:
+        # A document change replaces every event, and the types of every event differ before the first edit
+        return 0
+    return min(operation['removed']['positions'] + operation['added']['positions'], default=0)
+
+
+class OperationLog:
+    """
+    Undo/redo history of one session.
+
+    Attributes:
+        done (list): Operations that can be undone, the next one to undo last.
+        undone (list): Operations that can be redone, the next one to redo last.
+        pending (list): Log entries not yet appended to the file.
+        version (int): Number of entries ever logged; it grows with every change of the session.
+    """
+
+    def __init__(self):
+        self.done = []
+        self.undone = []
+        self.pending = []
+        self.since_snapshot = 0
+        self.version = 0
+        self._event_count = 0
+
+    @classmethod
+    def start(cls, analysis_data):
+        """Returns an empty history whose log starts with a snapshot of `analysis_data`."""
+        history = cls()
+        history._append(history._snapshot(analysis_data), analysis_data)
+        return history
+
+    @property
+    def can_undo(self):
+        return bool(self.done)
+
+    @property
+    def can_redo(self):
+        return bool(self.undone)
+
+    def record(self, operation, analysis_data):
+        """
+        Adds an operation that was just applied to `analysis_data`; the redo history is discarded.
+        """
+        self.done.append(operation)
+        self._event_count += _operation_event_count(operation)
+        # Each operation is dropped once, so this stays O(1) per edit on average
+        self._event_count -= sum(_operation_event_count(undone) for undone in self.undone)
+        self.undone.clear()
+        if len(self.done) > MAX_UNDO_DEPTH:
+            self._event_count -= sum(_operation_event_count(dropped) for dropped in self.done[:-MAX_UNDO_DEPTH])
+            del self.done[:-MAX_UNDO_DEPTH]
+        self._append(operation, analysis_data)
+
+    def undo(self, analysis_data):
+        """
+        Reverts the last operation on `analysis_data`.
+
+        Returns:
+            dict: The operation reverted, or None if there was nothing to undo.
+        """
+        if not self.done:
+            return None
+        operation = self.done.pop()
+        apply_operation(analysis_data, operation, inverse=True)
+        self.undone.append(operation)
+        self._append({'op': 'undo'}, analysis_data)
+        return operation
+
+    def redo(self, analysis_data):
+        """
+        Applies the last undone operation to `analysis_data` again.
+
+        Returns:
+            dict: The operation applied again, or None if there was nothing to redo.
+        """
+        if not self.undone:
+            return None
+        operation = self.undone.pop()
+        apply_operation(analysis_data, operation)
+        self.done.append(operation)
+        self._append({'op': 'redo'}, analysis_data)
+        return operation
+
+    def event_count(self):
+        """Returns the number of events held by the history, to estimate its memory use."""
+        return self._event_count
+
+    def _append(self, entry, analysis_data):
+        self.pending.append(entry)
+        self.version += 1
+        if entry['op'] == 'snapshot':
+            self.since_snapshot = 0
+            return
+        self.since_snapshot += 1
+        if self.since_snapshot >= SNAPSHOT_INTERVAL:
+            self._append(self._snapshot(analysis_data), analysis_data)
+
+    def _snapshot(self, analysis_data):
+        # The version is the one the snapshot itself gets when it is appended
+        return dict(_snapshot(analysis_data), done=list(self.done), undone=list(self.undone), version=self.version + 1)
+
+    def _restore(self, snapshot):
+        """Takes the undo/redo stacks and version from a snapshot (and the entries before it)."""
+        self.done = list(snapshot.get('done', self.done))[-MAX_UNDO_DEPTH:]
+        self.undone = list(snapshot.get('undone', self.undone))
+        self.version = snapshot.get('version', self.version)
+        self._event_count = sum(_operation_event_count(operation) for operation in self.done + self.undone)
+
+
+def append_operations(session_folder, history):
+    """
+    Appends the pending entries of `history` to the session's log file, or starts the file
+    again from the last pending snapshot.
+    """
+    if not history.pending:
+        return
+    snapshots = [i for i, entry in enumerate(history.pending) if entry['op'] == 'snapshot']
+    lines = ''.join(json.dumps(entry) + '\n' for entry in history.pending[snapshots[-1] if snapshots else 0:])
+    log_path = operations_path(session_folder)
+    if snapshots:
+        # The snapshot replaces the whole previous log at once, so a crash leaves either file complete
+        temp_path = log_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(lines)
+        os.replace(temp_path, log_path)
+    else:
+        with open(log_path, 'a') as f:
+            f.write(lines)
+    history.pending = []
+
+
+def load_operation_log(session_folder):
+    """
+    Rebuilds a session from its operation log.
+
+    The document, undo/redo stacks and version come from the last snapshot, and the
+    entries after it are replayed, so loading costs O(entries since the last snapshot).
+    Logs written before snapshots held the stacks have them rebuilt from every entry.
+
+    Returns:
+        tuple: (analysis_data, OperationLog), or (None, None) if the session has no log.
+    """
+    log_path = operations_path(session_folder)
+    if not os.path.exists(log_path):
+        return None, None
+
+    entries = []
+    with open(log_path, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line cut short by a crash in the middle of an append; the edit it held is lost
+                break
+    snapshots = [i for i, entry in enumerate(entries) if entry['op'] == 'snapshot']
+    if not snapshots:
+        return None, None
+    last_snapshot = snapshots[-1]
+
+    history = OperationLog()
+    analysis_data = None
+    first = last_snapshot if 'done' in entries[last_snapshot] else 0
+    for i, entry in enumerate(entries[first:], first):
+        if i == last_snapshot:
+            analysis_data = _unpack_document(entry['document'])
+            history._restore(dict(entry, version=entry.get('version', i + 1)))
+            continue
+        if entry['op'] in ('edit', 'document'):
+            history.done.append(entry)
+            history.undone.clear()
+            if analysis_data is not None:
+                apply_operation(analysis_data, entry)
+        elif entry['op'] == 'undo' and history.done:
+            history.undone.append(history.done.pop())
+            if analysis_data is not None:
+                apply_operation(analysis_data, history.undone[-1], inverse=True)
+        elif entry['op'] == 'redo' and history.undone:
+            history.done.append(history.undone.pop())
+            if analysis_data is not None:
+                apply_operation(analysis_data, history.done[-1])
+    history.since_snapshot = len(entries) - 1 - last_snapshot
+    history.version += history.since_snapshot
+    history._restore({})
+    return analysis_data, history
+
+
+_MISSING = object()
+
+
+def _loggable(analysis_data):
+    return {key: value for key, value in without_arrays(analysis_data).items() if key not in DERIVED_KEYS}
+
+
+def _positioned_events(events, positions):
+    return {'positions': positions.tolist(), 'events': events.subset(positions).to_records()}
+
+
+def _operation_event_count(operation):
+    if operation['op'] == 'edit':
+        return len(operation['removed']['events']) + len(operation['added']['events'])
+    return sum(len(operation[side][key]) for side in ('set', 'previous') for key in EVENT_LIST_KEYS if key in operation[side])
+
+
+def _snapshot(analysis_data):
+    # Event lists are stored as columns, which is about half the size of the records
+    document = _loggable(analysis_data)
+    for key in EVENT_LIST_KEYS:
+        if key in document:
+            events = EventStore.from_records(document[key])
+            document[key] = {'id': events.ids.tolist(), 'start': json_times(events.starts),
+                             'end': json_times(events.ends), 'code': events.codes.tolist()}
+    return {'op': 'snapshot', 'document': document}
+
+
+def _unpack_document(document):
+    analysis_data = dict(document)
+    for key in EVENT_LIST_KEYS:
+        if key in analysis_data:
+            columns = analysis_data[key]
+            analysis_data[key] = EventStore(columns['id'], columns['start'], columns['end'], columns['code']).to_records()
+    return analysis_data
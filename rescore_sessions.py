@@ -0,0 +1,150 @@
+"""
+Rescores every saved session after the scoring configuration changed.
+
+The scores stored with each session were computed with the `CONFIG` of the day; after
+its targets or weights are tuned they are stale until the session is edited. This
+command recomputes them for the whole database from the stored cycles (the cycles
+depend only on the events, not on the scoring configuration):
+
+- sessions are read in id order, BATCH_SIZE at a time, so memory use does not grow
+  with the database;
+- each batch is scored at once by `score_sessions` (grouped NumPy reductions instead
+  of one `analyze_respiration` DataFrame per session);
+- the new scores and the run's progress are written in one transaction per batch.
+
+The scores equal those `analyze_respiration` gives the same cycles. Scores saved by
+versions that summed the cycles table with pandas may move by up to SCORE_TOLERANCE
+(one hundredth) without any configuration change, from the different float rounding.
+
+An interrupted run resumes after its last saved batch when the command is run again
+with the same configuration. Run it with the server stopped (or restart the server
+with the new CONFIG first), so open sessions do not write back scores of the old one.
+
+Usage:
+    python rescore_sessions.py [--config overrides.json] [--batch-size 500] [--restart]
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+
+import numpy as np
+
+from analisis_audio import CONFIG, score_sessions
+from database import create_tables, start_rescoring_run, get_cycles_batch, save_rescored_batch, finish_rescoring_run
+
+BATCH_SIZE = 500  # Sessions read, scored and written per transaction
+
+
+def scoring_config(custom_config=None):
+    """Returns the configuration the sessions are scored with: CONFIG with the overrides applied."""
+    final_config = CONFIG.copy()
+    if custom_config:
+        final_config.update(custom_config)
+    return final_config
+
+
+def config_key(final_config):
+    """Returns a digest identifying a scoring configuration, under which its run is resumed."""
+    return hashlib.sha1(json.dumps(final_config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def rescore_batch(session_ids, cycle_rows, custom_config=None):
+    """
+    Scores a batch of sessions from their cycles.
+
+    Args:
+        session_ids (list): The sessions of the batch.
+        cycle_rows (list): (session_id, inhalation, apnea_1, exhalation, apnea_2, total) rows,
+            grouped by session as `get_cycles_batch` returns them.
+        custom_config (dict, optional): Overrides of CONFIG.
+
+    Returns:
+        list: (db_id, respiration_analysis) pairs for every session of the batch; sessions
+              without cycles get None, as `analyze_respiration` gives them.
+    """
+    rows = np.array(cycle_rows, dtype=np.float64).reshape(-1, 6)
+    cycle_sessions = rows[:, 0].astype(np.int64)
+    scored_ids, offsets = np.unique(cycle_sessions, return_index=True)
+    analyses = dict(zip(scored_ids.tolist(), score_sessions(rows[:, 1:], offsets, custom_config)))
+    return [(db_id, analyses.get(db_id)) for db_id in session_ids]
+
+
+def run_rescoring(custom_config=None, batch_size=BATCH_SIZE, restart=False):
+    """
+    Rescores the saved sessions in batches, resuming the unfinished run of the same configuration.
+
+    Args:
+        custom_config (dict, optional): Overrides of CONFIG.
+        batch_size (int): Sessions read, scored and written per transaction.
+        restart (bool): Rescore from the first session even if a run can be resumed.
+
+    Returns:
+        dict: The run id, the sessions and cycles rescored by this call, the sessions already
+              rescored by an earlier call of the run, and the elapsed time.
+    """
+    final_config = scoring_config(custom_config)
+    run = start_rescoring_run(config_key(final_config), json.dumps(final_config, sort_keys=True), restart)
+    if run is None:
+        raise RuntimeError("Could not start the rescoring run.")
+
+    stats = {'run_id': run['id'], 'resumed': run['sessions_rescored'], 'sessions': 0, 'cycles': 0, 'elapsed': 0.0}
+    last_session_id = run['last_session_id']
+    start_time = time.perf_counter()
+    try:
+        while True:
+            batch = get_cycles_batch(last_session_id, batch_size)
+            if batch is None:
+                raise RuntimeError("Could not read the sessions from the database.")
+            session_ids, cycle_rows = batch
+            if not session_ids:
+                break
+            analyses = rescore_batch(session_ids, cycle_rows, final_config)
+            if not save_rescored_batch(run['id'], session_ids[-1], analyses):
+                raise RuntimeError("Could not save the new scores to the database.")
+            last_session_id = session_ids[-1]
+            stats['sessions'] += len(session_ids)
+            stats['cycles'] += len(cycle_rows)
+            elapsed = max(time.perf_counter() - start_time, 1e-9)
+            print(f"Rescored {stats['resumed'] + stats['sessions']} session(s), up to ID {last_session_id} "
+                  f"({stats['sessions'] / elapsed:.0f} sessions/s)")
+        finish_rescoring_run(run['id'])
+    finally:
+        stats['elapsed'] = time.perf_counter() - start_time
+    return stats
+
+
+def print_stats(stats):
+    """Prints the counts and throughput of a rescoring run."""
+    elapsed = max(stats['elapsed'], 1e-9)
+    resumed = f" (resumed after {stats['resumed']} session(s))" if stats['resumed'] else ""
+    print(f"\nRun {stats['run_id']}: {stats['sessions']} session(s) and {stats['cycles']} cycle(s) "
+          f"rescored in {stats['elapsed']:.2f} s{resumed}")
+    if stats['sessions']:
+        print(f"Throughput: {stats['sessions'] / elapsed:.0f} sessions/s, {stats['cycles'] / elapsed:.0f} cycles/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rescore every saved session with the current scoring configuration.")
+    parser.add_argument('--config', help="JSON file with overrides of CONFIG (same keys, e.g. TARGET_IE_RATIO)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Sessions read, scored and written per transaction")
+    parser.add_argument('--restart', action='store_true', help="Rescore from the first session instead of resuming")
+    args = parser.parse_args(argv)
+
+    custom_config = None
+    if args.config:
+        with open(args.config, 'r') as f:
+            custom_config = json.load(f)
+    create_tables()
+    try:
+        stats = run_rescoring(custom_config, max(1, args.batch_size), args.restart)
+    except KeyboardInterrupt:
+        print("\nInterrupted; run the same command again to resume.")
+        return 130
+    print_stats(stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
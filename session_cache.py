@@ -0,0 +1,280 @@
+"""
+In-process LRU cache of session state with write-behind persistence.
+
+Edits change the cached session document and return immediately. A background
+thread writes dirty sessions to disk (new operation log entries and the session
+document) and SQLite (cycles, scores, events) every SESSION_FLUSH_SECONDS,
+coalescing all the edits made in between into a single write. Sessions are always flushed before
+they are evicted and when the process exits.
+
+Evicted sessions are queued for the background thread rather than flushed by the
+request that evicted them: that request holds its own session's lock, and flushing
+takes the evicted session's lock, so two requests evicting each other's sessions
+would deadlock. Until its flush is done, a queued session is still returned by `get`.
+
+The cache lives in the memory of one process, which matches how the app is run
+(`python app.py`). Running several worker processes would need a shared store.
+"""
+import atexit
+import threading
+from collections import OrderedDict
+
+from database import get_analysis_details, update_analysis_in_db
+from operation_log import OperationLog, append_operations, load_operation_log, event_delta
+from session_store import load_session, save_session
+
+SESSION_CACHE_BYTES = 64 * 1024 * 1024  # Memory budget for cached sessions
+SESSION_FLUSH_SECONDS = 2.0  # Delay before dirty sessions are written to disk and SQLite
+EVENT_BYTES = 400  # Approximate memory used by one event dictionary
+SESSION_OVERHEAD_BYTES = 4096  # Approximate memory used by a session's metadata
+SESSION_EVENT_KEYS = ('events', 'original_events', 'cycle_events')  # Event lists of a session document
+
+
+class CachedSession:
+    """
+    Decoded state of one session.
+
+    Attributes:
+        db_id (int): The session id in SQLite.
+        details (dict): 'session_folder_path' and 'audio_filename', as returned by `get_analysis_details`.
+        analysis_data (dict): The session document (events and metadata, without arrays).
+        history (OperationLog): The undo/redo history of the session.
+        view (dict): Cycles and scoring statistics of the last response, updated edit by edit and used to send deltas.
+        lock (threading.RLock): Held while the session is edited or flushed.
+    """
+
+    def __init__(self, db_id, details, analysis_data, history=None):
+        self.db_id = db_id
+        self.details = details
+        self.analysis_data = analysis_data
+        self.history = history or OperationLog.start(analysis_data)
+        self.view = None
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.pending_db = None
+        self.size = 0
+        self.event_count = 0  # Events of the document counted in `size`
+
+    @property
+    def session_folder(self):
+        return self.details['session_folder_path']
+
+
+class SessionCache:
+    """
+    LRU cache of `CachedSession` objects keyed by db_id, bounded by an approximate memory budget.
+
+    Args:
+        max_bytes (int): Memory budget; least recently used sessions are flushed and evicted beyond it.
+        flush_seconds (float): Interval of the background flush.
+    """
+
+    def __init__(self, max_bytes=SESSION_CACHE_BYTES, flush_seconds=SESSION_FLUSH_SECONDS):
+        self.max_bytes = max_bytes
+        self.flush_seconds = flush_seconds
+        self._entries = OrderedDict()
+        self._evicted = OrderedDict()  # Evicted sessions waiting for the background flush, by db_id
+        self._lock = threading.RLock()
+        self._bytes = 0
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'flushes': 0}
+        self._stop = threading.Event()
+        self._flusher = None
+        atexit.register(self.close)
+
+    # --- Reads ---
+
+    def get(self, db_id):
+        """
+        Returns the cached session for `db_id`, loading it from SQLite and disk on a miss.
+
+        Returns:
+            CachedSession: The session, or None if `db_id` does not exist.
+        """
+        try:
+            # Ids arrive as ints from routes and as whatever the client sent in JSON bodies
+            db_id = int(db_id)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            entry = self._entries.get(db_id)
+            if entry is not None:
+                self._entries.move_to_end(db_id)
+                self._counters['hits'] += 1
+                return entry
+            self._counters['misses'] += 1
+            # An evicted session whose changes are not on disk yet comes back as it is
+            entry = self._evicted.pop(db_id, None)
+        if entry is not None:
+            entry.size = 0  # Counted again in the cache's memory use by _insert
+            return self._insert(entry)
+
+        details = get_analysis_details(db_id)
+        if not details:
+            return None
+        session_folder = details['session_folder_path']
+        # The operation log, when there is one, holds the latest state and the undo history
+        analysis_data, history = load_operation_log(session_folder)
+        if analysis_data is None:
+            analysis_data = load_session(session_folder)
+        entry = CachedSession(db_id, details, analysis_data, history)
+        # Another request may have loaded the same session meanwhile
+        return self._insert(entry)
+
+    def add(self, db_id, details, analysis_data):
+        """Caches a session that was just created and persisted."""
+        return self._insert(CachedSession(int(db_id), details, analysis_data))
+
+    # --- Writes ---
+
+    def record(self, entry, operation):
+        """Adds an operation (from `edit_operation` or `document_operation`) already applied to the session."""
+        entry.history.record(operation, entry.analysis_data)
+        self._resize(entry, event_delta(operation))
+
+    def undo(self, entry):
+        """
+        Reverts the last operation of the session.
+
+        Returns:
+            dict: The operation reverted, or None if there was nothing to undo.
+        """
+        return self._step(entry, entry.history.undo, inverse=True)
+
+    def redo(self, entry):
+        """
+        Applies the last undone operation of the session again.
+
+        Returns:
+            dict: The operation applied again, or None if there was nothing to redo.
+        """
+        return self._step(entry, entry.history.redo)
+
+    def mark_dirty(self, entry, df_table=None, respiration_analysis=None, document=True):
+        """
+        Schedules the session for the next background flush.
+
+        Args:
+            entry (CachedSession): The edited session.
+            df_table (pd.DataFrame or callable, optional): Cycles table to store in SQLite, or a
+                function building it, called at flush time (once for all the edits a flush writes).
+            respiration_analysis (dict, optional): Scores to store in SQLite.
+            document (bool): Whether the session document changed (False when only scores did).
+        """
+        if document:
+            entry.dirty = True
+        if df_table is not None:
+            entry.pending_db = (df_table, respiration_analysis)
+        with self._lock:
+            if self._entries.get(entry.db_id) is not entry:
+                # The session was evicted while it was being edited; the flush of evicted sessions writes it
+                self._evicted[entry.db_id] = entry
+        self._start_flusher()
+
+    def flush(self, entry):
+        """Writes the pending changes of one session to disk and SQLite."""
+        with entry.lock:
+            if not (entry.dirty or entry.pending_db):
+                return
+            # The log goes first: it is the record a half-finished flush is recovered from
+            append_operations(entry.session_folder, entry.history)
+            if entry.dirty:
+                save_session(entry.session_folder, entry.analysis_data)
+                entry.dirty = False
+            if entry.pending_db:
+                df_table, respiration_analysis = entry.pending_db
+                if callable(df_table):
+                    df_table = df_table()
+                update_analysis_in_db(entry.db_id, entry.analysis_data, df_table, respiration_analysis)
+                entry.pending_db = None
+        with self._lock:
+            self._counters['flushes'] += 1
+
+    def flush_all(self):
+        """Writes the pending changes of every cached session, evicted ones first."""
+        self.flush_evicted()
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            self.flush(entry)
+
+    def flush_evicted(self):
+        """Writes the pending changes of the evicted sessions and forgets them."""
+        with self._lock:
+            entries = list(self._evicted.values())
+        for entry in entries:
+            self.flush(entry)
+            with self._lock:
+                # Unless `get` brought it back into the cache meanwhile
+                if self._evicted.get(entry.db_id) is entry:
+                    del self._evicted[entry.db_id]
+
+    def close(self):
+        """Stops the background flush and writes everything still pending."""
+        self._stop.set()
+        self.flush_all()
+
+    def stats(self):
+        """Returns the hit/miss/eviction/flush counters and the current memory use."""
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), evicted_pending=len(self._evicted),
+                        bytes=self._bytes, max_bytes=self.max_bytes)
+
+    # --- Internals ---
+
+    def _insert(self, entry):
+        with self._lock:
+            existing = self._entries.get(entry.db_id)
+            if existing is not None:
+                return existing
+            self._entries[entry.db_id] = entry
+        self._resize(entry)
+        return entry
+
+    def _step(self, entry, step, inverse=False):
+        operation = step(entry.analysis_data)
+        if operation is not None:
+            self._resize(entry, event_delta(operation, inverse))
+        return operation
+
+    def _resize(self, entry, events_delta=None):
+        """
+        Updates the memory estimate of a session after its events changed by `events_delta`,
+        or from all its event lists when None (a new session, or lists replaced by /recalculate).
+        """
+        if events_delta is None:
+            entry.event_count = sum(len(entry.analysis_data.get(key, [])) for key in SESSION_EVENT_KEYS)
+        else:
+            entry.event_count += events_delta
+        size = SESSION_OVERHEAD_BYTES + EVENT_BYTES * (entry.event_count + entry.history.event_count())
+        with self._lock:
+            if self._entries.get(entry.db_id) is entry:
+                self._bytes += size - entry.size
+            entry.size = size
+            evicted = self._pop_over_budget()
+        if evicted:
+            # The caller may hold its own session's lock, so the flush is left to the background thread
+            self._start_flusher()
+
+    def _pop_over_budget(self):
+        # The most recently used session always stays, even if it alone exceeds the budget
+        evicted = []
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._counters['evictions'] += 1
+            self._evicted[entry.db_id] = entry
+            evicted.append(entry)
+        return evicted
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name='session-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_seconds):
+            try:
+                self.flush_all()
+            except Exception as e:
+                print(f"Background session flush failed: {e}")
@@ -0,0 +1,173 @@
+"""
+Session storage: a small mutable JSON document plus an immutable binary sidecar.
+
+Each session folder holds:
+    segmentation_data.json  events, original events and metadata; rewritten after edits
+    session_arrays.npz      the waveshow 'signal' and the 'envelope' arrays; written once
+                            per upload (they do not depend on the apnea threshold)
+    operations.jsonl        the log of edits used for undo and redo (see operation_log.py)
+
+Sessions saved before the split kept the arrays inside the JSON document. They are
+migrated the first time they are loaded, or in bulk with:
+
+    python session_store.py [results_folder]
+"""
+import json
+import os
+import sys
+
+import numpy as np
+
+from event_store import json_times
+
+SESSION_FILENAME = 'segmentation_data.json'
+SESSION_ARRAYS_FILENAME = 'session_arrays.npz'
+SESSION_ARRAY_KEYS = ('signal', 'envelope')
+ARRAY_FIELDS = {
+    'signal': ('t', 'min', 'max'),
+    'envelope': ('time', 'positive_mean', 'negative_mean')
+}
+TIME_FIELDS = {'t', 'time'}
+
+
+def session_json_path(session_folder):
+    """Returns the path of the session's JSON document."""
+    return os.path.join(session_folder, SESSION_FILENAME)
+
+
+def without_arrays(analysis_data):
+    """Returns a shallow copy of the analysis data without the signal and envelope arrays."""
+    return {key: value for key, value in analysis_data.items() if key not in SESSION_ARRAY_KEYS}
+
+
+def save_session(session_folder, analysis_data):
+    """
+    Saves the analysis data of a session.
+
+    The signal and envelope arrays, when present, go to the binary sidecar; everything
+    else is written as compact JSON, so edits only pay for the size of the events.
+
+    Args:
+        session_folder (str): The session folder.
+        analysis_data (dict): The analysis data, with or without the arrays.
+    """
+    if any(key in analysis_data for key in SESSION_ARRAY_KEYS):
+        save_session_arrays(session_folder, analysis_data)
+    _write_atomically(session_json_path(session_folder), lambda f: json.dump(without_arrays(analysis_data), f))
+
+
+def load_session(session_folder, with_arrays=False):
+    """
+    Loads the analysis data of a session, migrating the folder first if it uses the old format.
+
+    Args:
+        session_folder (str): The session folder.
+        with_arrays (bool): Also load the signal and envelope from the sidecar.
+
+    Returns:
+        dict: The analysis data.
+    """
+    with open(session_json_path(session_folder), 'r') as f:
+        analysis_data = json.load(f)
+    if any(key in analysis_data for key in SESSION_ARRAY_KEYS):
+        _migrate(session_folder, analysis_data)
+    if with_arrays:
+        analysis_data.update(load_session_arrays(session_folder))
+    return analysis_data
+
+
+def save_session_arrays(session_folder, analysis_data):
+    """
+    Writes the signal and envelope arrays of the analysis data to the session's sidecar.
+    """
+    arrays = {}
+    for key, fields in ARRAY_FIELDS.items():
+        for field in fields:
+            values = analysis_data.get(key, {}).get(field, [])
+            arrays[f'{key}_{field}'] = np.asarray(values, dtype=np.float64)
+    _write_atomically(os.path.join(session_folder, SESSION_ARRAYS_FILENAME), lambda f: np.savez(f, **arrays))
+
+
+def load_session_arrays(session_folder):
+    """
+    Reads the signal and envelope arrays of a session.
+
+    Returns:
+        dict: 'signal' and 'envelope' dictionaries of lists, in the shape the frontend and
+              the exports use, or an empty dict if the session has no sidecar.
+    """
+    arrays_path = os.path.join(session_folder, SESSION_ARRAYS_FILENAME)
+    if not os.path.exists(arrays_path):
+        return {}
+    with np.load(arrays_path) as data:
+        return {
+            key: {field: json_times(data[f'{key}_{field}']) if field in TIME_FIELDS else data[f'{key}_{field}'].tolist()
+                  for field in fields}
+            for key, fields in ARRAY_FIELDS.items()
+        }
+
+
+def read_session_array(session_folder, key):
+    """
+    Reads one array of the sidecar ('signal' or 'envelope') without converting it to lists.
+
+    Returns:
+        dict: The fields of the array as NumPy arrays, or None if the session has no sidecar.
+    """
+    arrays_path = os.path.join(session_folder, SESSION_ARRAYS_FILENAME)
+    if not os.path.exists(arrays_path):
+        return None
+    with np.load(arrays_path) as data:
+        return {field: data[f'{key}_{field}'] for field in ARRAY_FIELDS[key]}
+
+
+def migrate_session(session_folder):
+    """
+    Moves the arrays of an old-format session into the sidecar.
+
+    Returns:
+        bool: True if the folder was migrated, False if it already used the split format.
+    """
+    with open(session_json_path(session_folder), 'r') as f:
+        analysis_data = json.load(f)
+    if not any(key in analysis_data for key in SESSION_ARRAY_KEYS):
+        return False
+    _migrate(session_folder, analysis_data)
+    return True
+
+
+def _migrate(session_folder, analysis_data):
+    # The sidecar is written before the arrays leave the JSON document, so an
+    # interrupted migration never loses them
+    save_session_arrays(session_folder, analysis_data)
+    for key in SESSION_ARRAY_KEYS:
+        analysis_data.pop(key, None)
+    _write_atomically(session_json_path(session_folder), lambda f: json.dump(analysis_data, f))
+
+
+def _write_atomically(path, write):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb' if path.endswith('.npz') else 'w') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def migrate_results_folder(results_folder):
+    """
+    Migrates every session folder inside `results_folder`.
+
+    Returns:
+        int: The number of sessions migrated.
+    """
+    migrated = 0
+    for name in sorted(os.listdir(results_folder)):
+        session_folder = os.path.join(results_folder, name)
+        if os.path.isfile(session_json_path(session_folder)) and migrate_session(session_folder):
+            print(f"Migrated {session_folder}")
+            migrated += 1
+    return migrated
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1] if len(sys.argv) > 1 else 'results'
+    print(f"{migrate_results_folder(folder)} session(s) migrated.")
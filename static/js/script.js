@@ -15,6 +15,45 @@ document.addEventListener('DOMContentLoaded', function() {
     // as the 'loading-overlay' is hidden by default in the CSS.
     // No additional code is needed to hide it after the analysis.
 
+    // After an upload the analysis runs in the background: poll the job and open the results when it is done
+    const jobProgress = document.getElementById('job-progress');
+    if (jobProgress) {
+        const stageLabels = {
+            queued: 'Waiting in the queue',
+            decoding: 'Reading the audio',
+            segmenting: 'Detecting breathing phases',
+            saving: 'Saving the session',
+            done: 'Done'
+        };
+        const progressBar = document.getElementById('job-progress-bar');
+        const stageText = document.getElementById('job-stage');
+        const errorBox = document.getElementById('job-error');
+
+        function pollJob() {
+            fetch(jobProgress.dataset.statusUrl)
+                .then(response => response.json())
+                .then(job => {
+                    if (!job.success || job.status === 'failed') {
+                        progressBar.classList.remove('progress-bar-animated');
+                        errorBox.textContent = job.error || 'The analysis failed.';
+                        errorBox.style.display = 'block';
+                        return;
+                    }
+                    progressBar.style.width = `${job.progress}%`;
+                    progressBar.setAttribute('aria-valuenow', job.progress);
+                    progressBar.textContent = `${job.progress}%`;
+                    stageText.textContent = stageLabels[job.stage] || job.stage;
+                    if (job.status === 'done') {
+                        window.location.href = job.result_url;
+                    } else {
+                        setTimeout(pollJob, 1000);
+                    }
+                })
+                .catch(() => setTimeout(pollJob, 3000));
+        }
+        pollJob();
+    }
+
     // Check if analysis_data is available (passed from Flask)
     if (typeof analysis_data !== 'undefined' && analysis_data !== null) {
         // Set the value of the recalc input to the factor used in the analysis
@@ -26,9 +65,10 @@ document.addEventListener('DOMContentLoaded', function() {
         let data = analysis_data; // Use the global analysis_data
         let dbId = data.db_id;
         let events = data.events;
-        let signal = data.signal;
-        let envelope = data.envelope;
+        let envelope = null; // Loaded from the session's float32 buffer before the charts are drawn
+        let sessionVersion = data.version;
         let breathingChart, signalChart;
+        let waveformRequestId = 0;
         let audioPlayer = document.getElementById('audioPlayer'); // Get audio player reference
 
         // --- State variables ---
@@ -39,6 +79,7 @@ document.addEventListener('DOMContentLoaded', function() {
         // --- DOM Elements ---
         const btnRecalculate = document.getElementById('recalculate-button');
         const btnUndo = document.getElementById('undo-button');
+        const btnRedo = document.getElementById('redo-button');
         const btnMerge = document.getElementById('merge-button');
         const btnSplit = document.getElementById('split-button');
         const btnDelete = document.getElementById('delete-button');
@@ -54,14 +95,96 @@ document.addEventListener('DOMContentLoaded', function() {
 
         // --- Core Functions ---
 
+        /**
+         * Replaces the items [start, start + delete_count) of an array with new ones.
+         * Written without spread arguments, which overflow the call stack on long sessions.
+         */
+        function spliceItems(items, patch, newItems) {
+            return items.slice(0, patch.start).concat(newItems, items.slice(patch.start + patch.delete_count));
+        }
+
+        /**
+         * Builds one row of the cycles table.
+         */
+        function createCycleRow(values) {
+            const row = document.createElement('tr');
+            values.forEach(value => {
+                const cell = document.createElement('td');
+                cell.textContent = value;
+                row.appendChild(cell);
+            });
+            return row;
+        }
+
+        /**
+         * Renders the whole cycles table.
+         * @param {object} cycleTable The table's columns and rows.
+         */
+        function renderCycleTable(cycleTable) {
+            const table = document.createElement('table');
+            table.className = 'dataframe table table-striped';
+            const headerRow = table.createTHead().insertRow();
+            headerRow.style.textAlign = 'right';
+            cycleTable.columns.forEach(column => {
+                const header = document.createElement('th');
+                header.textContent = column;
+                headerRow.appendChild(header);
+            });
+            const body = table.createTBody();
+            cycleTable.rows.forEach(values => body.appendChild(createCycleRow(values)));
+            cyclesTableContainer.replaceChildren(table);
+        }
+
+        /**
+         * Replaces only the rows of the cycles table that changed.
+         */
+        function patchCycleTable(patch) {
+            const body = cyclesTableContainer.querySelector('tbody');
+            for (let i = 0; i < patch.delete_count; i++) {
+                body.deleteRow(patch.start);
+            }
+            const next = body.rows[patch.start] || null;
+            patch.rows.forEach(values => body.insertBefore(createCycleRow(values), next));
+        }
+
+        /**
+         * Applies a delta response to the events, cycle labels and cycles table held by the page.
+         * @param {object} delta The changes since the version the page holds.
+         */
+        function applyDelta(delta) {
+            // Positions refer to the event list before (removed) and after (added) the change
+            const removed = new Set(delta.events.removed);
+            events = events.filter((event, i) => !removed.has(i));
+            delta.events.added.positions.forEach((position, i) => events.splice(position, 0, delta.events.added.events[i]));
+            const pattern = delta.events.pattern;
+            events.forEach((event, i) => { event.type = pattern[i % pattern.length]; });
+            data.events = events;
+            data.cycle_events = spliceItems(data.cycle_events || [], delta.cycle_events, delta.cycle_events.items);
+            patchCycleTable(delta.cycle_rows);
+        }
+
+        /**
+         * Fetches the whole editable state of the session, when the page's copy is out of date.
+         */
+        async function fetchSession() {
+            const response = await fetch(`/session/${dbId}`);
+            return response.json();
+        }
+
         /**
          * Updates all UI components with new data from the server.
-         * @param {object} responseData The JSON data from the backend.
+         * @param {object} responseData The JSON data from the backend, either the whole session or a delta.
          */
         function updateUI(responseData) {
             // Update global data
-            data = responseData.analysis_data;
-            events = data.events;
+            if (responseData.delta) {
+                applyDelta(responseData.delta);
+            } else {
+                data = responseData.analysis_data;
+                events = data.events;
+                renderCycleTable(responseData.cycle_table);
+            }
+            sessionVersion = responseData.version;
 
             // Update analysis summary
             if (responseData.respiration_analysis) {
@@ -82,9 +205,6 @@ document.addEventListener('DOMContentLoaded', function() {
                 analysisContainer.innerHTML = '<p>No sufficient data to generate an analysis.</p>';
             }
 
-            // Update cycles table
-            cyclesTableContainer.innerHTML = responseData.table_html;
-
             // Update chart
             breathingChart.options.plugins.annotation.annotations = createAnnotations(events, data.cycle_events);
             breathingChart.update('none');
@@ -104,11 +224,12 @@ document.addEventListener('DOMContentLoaded', function() {
                 const response = await fetch(endpoint, {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(body)
+                    body: JSON.stringify({ ...body, version: sessionVersion })
                 });
                 const responseData = await response.json();
                 if (response.ok && responseData.success) {
-                    updateUI(responseData);
+                    // A delta only applies to the version it was computed from; otherwise resync
+                    updateUI(responseData.delta && responseData.base_version !== sessionVersion ? await fetchSession() : responseData);
                 } else {
                     alert(`Error: ${responseData.error || 'Unknown error'}`);
                 }
@@ -160,7 +281,10 @@ document.addEventListener('DOMContentLoaded', function() {
             }
 
             fetch('/undo', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ db_id: dbId, check: true }) })
-                .then(res => res.json()).then(data => { btnUndo.disabled = !data.undo_available; });
+                .then(res => res.json()).then(data => {
+                    btnUndo.disabled = !data.undo_available;
+                    btnRedo.disabled = !data.redo_available;
+                });
         }
 
         /**
@@ -195,6 +319,48 @@ document.addEventListener('DOMContentLoaded', function() {
             updateSelection();
         };
 
+        /**
+         * Fetches arrays served as a float32 buffer: the magic 'F32A', the header length
+         * (uint32), a JSON header naming the fields, then the values of each field.
+         * Float32Array reads the platform's byte order, which is little-endian in every browser.
+         * @param {string} url The buffer's URL.
+         * @returns {Promise<object>} The header and a Float32Array per field (views on the buffer).
+         */
+        async function fetchFloat32Arrays(url) {
+            const response = await fetch(url);
+            if (!response.ok) throw new Error(`Could not load ${url} (${response.status})`);
+            const buffer = await response.arrayBuffer();
+            if (new TextDecoder().decode(new Uint8Array(buffer, 0, 4)) !== 'F32A') throw new Error(`${url} is not a float32 buffer`);
+            const headerLength = new DataView(buffer).getUint32(4, true);
+            const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+            const arrays = {};
+            header.fields.forEach((field, i) => {
+                arrays[field] = new Float32Array(buffer, 8 + headerLength + i * header.length * 4, header.length);
+            });
+            return { header, arrays };
+        }
+
+        /**
+         * Loads the min/max waveform of the visible window from the session's pyramid.
+         * Only the bins needed for the chart width are transferred, at any zoom level.
+         */
+        async function loadWaveform(start, end) {
+            if (!signalChart) return;
+            const requestId = ++waveformRequestId;
+            const px = Math.max(1, Math.round(signalChart.width));
+            try {
+                const { header, arrays } = await fetchFloat32Arrays(`/waveform/${dbId}?start=${start}&end=${end}&px=${px}&format=binary`);
+                // Ignore responses superseded by a newer zoom
+                if (requestId !== waveformRequestId) return;
+                const toPoints = (values) => Array.from(values, (val, i) => ({ x: header.start + i * header.bin_seconds, y: val }));
+                signalChart.data.datasets[0].data = toPoints(arrays.max);
+                signalChart.data.datasets[1].data = toPoints(arrays.min);
+                signalChart.update('none');
+            } catch (error) {
+                console.error('Error loading waveform:', error);
+            }
+        }
+
         // --- Chart Initialization ---
         function initializeCharts() {
             try {
@@ -203,20 +369,21 @@ document.addEventListener('DOMContentLoaded', function() {
                 signalChart = new Chart(document.getElementById('signal-chart').getContext('2d'), {
                     type: 'line',
                     data: { datasets: [{
-                            label: 'Max Amplitude', data: signal.max.map((val, i) => ({ x: signal.t[i], y: val })), borderColor: 'rgba(128, 128, 128, 0.8)', backgroundColor: 'rgba(128, 128, 128, 0.8)', borderWidth: 1, pointRadius: 0, fill: 'origin'
+                            label: 'Max Amplitude', data: [], borderColor: 'rgba(128, 128, 128, 0.8)', backgroundColor: 'rgba(128, 128, 128, 0.8)', borderWidth: 1, pointRadius: 0, fill: 'origin'
                         }, {
-                            label: 'Min Amplitude', data: signal.min.map((val, i) => ({ x: signal.t[i], y: val })), borderColor: 'rgba(128, 128, 128, 0.8)', backgroundColor: 'rgba(128, 128, 128, 0.8)', borderWidth: 1, pointRadius: 0, fill: 'origin'
+                            label: 'Min Amplitude', data: [], borderColor: 'rgba(128, 128, 128, 0.8)', backgroundColor: 'rgba(128, 128, 128, 0.8)', borderWidth: 1, pointRadius: 0, fill: 'origin'
                         }]
                     },
                     options: { responsive: true, maintainAspectRatio: false, scales: { x: { ...baseAxisOptions, title: { display: false } }, y: { title: { display: false }, min: -1, max: 1, ticks: { callback: (val) => val.toFixed(2) } } }, plugins: { legend: { display: false } } }
                 });
+                loadWaveform(0, data.duration);
 
                 breathingChart = new Chart(document.getElementById('breathing-chart').getContext('2d'), {
                     type: 'line',
                     data: { datasets: [{
-                            label: 'Positive Envelope', data: envelope.positive_mean.map((val, i) => ({ x: envelope.time[i], y: val })), borderColor: 'blue', borderWidth: 1.5, pointRadius: 0
+                            label: 'Positive Envelope', data: Array.from(envelope.positive_mean, (val, i) => ({ x: envelope.time[i], y: val })), borderColor: 'blue', borderWidth: 1.5, pointRadius: 0
                         }, {
-                            label: 'Negative Envelope', data: envelope.negative_mean.map((val, i) => ({ x: envelope.time[i], y: val })), borderColor: 'purple', borderWidth: 1.5, pointRadius: 0
+                            label: 'Negative Envelope', data: Array.from(envelope.negative_mean, (val, i) => ({ x: envelope.time[i], y: val })), borderColor: 'purple', borderWidth: 1.5, pointRadius: 0
                         }]
                     },
                     options: {
@@ -266,6 +433,7 @@ document.addEventListener('DOMContentLoaded', function() {
         btnDelete.addEventListener('click', () => performAction('/delete', { db_id: dbId, segment_ids: Array.from(selectedPhaseIds) }));
         btnMerge.addEventListener('click', () => performAction('/merge', { db_id: dbId, segment_ids: Array.from(selectedPhaseIds) }));
         btnUndo.addEventListener('click', () => performAction('/undo', { db_id: dbId }));
+        btnRedo.addEventListener('click', () => performAction('/redo', { db_id: dbId }));
         btnRecalculate.addEventListener('click', () => {
             if (confirm('Are you sure you want to discard all changes and run the initial analysis again?')) {
                 const threshold = document.getElementById('apnea_threshold_recalc').value;
@@ -358,6 +526,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     chart.update('none');
                 }
             });
+            loadWaveform(signalChart.options.scales.x.min, signalChart.options.scales.x.max);
         }
         
         function handleZoomIn() {
@@ -388,6 +557,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     chart.update('none');
                 }
             });
+            loadWaveform(0, data.duration);
         }
 
         document.getElementById('zoom-in').addEventListener('click', handleZoomIn);
@@ -467,10 +637,33 @@ document.addEventListener('DOMContentLoaded', function() {
                     breathingChart.update('none');
                 }
             });
+
+            // Switches between the original recording and the compressed preview, keeping the playback position
+            const previewToggle = document.getElementById('preview-toggle');
+            if (previewToggle) {
+                const originalSrc = audioPlayer.querySelector('source').src;
+                const previewFormat = audioPlayer.canPlayType('audio/ogg; codecs="opus"') ? 'opus' : 'mp3';
+                previewToggle.addEventListener('change', () => {
+                    const position = audioPlayer.currentTime;
+                    const wasPlaying = !audioPlayer.paused;
+                    audioPlayer.src = previewToggle.checked ? `${previewToggle.dataset.previewSrc}?format=${previewFormat}` : originalSrc;
+                    audioPlayer.addEventListener('loadedmetadata', () => {
+                        audioPlayer.currentTime = position;
+                        if (wasPlaying) audioPlayer.play();
+                    }, { once: true });
+                });
+            }
         }
 
         // --- Initial Run ---
-        initializeCharts();
+        // The table is rendered from its rows so that later deltas can patch it row by row
+        if (data.cycle_table) renderCycleTable(data.cycle_table);
+        fetchFloat32Arrays(data.arrays.envelope)
+            .then(({ arrays }) => {
+                envelope = arrays;
+                initializeCharts();
+            })
+            .catch(error => alert(`Could not load the breathing envelope: ${error.message}`));
         updateButtonStates();
     }
 });
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import database  # noqa: E402
+
+PHASES = ['inhalation', 'apnea', 'exhalation', 'apnea']
+
+
+def synthetic_events(n_cycles, seed=0):
+    """Labeled events of `n_cycles` breaths, with durations rounded to 10 ms as the segmentation gives them."""
+    rng = np.random.default_rng(seed)
+    durations = rng.uniform([3, 0.5, 5, 0.5], [6, 3, 12, 4], size=(n_cycles, 4)).round(2).ravel()
+    ends = np.cumsum(durations).round(2)
+    starts = np.concatenate([[0], ends[:-1]])
+    return [{'id': i, 'start': float(s), 'end': float(e), 'type': PHASES[i % 4]}
+            for i, (s, e) in enumerate(zip(starts, ends))]
+
+
+def random_edit(rng, events):
+    """Picks a merge, split or delete of the list events, as (EventStore method name, arguments)."""
+    ids = [event['id'] for event in events]
+    operation = rng.choice(['merge', 'split', 'delete'])
+    if operation == 'merge':
+        first = int(rng.integers(len(ids) - 2))
+        return 'merge', ({ids[first], ids[first + int(rng.integers(1, 3))]},)
+    if operation == 'delete':
+        return 'delete', (set(rng.choice(ids, size=int(rng.integers(1, 3)), replace=False).tolist()),)
+    event = max(events, key=lambda e: e['end'] - e['start'])
+    return 'split', (event['id'], round((event['start'] + event['end']) / 2, 2))
+
+
+def breathing_recording(path, seconds=90, sr=8000, seed=0):
+    """Writes noise modulated like slow breathing: loud inhalations and exhalations, quiet apneas."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(seconds * sr) / sr
+    breath = np.clip(np.sin(2 * np.pi * t / 12), 0, None) + np.clip(np.sin(2 * np.pi * t / 12 + 2.5), 0, None)
+    sf.write(path, (0.3 * breath * rng.standard_normal(len(t))).astype(np.float32), sr)
+
+
+@pytest.fixture
+def database_file(tmp_path, monkeypatch):
+    """An empty database with the current schema, used instead of mindfulness_analysis.db."""
+    monkeypatch.setattr(database, 'DATABASE_FILE', str(tmp_path / 'test.db'))
+    database.create_tables()
+    yield database.DATABASE_FILE
+    database._pool.close_all()
+
+
+def record_session(results_folder, name='breath', seed=0):
+    """Analyzes a synthetic recording into a session saved in the test database; returns its db_id."""
+    from analysis_jobs import analyze_session, save_session_row
+    session_folder = results_folder / f'tester_{name}'
+    session_folder.mkdir(parents=True)
+    breathing_recording(str(session_folder / f'{name}.wav'), seed=seed)
+    session, error = analyze_session(str(session_folder), f'{name}.wav')
+    assert error is None
+    return save_session_row(str(session_folder), session, 'tester')
+
+
+@pytest.fixture
+def recorded_session(database_file, tmp_path):
+    """The db_id of a session analyzed from a synthetic recording."""
+    return record_session(tmp_path / 'results')
+
+
+@pytest.fixture
+def client(database_file, tmp_path, monkeypatch):
+    """A test client of the app, running in `tmp_path` with its own session cache."""
+    monkeypatch.chdir(tmp_path)
+    import app as app_module
+    from session_cache import SessionCache
+    session_cache = SessionCache()
+    monkeypatch.setattr(app_module, 'session_cache', session_cache)
+    yield app_module.app.test_client()
+    session_cache.close()
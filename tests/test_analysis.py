@@ -0,0 +1,282 @@
+import shutil
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+import soundfile as sf
+
+import analisis_audio
+from analisis_audio import get_audio_features, identify_phase_intervals, segment_apnea_masks
+from conftest import PHASES, breathing_recording, synthetic_events
+from event_store import PHASE_TYPES
+
+
+def legacy_identify_phase_intervals(apnea_mask, time):
+    """The original iloc loop, as in benchmarks/bench_segmentation.py."""
+    details = {'inhalation': [], 'exhalation': [], 'apnea': []}
+    if time.empty:
+        return details
+    changes = np.diff(apnea_mask.astype(int), prepend=apnea_mask.iloc[0])
+    change_points_idx = np.where(changes != 0)[0]
+    start_idx = 0
+    respiration_alternator = True
+    change_indices = list(change_points_idx) + [len(apnea_mask)]
+    for end_idx in change_indices:
+        if end_idx == 0: continue
+        if start_idx >= len(time): break
+        is_apnea = apnea_mask.iloc[start_idx]
+        start_time = time.iloc[start_idx]
+        if end_idx < len(time):
+            end_time = time.iloc[end_idx]
+        else:
+            end_time = time.iloc[-1] + 1
+        if end_time > start_time:
+            if is_apnea:
+                details['apnea'].append([start_time, end_time])
+            else:
+                if respiration_alternator:
+                    details['inhalation'].append([start_time, end_time])
+                else:
+                    details['exhalation'].append([start_time, end_time])
+                respiration_alternator = not respiration_alternator
+        start_idx = end_idx
+    return details
+
+
+def random_apnea_masks(rng, n_masks, n_frames):
+    """Masks with runs of random lengths, starting with apnea or breathing."""
+    runs = rng.integers(1, 12, size=(n_masks, n_frames))
+    values = rng.integers(0, 2, size=(n_masks, 1)) + np.arange(n_frames)
+    return np.stack([np.repeat(value % 2 == 1, run)[:n_frames] for value, run in zip(values, runs)])
+
+
+@pytest.mark.parametrize('n_frames', [0, 1, 2, 7, 500])
+def test_segmentation_matches_the_legacy_loop(n_frames):
+    rng = np.random.default_rng(n_frames)
+    masks = random_apnea_masks(rng, 6, n_frames)
+    time = pd.Series(np.arange(n_frames))
+    rows, starts, ends, codes = segment_apnea_masks(masks, time.to_numpy(), hop_seconds=1)
+    for row, mask in enumerate(masks):
+        expected = legacy_identify_phase_intervals(pd.Series(mask), time)
+        assert identify_phase_intervals(pd.Series(mask), time, hop_seconds=1) == expected
+        # All the masks segmented in one pass give the same phases as each mask on its own
+        in_row = rows == row
+        for code, phase in enumerate(PHASE_TYPES):
+            selected = in_row & (codes == code)
+            assert np.column_stack((starts[selected], ends[selected])).tolist() == expected[phase]
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_short_recordings_get_a_full_waveshow(tmp_path, streaming):
+    # 300 s is 300 envelope frames at the default 1 s hop, fewer than the 1000 waveshow points
+    path = str(tmp_path / 'short.wav')
+    breathing_recording(path, seconds=300)
+    features, _ = get_audio_features(path, streaming=streaming)
+    signal = features['signal']
+    assert len(signal['t']) == len(signal['min']) == len(signal['max']) == 1000
+    assert np.all(np.diff(signal['t']) > 0) and signal['t'][-1] < 300
+    assert np.all(np.asarray(signal['min']) <= np.asarray(signal['max']))
+
+
+def fake_ffmpeg(tmp_path, stderr_bytes, samples, exit_code=0):
+    """An executable standing in for ffmpeg: writes to stderr first, then float32 samples to stdout."""
+    script = tmp_path / 'ffmpeg'
+    script.write_text(f'#!{sys.executable}\n'
+                      'import sys\n'
+                      f'sys.stderr.write("x" * {stderr_bytes})\n'
+                      'sys.stderr.flush()\n'
+                      f'sys.stdout.buffer.write(b"\\0\\0\\0\\0" * {samples})\n'
+                      f'sys.exit({exit_code})\n')
+    script.chmod(0o755)
+    return str(script)
+
+
+def read_ffmpeg_blocks(monkeypatch, binary):
+    monkeypatch.setattr(analisis_audio, 'FFMPEG_BINARY', binary)
+    monkeypatch.setattr(analisis_audio, '_probe_audio', lambda path: (8000, 1, 2.0))
+    _, blocks = analisis_audio._open_ffmpeg_stream('input.mp3', block_seconds=1)
+    result = {}
+    reader = threading.Thread(target=lambda: result.update(samples=sum(len(block) for block in blocks)), daemon=True)
+    reader.start()
+    reader.join(30)
+    assert not reader.is_alive(), "decoding hung"
+    return result
+
+
+def test_ffmpeg_stderr_does_not_block_decoding(tmp_path, monkeypatch):
+    # Far more than a pipe buffer holds, written before any sample
+    assert read_ffmpeg_blocks(monkeypatch, fake_ffmpeg(tmp_path, 1 << 20, 16000)) == {'samples': 16000}
+
+
+def test_ffmpeg_failures_report_its_stderr(tmp_path, monkeypatch):
+    monkeypatch.setattr(analisis_audio, 'FFMPEG_BINARY', fake_ffmpeg(tmp_path, 10, 0, exit_code=1))
+    monkeypatch.setattr(analisis_audio, '_probe_audio', lambda path: (8000, 1, 2.0))
+    _, blocks = analisis_audio._open_ffmpeg_stream('input.mp3')
+    with pytest.raises(RuntimeError, match='xxxxxxxxxx'):
+        list(blocks)
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None, reason='ffmpeg is not installed')
+def test_mp3_uploads_are_decoded_with_ffmpeg(tmp_path):
+    wav_path, mp3_path = str(tmp_path / 'breath.wav'), str(tmp_path / 'breath.mp3')
+    breathing_recording(wav_path, seconds=120)
+    subprocess.run(['ffmpeg', '-v', 'error', '-i', wav_path, mp3_path], check=True)
+    # Decoding the WAV through ffmpeg gives the samples soundfile reads
+    sr, blocks = analisis_audio._open_ffmpeg_stream(wav_path, block_seconds=10)
+    samples, file_sr = sf.read(wav_path, dtype='float32')
+    assert sr == file_sr
+    assert np.array_equal(np.concatenate(list(blocks)), samples)
+
+    analysis_data, error = analisis_audio.perform_initial_analysis(mp3_path, streaming=True)
+    assert error is None
+    assert abs(analysis_data['duration'] - 120) < 0.2
+    assert len(analysis_data['events']) > 10
+
+
+@pytest.mark.filterwarnings('ignore:Mean of empty slice', 'ignore:invalid value encountered')
+def test_frame_kernel_matches_the_masked_means():
+    rng = np.random.default_rng(6)
+    sr = 8000
+    y = (rng.standard_normal(sr * 30 + 1234) * 0.3).astype(np.float32)
+    y[sr:2 * sr] = np.abs(y[sr:2 * sr])  # A frame without negative samples
+
+    positive_mean, negative_mean, frame_min, frame_max = analisis_audio.calculate_frame_features(y, sr, 1)
+
+    # Baseline: masked means over whole frames, then the trailing partial frame
+    frames = [y[i:i + sr] for i in range(0, len(y), sr)]
+    expected_positive = [np.nan_to_num(np.mean(f, where=f > 0)) for f in frames]
+    expected_negative = [np.nan_to_num(np.mean(f, where=f < 0)) for f in frames]
+    np.testing.assert_allclose(positive_mean, expected_positive, rtol=1e-5)
+    np.testing.assert_allclose(negative_mean, expected_negative, rtol=1e-5, atol=1e-12)
+    assert negative_mean[1] == 0
+    assert np.array_equal(frame_min, [f.min() for f in frames])
+    assert np.array_equal(frame_max, [f.max() for f in frames])
+
+
+def test_waveshow_points_start_at_their_first_frame():
+    rng = np.random.default_rng(7)
+    frame_min, frame_max = rng.random(2500, dtype=np.float32) - 1, rng.random(2500, dtype=np.float32)
+
+    t, y_min, y_max = analisis_audio.calculate_waveshow_from_frames(frame_min, frame_max, 0.5, num_vis_points=1000)
+
+    starts = np.unique(np.arange(1000) * 2500 // 1000)
+    assert t == (starts * 0.5).tolist()
+    assert t[0] == 0 and t[-1] < 2500 * 0.5
+    for i, (first, last) in enumerate(zip(starts, np.append(starts[1:], 2500))):
+        assert y_min[i] == frame_min[first:last].min()
+        assert y_max[i] == frame_max[first:last].max()
+
+
+@pytest.mark.parametrize('hop_seconds', [1, 0.25])
+def test_threaded_frame_features_equal_the_serial_ones(monkeypatch, hop_seconds):
+    # Small chunks, so the signal is split across many threads
+    monkeypatch.setattr(analisis_audio, 'FEATURE_CHUNK_SAMPLES', 1 << 14)
+    rng = np.random.default_rng(19)
+    y = (rng.standard_normal(8000 * 120 + 777) * 0.2).astype(np.float32)
+
+    serial = analisis_audio.calculate_frame_features(y, 8000, hop_seconds, workers=1)
+    threaded = analisis_audio.calculate_frame_features(y, 8000, hop_seconds, workers=4)
+
+    for serial_values, threaded_values in zip(serial, threaded):
+        assert serial_values.dtype == threaded_values.dtype
+        assert serial_values.tobytes() == threaded_values.tobytes()
+    for serial_bins, threaded_bins in zip(analisis_audio.calculate_minmax_bins(y, workers=1),
+                                          analisis_audio.calculate_minmax_bins(y, workers=4)):
+        assert serial_bins.tobytes() == threaded_bins.tobytes()
+
+
+@pytest.mark.parametrize('hop_seconds', [1, 0.25])
+def test_streamed_features_equal_the_in_memory_ones(tmp_path, hop_seconds):
+    path = str(tmp_path / 'breath.wav')
+    breathing_recording(path, seconds=95)
+
+    in_memory = analisis_audio._compute_audio_features(path, streaming=False, hop_seconds=hop_seconds)
+    # Short blocks, so the recording spans many of them and ends in a partial one
+    streamed = analisis_audio.calculate_streaming_features(path, block_seconds=7, hop_seconds=hop_seconds)
+
+    assert streamed['duration'] == in_memory['duration']
+    assert streamed['sampling_rate'] == in_memory['sampling_rate']
+    assert streamed['signal'] == in_memory['signal']
+    pd.testing.assert_frame_equal(streamed['envelope'], in_memory['envelope'])
+    for streamed_bins, in_memory_bins in zip(streamed['waveform_bins'], in_memory['waveform_bins']):
+        assert np.array_equal(streamed_bins, in_memory_bins)
+
+    streamed_analysis, _ = analisis_audio.perform_initial_analysis(path, streaming=True, hop_seconds=hop_seconds)
+    in_memory_analysis, _ = analisis_audio.perform_initial_analysis(path, streaming=False, hop_seconds=hop_seconds)
+    assert streamed_analysis['events'] == in_memory_analysis['events']
+
+
+def legacy_cycle_starts(types):
+    """The original greedy scan of build_respiratory_cycles_table, returning where each cycle starts."""
+    starts = []
+    i = next((i for i, phase in enumerate(types) if phase == 'inhalation'), len(types))
+    while i <= len(types) - 4:
+        if types[i:i + 4] == ['inhalation', 'apnea', 'exhalation', 'apnea']:
+            starts.append(i)
+            i += 4
+        else:
+            i += 1
+    return starts
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_cycle_matching_agrees_with_the_legacy_scan(seed):
+    rng = np.random.default_rng(seed)
+    # Mostly well-formed breaths, with phases dropped and repeated at random
+    codes = np.tile([PHASE_TYPES.index(phase) for phase in PHASES], 300)
+    codes = codes[rng.random(len(codes)) > 0.1]
+    codes = np.insert(codes, rng.integers(len(codes), size=50), rng.integers(3, size=50))
+    types = [PHASE_TYPES[code] for code in codes]
+
+    starts = analisis_audio.find_respiratory_cycles(codes)
+    assert starts.tolist() == legacy_cycle_starts(types)
+    for first in rng.integers(len(codes), size=10).tolist():
+        assert analisis_audio.find_respiratory_cycles(codes, first).tolist() == [s for s in starts.tolist() if s >= first]
+
+
+def test_cycles_table_agrees_with_the_legacy_scan():
+    events = synthetic_events(200, seed=7)
+    rng = np.random.default_rng(7)
+    events = [event for event in events if rng.random() > 0.05]
+
+    df_table, cycle_events = analisis_audio.build_respiratory_cycles_table(events)
+    starts = legacy_cycle_starts([event['type'] for event in events])
+    assert len(starts) > 100
+    assert [cycle['start'] for cycle in cycle_events] == [events[i]['start'] for i in starts]
+    assert [cycle['end'] for cycle in cycle_events] == [events[i + 3]['end'] for i in starts]
+    expected_totals = [round(sum(round(e['end'] - e['start'], 6) for e in events[i:i + 4]), 6) for i in starts]
+    assert df_table['Total Cycle (s)'].iloc[:-1].tolist() == pytest.approx(expected_totals, abs=1e-6)
+
+
+def raw_minmax(y, bin_samples):
+    """Min and max of every `bin_samples` samples of the raw signal, including a partial last bin."""
+    starts = np.arange(0, len(y), bin_samples)
+    return np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)
+
+
+def test_waveform_pyramid_bins_match_the_raw_signal(tmp_path):
+    rng = np.random.default_rng(10)
+    sr, bin_samples = 8000, analisis_audio.WAVEFORM_BIN_SAMPLES
+    y = rng.standard_normal(sr * 60 + 1001).astype(np.float32)
+
+    bins = analisis_audio.calculate_minmax_bins(y)
+    levels = analisis_audio.build_waveform_pyramid(*bins)
+    for level, (level_min, level_max) in enumerate(levels):
+        expected_min, expected_max = raw_minmax(y, bin_samples * 2 ** level)
+        assert np.array_equal(level_min, expected_min) and np.array_equal(level_max, expected_max)
+    assert len(levels[-1][0]) == 1
+
+    path = str(tmp_path / analisis_audio.WAVEFORM_FILENAME)
+    analisis_audio.save_waveform_pyramid(path, sr, bins)
+    for start, end, px in [(0, 60.2, 800), (12.3, 13.1, 800), (5, 45, 100), (59.9, 61, 50)]:
+        window = analisis_audio.read_waveform_window(path, start, end, px)
+        samples_per_bin = round(window['bin_seconds'] * sr)
+        first = round(window['start'] * sr)
+        expected_min, expected_max = raw_minmax(y[first:first + samples_per_bin * len(window['min'])], samples_per_bin)
+        assert np.array_equal(window['min'], expected_min) and np.array_equal(window['max'], expected_max)
+        assert window['start'] <= start and len(window['min']) <= px + 2
+        # The window is covered, up to the end of the recording
+        assert window['start'] + len(window['min']) * window['bin_seconds'] >= min(end, len(y) / sr)
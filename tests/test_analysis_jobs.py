@@ -0,0 +1,51 @@
+import analysis_jobs
+import database
+from analysis_jobs import AnalysisQueue, analyze_session
+from conftest import breathing_recording
+
+AUDIO_HASH = 'ab' * 32
+
+
+def upload(tmp_path, name):
+    """Saves a recording in a new session folder, as the upload route does."""
+    session_folder = tmp_path / 'results' / name
+    session_folder.mkdir(parents=True)
+    breathing_recording(str(session_folder / 'breath.wav'))
+    return str(session_folder)
+
+
+def cached_upload(tmp_path, monkeypatch):
+    """A second upload of a recording whose analysis is in the content store's cache."""
+    monkeypatch.chdir(tmp_path)
+    _, error = analyze_session(upload(tmp_path, 'first'), 'breath.wav', audio_hash=AUDIO_HASH)
+    assert error is None
+    return upload(tmp_path, 'second')
+
+
+def test_cached_uploads_complete_at_once(database_file, tmp_path, monkeypatch):
+    session_folder = cached_upload(tmp_path, monkeypatch)
+    queue = AnalysisQueue(max_pending=1)
+    job_id = queue.submit(session_folder, 'breath.wav', 'tester', AUDIO_HASH)
+    job = database.get_job(job_id)
+    assert job['status'] == 'done' and job['db_id'] is not None
+    assert queue.stats()['pending'] == 0
+
+
+def test_cached_uploads_count_against_the_queue_limit(database_file, tmp_path, monkeypatch):
+    session_folder = cached_upload(tmp_path, monkeypatch)
+    queue = AnalysisQueue(max_pending=1)
+    queue._jobs.add('running elsewhere')
+    assert queue.submit(session_folder, 'breath.wav', 'tester', AUDIO_HASH) is None
+
+
+def test_cached_upload_failures_are_recorded_on_the_job(database_file, tmp_path, monkeypatch):
+    session_folder = cached_upload(tmp_path, monkeypatch)
+
+    def restore_cached_session(*args):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(analysis_jobs, 'restore_cached_session', restore_cached_session)
+    queue = AnalysisQueue(max_pending=1)
+    job = database.get_job(queue.submit(session_folder, 'breath.wav', 'tester', AUDIO_HASH))
+    assert job['status'] == 'failed' and 'No space left on device' in job['error']
+    assert queue.stats()['pending'] == 0
@@ -0,0 +1,222 @@
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analisis_audio import analyze_respiration, build_respiratory_cycles_table, score_statistics, MAX_SWEEP_FACTORS
+from conftest import random_edit, record_session, synthetic_events
+from event_store import EventStore
+from operation_log import edit_operation, first_changed_event
+from session_store import SESSION_ARRAYS_FILENAME, read_session_array
+
+
+def session_folder(client, db_id):
+    import app as app_module
+    return app_module.session_cache.get(db_id).session_folder
+
+
+def test_recalculate_keeps_the_arrays_sidecar(client, recorded_session):
+    sidecar = os.path.join(session_folder(client, recorded_session), SESSION_ARRAYS_FILENAME)
+    before = os.stat(sidecar)
+    response = client.post('/recalculate', json={'db_id': recorded_session, 'apnea_threshold': 0.3})
+    assert response.status_code == 200
+    after = os.stat(sidecar)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    assert client.get(f'/arrays/{recorded_session}/envelope').status_code == 200
+
+
+def test_recalculate_reads_the_feature_cache_instead_of_decoding(client, recorded_session, monkeypatch):
+    import analisis_audio
+    import app as app_module
+    folder = session_folder(client, recorded_session)
+    audio_path = os.path.join(folder, 'breath.wav')
+    expected, _ = analisis_audio.perform_initial_analysis(audio_path, apnea_threshold_factor=0.3)
+
+    def decode(*args, **kwargs):
+        raise AssertionError('the recording was decoded again')
+
+    monkeypatch.setattr(analisis_audio, '_load_audio_file', decode)
+    monkeypatch.setattr(analisis_audio, '_open_audio_stream', decode)
+    response = client.post('/recalculate', json={'db_id': recorded_session, 'apnea_threshold': 0.3})
+    assert response.status_code == 200
+    events = app_module.session_cache.get(recorded_session).analysis_data['events']
+    assert [dict(event) for event in events] == [dict(event) for event in expected['events']]
+
+
+@pytest.mark.parametrize('request_data', [
+    {'factors': []},
+    {'factors': [0.1] * (MAX_SWEEP_FACTORS + 1)},
+    {'start': 0.0, 'stop': 1.0, 'step': 0.001},
+    {'start': 0.1, 'stop': 0.2, 'step': 0},
+    {'start': 0.1, 'stop': 0.2},
+    {'factors': ['high']},
+])
+def test_threshold_sweeps_out_of_bounds_are_rejected(client, recorded_session, request_data):
+    response = client.post('/threshold_sweep', json=dict(request_data, db_id=recorded_session))
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_threshold_sweeps_match_single_recalculations(client, recorded_session):
+    import analisis_audio
+    response = client.post('/threshold_sweep', json={'db_id': recorded_session, 'start': 0.05, 'stop': 0.3, 'step': 0.05})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result['apnea_threshold_factor'] for result in results] == [0.05, 0.1, 0.15, 0.2, 0.25, 0.3]
+
+    audio_path = os.path.join(session_folder(client, recorded_session), 'breath.wav')
+    for result in results:
+        analysis_data, _ = analisis_audio.perform_initial_analysis(audio_path, result['apnea_threshold_factor'])
+        assert result['num_events'] == len(analysis_data['events'])
+
+
+def test_preview_transcodes_do_not_block_other_sessions(client, recorded_session, tmp_path, monkeypatch):
+    import app as app_module
+    other_session = record_session(tmp_path / 'results', 'other', seed=1)
+    blocked_folder = session_folder(client, recorded_session)
+    release = threading.Event()
+
+    def create_audio_preview(audio_path, preview_path, preview_format):
+        # The transcode of the first session takes until the test releases it
+        if os.path.dirname(preview_path) == blocked_folder:
+            release.wait(30)
+        with open(preview_path, 'wb') as f:
+            f.write(b'preview')
+
+    monkeypatch.setattr(app_module, 'create_audio_preview', create_audio_preview)
+    slow = threading.Thread(target=client.get, args=(f'/get_audio_preview/{recorded_session}',), daemon=True)
+    slow.start()
+    while not app_module.preview_locks and slow.is_alive():
+        time.sleep(0.01)
+    started = time.monotonic()
+    response = client.get(f'/get_audio_preview/{other_session}')
+    release.set()
+    slow.join(30)
+    assert response.status_code == 200
+    assert time.monotonic() - started < 10
+    assert app_module.preview_locks == {}
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_cycle_view_updates_match_a_full_rebuild(client, seed):
+    import app as app_module
+    rng = np.random.default_rng(seed)
+    records = synthetic_events(40, seed)
+    # The detection does not label events with the pattern, so the first edit relabels them all
+    records[1]['type'], records[2]['type'] = records[2]['type'], records[1]['type']
+    events = EventStore.from_records(records)
+    view = app_module._cycle_view(0, events)
+    for version in range(1, 150):
+        before = events
+        events = before.copy()
+        operation_name, args = random_edit(rng, events.to_records())
+        getattr(events, operation_name)(*args)
+        events.relabel()
+        operation = edit_operation(operation_name, before, events)
+        previous, view = view, app_module._cycle_view(version, events, view, first_changed_event(operation))
+
+        df_table, cycle_events = build_respiratory_cycles_table(events)
+        assert view['cycle_events'] == cycle_events
+        assert app_module._cycle_rows(view) == df_table.to_numpy(dtype=object).tolist()
+        pd.testing.assert_frame_equal(app_module._cycle_frame(view), df_table)
+        assert score_statistics(view['statistics']) == analyze_respiration(df_table)
+        # The changes turn the previous rows and cycle events into the new ones
+        rows = app_module._cycle_rows(previous)
+        start, old_stop, new_stop = view['changes']['rows']
+        rows[start:old_stop] = app_module._cycle_rows(view, start, new_stop)
+        assert rows == app_module._cycle_rows(view)
+        items = list(previous['cycle_events'])
+        start, old_stop, new_stop = view['changes']['cycles']
+        items[start:old_stop] = view['cycle_events'][start:new_stop]
+        assert items == cycle_events
+        if len(events) < 60:
+            events = EventStore.from_records(synthetic_events(40, seed + version))
+            view = app_module._cycle_view(version, events)
+
+
+def apply_delta(state, delta):
+    """Applies a delta response to a client's copy of the session, as static/js/script.js does."""
+    removed = set(delta['events']['removed'])
+    events = [event for i, event in enumerate(state['events']) if i not in removed]
+    for position, event in zip(delta['events']['added']['positions'], delta['events']['added']['events']):
+        events.insert(position, event)
+    pattern = delta['events']['pattern']
+    state['events'] = [dict(event, type=pattern[i % len(pattern)]) for i, event in enumerate(events)]
+    for key, patch, items in (('cycle_events', delta['cycle_events'], delta['cycle_events']['items']),
+                              ('rows', delta['cycle_rows'], delta['cycle_rows']['rows'])):
+        state[key][patch['start']:patch['start'] + patch['delete_count']] = items
+
+
+def client_state(response):
+    return {'version': response['version'], 'events': response['analysis_data']['events'],
+            'cycle_events': response['analysis_data']['cycle_events'], 'rows': response['cycle_table']['rows'],
+            'respiration_analysis': response['respiration_analysis']}
+
+
+def test_deltas_bring_the_client_to_the_session_state(client, recorded_session):
+    rng = np.random.default_rng(0)
+    state = client_state(client.get(f'/session/{recorded_session}').get_json())
+    deltas = 0
+    for _ in range(40):
+        request = {'db_id': recorded_session, 'version': state['version']}
+        action = rng.choice(['merge', 'split', 'delete', 'undo', 'redo'], p=[0.25, 0.3, 0.15, 0.2, 0.1])
+        if action in ('merge', 'split', 'delete'):
+            name, args = random_edit(rng, state['events'])
+            request.update({'segment_id': args[0], 'split_time': args[1]} if name == 'split' else {'segment_ids': list(args[0])})
+        response = client.post(f'/{action}', json=request).get_json()
+        if 'version' not in response:
+            continue
+        if 'delta' in response:
+            assert response['base_version'] == state['version']
+            apply_delta(state, response['delta'])
+            state.update(version=response['version'], respiration_analysis=response['respiration_analysis'])
+            deltas += 1
+        else:
+            state = client_state(response)
+        assert state == client_state(client.get(f'/session/{recorded_session}').get_json())
+    assert deltas > 10
+
+    # A client holding an older version gets the whole session
+    request = {'db_id': recorded_session, 'version': state['version'] - 1, 'segment_ids': [state['events'][0]['id']]}
+    response = client.post('/delete', json=request).get_json()
+    assert 'delta' not in response
+    assert [event['id'] for event in response['analysis_data']['events']] == [event['id'] for event in state['events'][1:]]
+
+
+def read_float32_buffer(data):
+    """Parses an F32A response the way the page does: magic, uint32 header length, JSON header, float32 fields."""
+    assert data[:4] == b'F32A'
+    header_length = struct.unpack('<I', data[4:8])[0]
+    # Float32Array views need the values to start on a 4-byte boundary
+    assert (8 + header_length) % 4 == 0
+    header = json.loads(data[8:8 + header_length])
+    values = np.frombuffer(data[8 + header_length:], dtype='<f4')
+    assert len(values) == len(header['fields']) * header['length']
+    return header, dict(zip(header['fields'], values.reshape(len(header['fields']), header['length'])))
+
+
+@pytest.mark.parametrize('name', ['signal', 'envelope'])
+def test_session_arrays_are_sent_as_float32_buffers(client, recorded_session, name):
+    response = client.get(f'/arrays/{recorded_session}/{name}')
+    assert response.status_code == 200 and response.mimetype == 'application/octet-stream'
+    header, arrays = read_float32_buffer(response.data)
+    expected = read_session_array(session_folder(client, recorded_session), name)
+    assert header['fields'] == list(expected)
+    for field, values in expected.items():
+        assert np.array_equal(arrays[field], np.asarray(values, dtype=np.float32))
+
+    cached = client.get(f'/arrays/{recorded_session}/{name}', headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+
+
+def test_binary_waveform_windows_match_the_json_ones(client, recorded_session):
+    query = f'/waveform/{recorded_session}?start=10&end=40&px=300'
+    window = client.get(query).get_json()
+    header, arrays = read_float32_buffer(client.get(query + '&format=binary').data)
+    assert (header['level'], header['bin_seconds'], header['start']) == (window['level'], window['bin_seconds'], window['start'])
+    assert arrays['min'].tolist() == window['min'] and arrays['max'].tolist() == window['max']
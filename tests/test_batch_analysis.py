@@ -0,0 +1,44 @@
+import batch_analysis
+from conftest import breathing_recording
+from database import get_session_folders
+from session_store import load_session
+
+
+def recordings_folder(tmp_path, names):
+    folder = tmp_path / 'recordings' / 'alice'
+    folder.mkdir(parents=True, exist_ok=True)
+    for seed, name in enumerate(names):
+        breathing_recording(str(folder / f'{name}.wav'), seconds=60, seed=seed)
+    return folder
+
+
+def test_reruns_skip_saved_recordings_and_resume_the_rest(database_file, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    folder = recordings_folder(tmp_path, ['first', 'second', 'third'])
+    (folder / 'broken.wav').write_bytes(b'not audio')
+    recordings = batch_analysis.find_recordings([str(tmp_path / 'recordings')])
+    assert [path.rsplit('/', 1)[-1] for path in recordings] == ['broken.wav', 'first.wav', 'second.wav', 'third.wav']
+
+    # A run stopped after two recordings
+    stats = batch_analysis.run_batch(recordings[1:3], workers=2, batch_size=1)
+    assert (stats['analyzed'], stats['skipped'], stats['failed']) == (2, 0, 0)
+
+    stats = batch_analysis.run_batch(recordings, workers=2, batch_size=2)
+    assert (stats['found'], stats['skipped'], stats['analyzed'], stats['failed']) == (4, 2, 1, 1)
+    stats = batch_analysis.run_batch(recordings, workers=2)
+    assert (stats['skipped'], stats['analyzed'], stats['failed']) == (3, 0, 1)
+
+    saved_folders = get_session_folders()
+    assert saved_folders == {batch_analysis.session_folder_for(path, 'alice', 'results') for path in recordings[1:]}
+    for session_folder in saved_folders:
+        analysis_data = load_session(session_folder)
+        assert analysis_data['db_id'] is not None and analysis_data['events']
+
+
+def test_cli_reports_failures_in_its_exit_code(database_file, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    recordings_folder(tmp_path, ['only'])
+    assert batch_analysis.main([str(tmp_path / 'recordings'), '--workers', '1', '--participant', 'bob']) == 0
+    assert 'Throughput' in capsys.readouterr().out
+    assert batch_analysis.main([str(tmp_path / 'recordings' / '*.mp3')]) == 1
+    assert 'No .wav or .mp3 recordings found.' in capsys.readouterr().out
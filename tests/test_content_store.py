@@ -0,0 +1,27 @@
+import io
+import os
+
+from content_store import CACHED_SESSION_FILES, save_audio_stream, load_cached_analysis, store_cached_analysis
+
+
+def test_repeat_upload_shares_the_stored_files(tmp_path):
+    store, cache = str(tmp_path / 'uploads'), str(tmp_path / 'cache')
+    first_hash, first_blob = save_audio_stream(io.BytesIO(b'RIFF' * 1000), 'wav', store)
+    second_hash, second_blob = save_audio_stream(io.BytesIO(b'RIFF' * 1000), 'wav', store)
+    assert (first_hash, first_blob) == (second_hash, second_blob)
+    assert os.listdir(store) == [os.path.basename(first_blob)]
+
+    first_session, second_session = tmp_path / 'first', tmp_path / 'second'
+    first_session.mkdir()
+    second_session.mkdir()
+    for name in CACHED_SESSION_FILES:
+        (first_session / name).write_bytes(name.encode() * 100)
+    analysis_data = {'events': [], 'duration': 12.5, 'session_folder': str(first_session), 'db_id': 1, 'signal': {}}
+    assert load_cached_analysis(first_hash, 0.1, str(second_session), cache) is None
+
+    store_cached_analysis(first_hash, 0.1, str(first_session), analysis_data, cache)
+    # Only the analysis itself is cached, not the fields of the session it came from
+    assert load_cached_analysis(first_hash, 0.1, str(second_session), cache) == {'events': [], 'duration': 12.5}
+    assert load_cached_analysis(first_hash, 0.2, str(second_session), cache) is None
+    for name in CACHED_SESSION_FILES:
+        assert os.path.samefile(first_session / name, second_session / name)
@@ -0,0 +1,204 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+import pytest
+
+import database
+from analisis_audio import analyze_respiration, build_respiratory_cycles_table
+from conftest import synthetic_events
+from database import SCHEMA_VERSION, SUMMARY_COLUMNS, LEGACY_JSON_COLUMNS
+
+RESULT_QUERIES = {
+    'events': 'SELECT event_id, type, start_time, end_time FROM events WHERE session_id = ? ORDER BY event_id',
+    'cycles': 'SELECT * FROM cycles WHERE session_id = ? ORDER BY cycle_number',
+    'scores': 'SELECT * FROM scores WHERE session_id = ?',
+    'summary': f'SELECT {", ".join(SUMMARY_COLUMNS)} FROM session_summaries WHERE session_id = ?',
+    'bins': 'SELECT bin, cycles FROM cycle_duration_bins WHERE session_id = ? ORDER BY bin'
+}
+
+
+def sessions():
+    """Sessions as the analysis saves them: two scored ones and one too short to have cycles."""
+    for n_cycles, seed in ((12, 0), (30, 1), (0, 2)):
+        events = synthetic_events(n_cycles, seed) or [{'id': 0, 'start': 0, 'end': 4.5, 'type': 'inhalation'}]
+        df_table, _ = build_respiratory_cycles_table(events)
+        analysis_data = {'audio_filename': f'breath_{seed}.wav', 'duration': events[-1]['end'], 'sampling_rate': 8000, 'events': events}
+        yield analysis_data, df_table, analyze_respiration(df_table) if len(df_table) else None
+
+
+def create_legacy_database(db_file):
+    """Writes the sessions with the JSON text columns of the schema before the results tables."""
+    conn = sqlite3.connect(db_file)
+    conn.execute('''CREATE TABLE analysis_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL,
+                    participant_name TEXT, analysis_timestamp DATETIME NOT NULL, total_duration_seconds REAL NOT NULL,
+                    sampling_rate INTEGER NOT NULL, session_folder TEXT NOT NULL, respiratory_cycles_json TEXT,
+                    respiration_analysis_json TEXT, segmentation_events_json TEXT)''')
+    conn.executemany('''INSERT INTO analysis_sessions (filename, participant_name, analysis_timestamp, total_duration_seconds,
+                        sampling_rate, session_folder, respiratory_cycles_json, respiration_analysis_json, segmentation_events_json)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     [(analysis_data['audio_filename'], 'tester', datetime.now(), analysis_data['duration'], 8000,
+                       f'session_{i}', df_table.to_json(orient='records'), json.dumps(respiration_analysis),
+                       json.dumps(analysis_data['events']))
+                      for i, (analysis_data, df_table, respiration_analysis) in enumerate(sessions())])
+    conn.commit()
+    conn.close()
+
+
+def stored_results(db_file):
+    conn = sqlite3.connect(db_file)
+    session_ids = [row[0] for row in conn.execute('SELECT id FROM analysis_sessions ORDER BY id')]
+    results = [{table: conn.execute(query, (db_id,)).fetchall() for table, query in RESULT_QUERIES.items()}
+               for db_id in session_ids]
+    conn.close()
+    return results
+
+
+def test_migration_stores_the_results_the_current_schema_would(tmp_path, monkeypatch, capsys):
+    legacy_file = str(tmp_path / 'legacy.db')
+    create_legacy_database(legacy_file)
+    monkeypatch.setattr(database, 'DATABASE_FILE', legacy_file)
+    database.create_tables()
+    database._pool.close_all()
+    assert 'Migrated the results of 3 session(s)' in capsys.readouterr().out
+    migrated = stored_results(legacy_file)
+
+    current_file = str(tmp_path / 'current.db')
+    monkeypatch.setattr(database, 'DATABASE_FILE', current_file)
+    database.create_tables()
+    for i, (analysis_data, df_table, respiration_analysis) in enumerate(sessions()):
+        database.save_analysis_to_db(f'session_{i}', analysis_data, df_table, respiration_analysis, 'tester')
+    database._pool.close_all()
+
+    assert migrated == stored_results(current_file)
+    assert [len(session['cycles']) for session in migrated] == [12, 30, 0]
+    assert migrated[2]['scores'] == [] and migrated[2]['summary'][0][0] == 0
+
+
+def test_migration_runs_once(tmp_path, monkeypatch, capsys):
+    legacy_file = str(tmp_path / 'legacy.db')
+    create_legacy_database(legacy_file)
+    monkeypatch.setattr(database, 'DATABASE_FILE', legacy_file)
+    database.create_tables()
+    migrated = stored_results(legacy_file)
+    capsys.readouterr()
+    database.create_tables()
+    database._pool.close_all()
+    assert 'Migrated' not in capsys.readouterr().out
+    assert stored_results(legacy_file) == migrated
+
+    conn = sqlite3.connect(legacy_file)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    # The results now live in their tables only
+    assert conn.execute(f'SELECT {", ".join(LEGACY_JSON_COLUMNS)} FROM analysis_sessions').fetchall() == [(None,) * 3] * 3
+    conn.close()
+
+
+def summary_of(db_file, db_id):
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute(RESULT_QUERIES['summary'], (db_id,)).fetchone()
+    conn.close()
+    return dict(row)
+
+
+def test_summary_matches_the_session_analysis(database_file):
+    for analysis_data, df_table, respiration_analysis in sessions():
+        db_id = database.save_analysis_to_db('session', analysis_data, df_table, respiration_analysis, 'tester')
+        summary = summary_of(database_file, db_id)
+        df = df_table[df_table['Cycle'] != 'avg']
+        if respiration_analysis is None:
+            assert summary['num_cycles'] == 0 and summary['total_std'] is None
+            continue
+        assert summary['num_cycles'] == respiration_analysis['num_cycles']
+        # The variability of the trends is the one the stability score is computed from
+        assert summary['total_std'] == pytest.approx(df['Total Cycle (s)'].std())
+        assert {pillar: summary[column] for column, pillar in database.SCORE_TABLE_COLUMNS.items()} == \
+            {pillar: float(score) for pillar, score in respiration_analysis['scores'].items()}
+
+
+def test_single_cycle_sessions_have_no_total_std(database_file):
+    events = synthetic_events(1)
+    df_table, _ = build_respiratory_cycles_table(events)
+    analysis_data = {'audio_filename': 'one.wav', 'duration': events[-1]['end'], 'sampling_rate': 8000, 'events': events}
+    db_id = database.save_analysis_to_db('session', analysis_data, df_table, analyze_respiration(df_table), 'tester')
+    assert summary_of(database_file, db_id)['total_std'] is None
+
+
+def test_summaries_of_version_2_are_recomputed(database_file):
+    analysis_data, df_table, respiration_analysis = next(sessions())
+    db_id = database.save_analysis_to_db('session', analysis_data, df_table, respiration_analysis, 'tester')
+    database._pool.close_all()
+    conn = sqlite3.connect(database_file)
+    conn.execute('UPDATE session_summaries SET total_std = 0 WHERE session_id = ?', (db_id,))
+    conn.execute('PRAGMA user_version = 2')
+    conn.commit()
+    conn.close()
+
+    database.create_tables()
+    df = df_table[df_table['Cycle'] != 'avg']
+    assert summary_of(database_file, db_id)['total_std'] == pytest.approx(df['Total Cycle (s)'].std())
+
+
+def test_pooled_connections_use_wal_and_a_busy_timeout(database_file):
+    with database.transaction() as cursor:
+        settings = [cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                    for name in ('journal_mode', 'synchronous', 'busy_timeout', 'foreign_keys')]
+    # synchronous=NORMAL is reported as 1
+    assert settings == ['wal', 1, database.BUSY_TIMEOUT_MS, 1]
+
+
+def test_pool_reuses_idle_connections_up_to_its_size(database_file):
+    pool = database.ConnectionPool(max_idle=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as again:
+        assert again is first
+    with pool.connection() as a, pool.connection() as b, pool.connection() as c:
+        assert len({id(a), id(b), id(c)}) == 3
+    assert len(pool._idle) == 2
+    pool.close_all()
+    assert pool._idle == []
+
+
+def test_pool_follows_the_database_file(database_file, tmp_path, monkeypatch):
+    pool = database.ConnectionPool()
+    with pool.connection() as first:
+        pass
+    monkeypatch.setattr(database, 'DATABASE_FILE', str(tmp_path / 'other.db'))
+    with pool.connection() as other:
+        assert other is not first
+        assert other.execute('PRAGMA database_list').fetchone()['file'].endswith('other.db')
+    pool.close_all()
+    first.close()
+
+
+def test_failed_transactions_are_rolled_back(database_file):
+    assert database.create_job('job', 'session', 'breath.wav')
+    with pytest.raises(RuntimeError):
+        with database.transaction() as cursor:
+            cursor.execute("UPDATE analysis_jobs SET status = 'failed' WHERE id = 'job'")
+            raise RuntimeError('failed halfway')
+    assert database.get_job('job')['status'] == 'queued'
+
+
+def test_concurrent_writers_do_not_lock_each_other_out(database_file):
+    analysis_data, df_table, respiration_analysis = next(sessions())
+    db_ids, errors = [], []
+
+    def save():
+        try:
+            for _ in range(5):
+                db_ids.append(database.save_analysis_to_db('session', analysis_data, df_table, respiration_analysis, 'tester'))
+                assert database.get_cycle_averages('tester') is not None
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert None not in db_ids and len(set(db_ids)) == 40
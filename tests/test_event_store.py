@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from conftest import PHASES, random_edit, synthetic_events
+from event_store import EventStore, IntervalIndex
+
+
+def legacy_relabel(events):
+    events.sort(key=lambda x: x['start'])
+    for i, event in enumerate(events):
+        event['type'] = PHASES[i % 4]
+    return events
+
+
+def legacy_merge(events, ids):
+    selected = sorted([e for e in events if e['id'] in ids], key=lambda x: x['start'])
+    if not selected:
+        return events
+    new_event = {'id': max(e['id'] for e in events) + 1, 'start': selected[0]['start'],
+                 'end': selected[-1]['end'], 'type': selected[0]['type']}
+    return legacy_relabel([e for e in events if e['id'] not in ids] + [new_event])
+
+
+def legacy_split(events, event_id, split_time):
+    index = next(i for i, e in enumerate(events) if e['id'] == event_id)
+    event = events[index]
+    original_end, event['end'] = event['end'], split_time
+    events.insert(index + 1, {'id': max(e['id'] for e in events) + 1, 'start': split_time,
+                              'end': original_end, 'type': event['type']})
+    return legacy_relabel(events)
+
+
+def legacy_delete(events, ids):
+    return legacy_relabel([e for e in events if e['id'] not in ids])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_edits_match_the_list_implementation(seed):
+    rng = np.random.default_rng(seed)
+    events = synthetic_events(30, seed)
+    store = EventStore.from_records(events)
+    legacy = {'merge': legacy_merge, 'split': legacy_split, 'delete': legacy_delete}
+    for _ in range(200):
+        operation, args = random_edit(rng, events)
+        events = legacy[operation]([dict(e) for e in events], *args)
+        getattr(store, operation)(*args)
+        store.relabel()
+        assert store.to_records() == events
+        # The incrementally maintained lookups agree with the events
+        assert all(store.position(event['id']) == i for i, event in enumerate(events))
+        assert store.next_id() == max(event['id'] for event in events) + 1
+        if len(events) < 20:
+            events = synthetic_events(30, seed + len(events))
+            store = EventStore.from_records(events)
+
+
+def test_edits_do_not_touch_the_source_or_copies():
+    events = synthetic_events(10)
+    starts = np.array([event['start'] for event in events], dtype=np.float64)
+    store = EventStore([event['id'] for event in events], starts, [event['end'] for event in events],
+                       np.zeros(len(events), dtype=np.int8))
+    copy = store.copy()
+    store.split(3, starts[3] + 0.25)
+    store.merge({0, 1})
+    assert np.array_equal(starts, [event['start'] for event in events])
+    assert copy.to_records() != store.to_records()
+    assert len(copy) == 40 and len(store) == 40
+
+
+def test_splice_inverts_an_edit():
+    store = EventStore.from_records(synthetic_events(5)).relabel()
+    before = store.copy()
+    store.merge({4, 5, 6})
+    store.relabel()
+    # Undo: remove the merged event and put the three originals back at their positions
+    store.splice([4], [4, 5, 6], before.subset([4, 5, 6])).relabel()
+    assert store == before
+
+
+def test_interval_queries():
+    store = EventStore.from_records(synthetic_events(10))
+    for position in range(len(store)):
+        middle = (store.starts[position] + store.ends[position]) / 2
+        assert store.find_at(middle) == position
+    assert list(store.overlapping(store.starts[3], store.ends[5])) == [3, 4, 5]
+    index = IntervalIndex([0, 10], [10, 20])
+    assert index.containing([2, 10, 15], [8, 20, 25]).tolist() == [0, 1, -1]
+
+
+def first_containing(starts, ends, query_start, query_end):
+    """The nested loop IntervalIndex.containing replaces: the first interval holding the query."""
+    return next((i for i, (s, e) in enumerate(zip(starts, ends)) if s <= query_start and query_end <= e), -1)
+
+
+@pytest.mark.parametrize('overlapping', [False, True])
+def test_containing_matches_the_nested_loop(overlapping):
+    rng = np.random.default_rng(9)
+    if overlapping:
+        starts = rng.integers(0, 100, size=60).astype(float)
+        ends = starts + rng.integers(0, 20, size=60)
+    else:
+        # Cycles: back to back or with gaps, given out of order
+        bounds = np.cumsum(rng.integers(1, 6, size=120)).astype(float)
+        starts, ends = bounds[0::2], bounds[1::2]
+        order = rng.permutation(len(starts))
+        starts, ends = starts[order], ends[order]
+    query_starts = rng.integers(0, int(ends.max()) + 5, size=500).astype(float)
+    query_ends = query_starts + rng.integers(0, 4, size=500)
+    # Queries that start or end exactly on interval bounds, including zero-length ones
+    query_starts[:50], query_ends[:50] = ends[:50], ends[:50]
+    query_starts[50:100], query_ends[50:100] = starts[:50], ends[:50]
+
+    index = IntervalIndex(starts, ends)
+    expected = [first_containing(starts, ends, s, e) for s, e in zip(query_starts, query_ends)]
+    assert index.containing(query_starts, query_ends).tolist() == expected
+    for t in query_starts[:100].tolist():
+        point = next((i for i, (s, e) in enumerate(zip(starts, ends)) if s <= t < e), None)
+        assert index.containing_point(t) == point
+    assert index.overlapping(20, 40).tolist() == [i for i, (s, e) in enumerate(zip(starts, ends)) if s < 40 and e > 20]
@@ -0,0 +1,149 @@
+import json
+
+import numpy as np
+import pytest
+
+import operation_log
+from conftest import random_edit, synthetic_events
+from event_store import EventStore
+from operation_log import (OperationLog, append_operations, document_operation, edit_operation, load_operation_log,
+                           operations_path)
+
+
+def session_document(seed=0):
+    events = synthetic_events(20, seed)
+    # Detected events do not follow the cycle pattern until the first edit relabels them
+    events[1]['type'], events[2]['type'] = events[2]['type'], events[1]['type']
+    return {'events': events, 'original_events': [dict(event) for event in events], 'apnea_threshold_factor': 0.1}
+
+
+def edit(history, analysis_data, rng):
+    before = EventStore.from_records(analysis_data['events'])
+    events = before.copy()
+    name, args = random_edit(rng, analysis_data['events'])
+    getattr(events, name)(*args)
+    events.relabel()
+    analysis_data['events'] = events.to_records()
+    history.record(edit_operation(name, before, events), analysis_data)
+
+
+def recalculate(history, analysis_data, seed):
+    previous = dict(analysis_data)
+    analysis_data.update(events=synthetic_events(15, seed), apnea_threshold_factor=0.2)
+    history.record(document_operation('recalculate', previous, analysis_data), analysis_data)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_reload_replays_edits_undo_and_redo(tmp_path, monkeypatch, seed):
+    # Snapshots every few entries, so reloading replays from one in the middle of the log
+    monkeypatch.setattr(operation_log, 'SNAPSHOT_INTERVAL', 7)
+    rng = np.random.default_rng(seed)
+    analysis_data = session_document(seed)
+    history = OperationLog.start(analysis_data)
+    for step in range(60):
+        action = rng.choice(['edit', 'edit', 'undo', 'redo', 'recalculate'], p=[0.4, 0.2, 0.2, 0.15, 0.05])
+        if action == 'edit':
+            edit(history, analysis_data, rng)
+        elif action == 'undo':
+            history.undo(analysis_data)
+        elif action == 'redo':
+            history.redo(analysis_data)
+        else:
+            recalculate(history, analysis_data, seed + step)
+        if rng.random() < 0.3:
+            append_operations(str(tmp_path), history)
+    append_operations(str(tmp_path), history)
+
+    loaded, loaded_history = load_operation_log(str(tmp_path))
+    assert loaded == analysis_data
+    assert loaded_history.version == history.version
+    assert loaded_history.since_snapshot == history.since_snapshot
+    assert loaded_history.done == history.done and loaded_history.undone == history.undone
+
+
+def test_undo_and_redo_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    analysis_data = session_document()
+    original = json.loads(json.dumps(analysis_data))
+    history = OperationLog.start(analysis_data)
+    states = []
+    for _ in range(30):
+        edit(history, analysis_data, rng)
+        states.append(json.loads(json.dumps(analysis_data)))
+    while history.can_undo:
+        history.undo(analysis_data)
+    # The first edit's undo restores the detected types, not the relabeled ones
+    assert analysis_data == original
+    for state in states:
+        history.redo(analysis_data)
+        assert analysis_data == state
+    append_operations(str(tmp_path), history)
+    assert load_operation_log(str(tmp_path))[0] == states[-1]
+
+
+def test_a_line_cut_short_by_a_crash_is_dropped(tmp_path):
+    rng = np.random.default_rng(1)
+    analysis_data = session_document()
+    history = OperationLog.start(analysis_data)
+    edit(history, analysis_data, rng)
+    append_operations(str(tmp_path), history)
+    saved = json.loads(json.dumps(analysis_data))
+    edit(history, analysis_data, rng)
+    line = json.dumps(history.pending[-1])
+    with open(operations_path(str(tmp_path)), 'a') as f:
+        f.write(line[:len(line) // 2])
+
+    loaded, loaded_history = load_operation_log(str(tmp_path))
+    assert loaded == saved
+    assert len(loaded_history.done) == 1
+
+
+def test_sessions_without_a_log_are_not_loaded(tmp_path):
+    assert load_operation_log(str(tmp_path)) == (None, None)
+
+
+def test_history_stays_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(operation_log, 'SNAPSHOT_INTERVAL', 10)
+    monkeypatch.setattr(operation_log, 'MAX_UNDO_DEPTH', 15)
+    rng = np.random.default_rng(2)
+    analysis_data = session_document()
+    history = OperationLog.start(analysis_data)
+    for _ in range(80):
+        if rng.random() < 0.8:
+            edit(history, analysis_data, rng)
+        else:
+            history.undo(analysis_data)
+        append_operations(str(tmp_path), history)
+        assert history.event_count() == sum(operation_log._operation_event_count(operation)
+                                            for operation in history.done + history.undone)
+        assert len(history.done) <= 15
+        # The file starts again from every snapshot
+        with open(operations_path(str(tmp_path))) as f:
+            lines = f.readlines()
+        assert json.loads(lines[0])['op'] == 'snapshot' and len(lines) <= 11
+
+    loaded, loaded_history = load_operation_log(str(tmp_path))
+    assert loaded == analysis_data
+    assert loaded_history.version == history.version
+    assert loaded_history.event_count() == history.event_count()
+
+
+def test_logs_without_stacks_in_their_snapshots_still_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(operation_log, 'SNAPSHOT_INTERVAL', 4)
+    rng = np.random.default_rng(3)
+    analysis_data = session_document()
+    history = OperationLog.start(analysis_data)
+    for _ in range(9):
+        edit(history, analysis_data, rng)
+    history.undo(analysis_data)
+    # As older versions wrote it: one file with every entry and snapshots of the document alone
+    with open(operations_path(str(tmp_path)), 'w') as f:
+        for entry in history.pending:
+            if entry['op'] == 'snapshot':
+                entry = {'op': 'snapshot', 'document': entry['document']}
+            f.write(json.dumps(entry) + '\n')
+
+    loaded, loaded_history = load_operation_log(str(tmp_path))
+    assert loaded == analysis_data
+    assert loaded_history.done == history.done and loaded_history.undone == history.undone
+    assert loaded_history.version == history.version
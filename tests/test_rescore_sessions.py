@@ -0,0 +1,87 @@
+import sqlite3
+
+import pytest
+
+import database
+import rescore_sessions
+from analisis_audio import (CONFIG, SCORE_TOLERANCE, analyze_respiration, build_respiratory_cycles_table,
+                            calculate_balance_score, calculate_depth_score, calculate_stability_score)
+from conftest import synthetic_events
+
+CUSTOM_CONFIG = {'TARGET_IE_RATIO': 2, 'TARGET_CYCLE_DURATION': 14.0}
+
+
+def save_sessions(n_sessions):
+    """Saves sessions of 0 to 9 cycles; returns the cycles table of each, by db_id."""
+    tables = {}
+    for seed in range(n_sessions):
+        events = synthetic_events(seed % 10, seed) or [{'id': 0, 'start': 0, 'end': 4.5, 'type': 'inhalation'}]
+        df_table, _ = build_respiratory_cycles_table(events)
+        analysis_data = {'audio_filename': f'breath_{seed}.wav', 'duration': events[-1]['end'], 'sampling_rate': 8000, 'events': events}
+        db_id = database.save_analysis_to_db(f'session_{seed}', analysis_data, df_table,
+                                             analyze_respiration(df_table) if len(df_table) else None, 'tester')
+        tables[db_id] = df_table
+    return tables
+
+
+def pandas_final_score(df_table, custom_config):
+    config = dict(CONFIG, **custom_config)
+    df = df_table[df_table['Cycle'] != 'avg']
+    weights = config['PILLAR_WEIGHTS']
+    return (weights['depth'] * calculate_depth_score(df, config) + weights['stability'] * calculate_stability_score(df, config) +
+            weights['balance'] * calculate_balance_score(df, config))
+
+
+def stored_final_scores(db_file):
+    conn = sqlite3.connect(db_file)
+    scores = dict(conn.execute('SELECT session_id, final FROM scores').fetchall())
+    conn.close()
+    return scores
+
+
+def test_interrupted_runs_resume_after_the_last_saved_batch(database_file, monkeypatch):
+    tables = save_sessions(23)
+    save_rescored_batch = rescore_sessions.save_rescored_batch
+    saved_batches = []
+
+    def interrupted_after_two_batches(run_id, last_session_id, analyses):
+        if len(saved_batches) == 2:
+            raise KeyboardInterrupt
+        saved_batches.append([db_id for db_id, _ in analyses])
+        return save_rescored_batch(run_id, last_session_id, analyses)
+
+    monkeypatch.setattr(rescore_sessions, 'save_rescored_batch', interrupted_after_two_batches)
+    with pytest.raises(KeyboardInterrupt):
+        rescore_sessions.run_rescoring(CUSTOM_CONFIG, batch_size=5)
+    monkeypatch.setattr(rescore_sessions, 'save_rescored_batch', save_rescored_batch)
+
+    stats = rescore_sessions.run_rescoring(CUSTOM_CONFIG, batch_size=5)
+    assert (stats['resumed'], stats['sessions']) == (10, 13)
+    assert sum(saved_batches, []) == sorted(tables)[:10]
+
+    expected = {db_id: float(analysis['scores']['Final']) for db_id, analysis in
+                ((db_id, analyze_respiration(df_table, CUSTOM_CONFIG)) for db_id, df_table in tables.items() if len(df_table))}
+    assert stored_final_scores(database_file) == expected
+    # Against the pandas pillar functions, scores move by no more than the documented rounding
+    for db_id, df_table in tables.items():
+        if len(df_table):
+            assert expected[db_id] == pytest.approx(pandas_final_score(df_table, CUSTOM_CONFIG), abs=SCORE_TOLERANCE)
+
+    # A finished run is not resumed: the same configuration starts over
+    stats = rescore_sessions.run_rescoring(CUSTOM_CONFIG, batch_size=5)
+    assert (stats['resumed'], stats['sessions']) == (0, 23)
+
+
+def test_runs_are_kept_per_configuration(database_file, monkeypatch):
+    save_sessions(6)
+    save_rescored_batch = rescore_sessions.save_rescored_batch
+    monkeypatch.setattr(rescore_sessions, 'save_rescored_batch', lambda *args: False)
+    with pytest.raises(RuntimeError):
+        rescore_sessions.run_rescoring(CUSTOM_CONFIG, batch_size=2)
+    monkeypatch.setattr(rescore_sessions, 'save_rescored_batch', save_rescored_batch)
+
+    # Another configuration, or --restart, does not pick up the unfinished run
+    other = rescore_sessions.run_rescoring({}, batch_size=2)
+    restarted = rescore_sessions.run_rescoring(CUSTOM_CONFIG, batch_size=2, restart=True)
+    assert other['sessions'] == restarted['sessions'] == 6
+    assert len({other['run_id'], restarted['run_id']}) == 2
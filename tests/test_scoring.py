@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analisis_audio import (CONFIG, SCORE_TOLERANCE, STATISTICS_COLUMNS, analyze_respiration,
+                            build_respiratory_cycles_table, calculate_balance_score, calculate_depth_score, calculate_stability_score,
+                            cycle_statistics, score_config_variants, score_sessions, score_statistics,
+                            update_cycle_statistics)
+from conftest import synthetic_events
+
+CONFIGS = [
+    {},
+    {'TARGET_IE_RATIO': 2, 'TARGET_CYCLE_DURATION': 14.0},
+    {'PILLAR_WEIGHTS': {'depth': 0.5, 'stability': 0.25, 'balance': 0.25}, 'TARGET_APNEA_PERCENTAGE': 0.2},
+    {'PHASE_STABILITY_WEIGHTS': {'inh': 0.25, 'exh': 0.25, 'ap1': 0.25, 'ap2': 0.25},
+     'INTERNAL_BALANCE_WEIGHTS': {'ie_ratio': 0.5, 'apnea_control': 0.5}}
+]
+
+
+def pandas_scores(df, custom_config):
+    """The pillar scores as the pandas functions compute them from the cycles DataFrame."""
+    config = dict(CONFIG, **custom_config)
+    weights = config['PILLAR_WEIGHTS']
+    depth, stability, balance = (function(df, config) for function in
+                                 (calculate_depth_score, calculate_stability_score, calculate_balance_score))
+    final = weights['depth'] * depth + weights['stability'] * stability + weights['balance'] * balance
+    return {'Depth': depth, 'Stability': stability, 'Internal Balance': balance, 'Final': final}
+
+
+def statistics_durations(df):
+    return df[STATISTICS_COLUMNS].to_numpy(dtype=np.float64)
+
+
+@pytest.mark.parametrize('n_cycles', [1, 2, 17, 400])
+@pytest.mark.parametrize('custom_config', CONFIGS)
+def test_statistics_scores_match_the_pandas_pillars(n_cycles, custom_config):
+    df_table, _ = build_respiratory_cycles_table(synthetic_events(n_cycles, n_cycles))
+    df = df_table[df_table['Cycle'] != 'avg']
+    statistics = cycle_statistics(statistics_durations(df))
+    analysis = score_statistics(statistics, custom_config)
+
+    expected = pandas_scores(df, custom_config)
+    # Formatted to hundredths from slightly different float roundings, see SCORE_TOLERANCE
+    assert {pillar: float(score) for pillar, score in analysis['scores'].items()} == pytest.approx(expected, abs=SCORE_TOLERANCE)
+    assert analysis['num_cycles'] == n_cycles
+    # The batched pass and the DataFrame entry point give the same analysis
+    assert score_sessions(statistics_durations(df), [0], custom_config)[0] == analysis
+    assert analyze_respiration(df_table, custom_config) == analysis
+
+
+def test_config_variants_match_one_config_at_a_time():
+    df_table, _ = build_respiratory_cycles_table(synthetic_events(50))
+    statistics = cycle_statistics(statistics_durations(df_table[df_table['Cycle'] != 'avg']))
+    assert score_config_variants(statistics, CONFIGS) == [score_statistics(statistics, config) for config in CONFIGS]
+
+
+def test_config_variants_apply_stability_weights_by_phase_position():
+    df_table, _ = build_respiratory_cycles_table(synthetic_events(50))
+    statistics = cycle_statistics(statistics_durations(df_table[df_table['Cycle'] != 'avg']))
+    # Weights under other names still apply to the phase columns in order, as in calculate_stability_score
+    configs = [{'PHASE_STABILITY_WEIGHTS': {'a': 1.0, 'b': 0, 'c': 0, 'd': 0}},
+               {'PHASE_STABILITY_WEIGHTS': {'d': 0, 'c': 0, 'b': 0, 'a': 1.0}}]
+    variants = score_config_variants(statistics, configs)
+    assert variants == [score_statistics(statistics, config) for config in configs]
+    assert variants[0]['scores']['Stability'] != variants[1]['scores']['Stability']
+    with pytest.raises(ValueError):
+        score_config_variants(statistics, [configs[0], {'PHASE_STABILITY_WEIGHTS': {'inh': 1.0}}])
+
+
+def test_updated_statistics_equal_the_statistics_of_the_new_cycles():
+    rng = np.random.default_rng(0)
+    durations = rng.uniform(0.5, 12, size=(300, 5)).round(6)
+    statistics = cycle_statistics(durations)
+    for _ in range(100):
+        start = int(rng.integers(len(durations)))
+        stop = start + int(rng.integers(0, 4))
+        added = rng.uniform(0.5, 12, size=(int(rng.integers(0, 4)), 5)).round(6)
+        statistics = update_cycle_statistics(statistics, durations[start:stop], added)
+        durations = np.concatenate([durations[:start], added, durations[stop:]])
+        assert statistics == cycle_statistics(durations)
+
+
+def test_sessions_without_cycles_are_not_scored():
+    assert score_statistics(cycle_statistics(np.zeros((0, 5)))) is None
+    assert score_config_variants(cycle_statistics(np.zeros((0, 5))), CONFIGS) == []
+    assert analyze_respiration(pd.DataFrame(columns=['Cycle'] + STATISTICS_COLUMNS)) is None
@@ -0,0 +1,143 @@
+import threading
+
+import numpy as np
+import pytest
+
+import database
+import session_cache
+from analisis_audio import build_respiratory_cycles_table, analyze_respiration
+from conftest import synthetic_events
+from event_store import EventStore, CYCLE_PATTERN
+from operation_log import edit_operation
+from session_cache import SessionCache
+from session_store import save_session
+
+EDITS_PER_THREAD = 40
+
+
+def create_session(tmp_path, name, n_cycles=20, seed=0):
+    session_folder = tmp_path / name
+    session_folder.mkdir()
+    analysis_data = {'audio_filename': f'{name}.wav', 'duration': 0, 'sampling_rate': 44100,
+                     'events': synthetic_events(n_cycles, seed)}
+    save_session(str(session_folder), analysis_data)
+    df_table, _ = build_respiratory_cycles_table(analysis_data['events'])
+    return database.save_analysis_to_db(str(session_folder), analysis_data, df_table, analyze_respiration(df_table), name)
+
+
+def edit(cache, db_id):
+    """Splits the longest event of the session, as /split does, holding the session's lock throughout."""
+    entry = cache.get(db_id)
+    with entry.lock:
+        before = EventStore.from_records(entry.analysis_data['events'])
+        events = before.copy()
+        longest = events.get(int(events.ids[np.argmax(events.ends - events.starts)]))
+        events.split(longest['id'], round((longest['start'] + longest['end']) / 2, 3))
+        events.relabel(CYCLE_PATTERN)
+        entry.analysis_data['events'] = events.to_records()
+        cache.record(entry, edit_operation('split', before, events, CYCLE_PATTERN))
+        df_table, _ = build_respiratory_cycles_table(events)
+        cache.mark_dirty(entry, df_table, analyze_respiration(df_table))
+    return len(events)
+
+
+@pytest.fixture
+def cache():
+    session_cache = SessionCache(flush_seconds=0.05)
+    yield session_cache
+    session_cache.close()
+
+
+def test_keys_are_normalized(database_file, tmp_path, cache):
+    db_id = create_session(tmp_path, 'a')
+    entry = cache.get(db_id)
+    assert cache.get(str(db_id)) is entry
+    assert cache.get(None) is None
+    assert cache.get('not an id') is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_eviction_does_not_wait_for_the_evicted_session(database_file, tmp_path, cache):
+    db_ids = [create_session(tmp_path, name, seed=seed) for seed, name in enumerate('ab')]
+    held = cache.get(db_ids[1])
+    cache.max_bytes = 1
+    released = threading.Event()
+
+    def hold_lock():
+        # Another request editing session b
+        with held.lock:
+            released.wait(30)
+
+    holder = threading.Thread(target=hold_lock, daemon=True)
+    holder.start()
+    editor = threading.Thread(target=edit, args=(cache, db_ids[0]), daemon=True)
+    editor.start()
+    # Editing session a evicts session b, whose lock is held
+    editor.join(timeout=10)
+    finished = not editor.is_alive()
+    released.set()
+    holder.join()
+    assert finished, "the edit waited for the evicted session's lock"
+    assert cache.stats()['evictions'] == 1
+
+
+def test_concurrent_edits_that_evict_each_other(database_file, tmp_path, cache):
+    # Every session alone is over the budget, so each edit evicts the other thread's session
+    cache.max_bytes = 1
+    db_ids = [create_session(tmp_path, name, seed=seed) for seed, name in enumerate('ab')]
+    counts = {}
+    errors = []
+
+    def run(db_id):
+        try:
+            for _ in range(EDITS_PER_THREAD):
+                counts[db_id] = edit(cache, db_id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(db_id,), daemon=True) for db_id in db_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert not any(thread.is_alive() for thread in threads), "edits deadlocked"
+    assert not errors
+    assert cache.stats()['evictions'] > 0
+
+    cache.flush_all()
+    assert cache.stats()['evicted_pending'] == 0
+    # A cold cache rebuilds every session from what was flushed, with all the edits
+    reloaded = SessionCache()
+    for db_id in db_ids:
+        assert len(reloaded.get(db_id).analysis_data['events']) == counts[db_id] == 80 + EDITS_PER_THREAD
+        assert reloaded.get(db_id).history.version == EDITS_PER_THREAD + 1
+
+
+def test_evicted_session_is_served_until_flushed(database_file, tmp_path):
+    db_ids = [create_session(tmp_path, name, seed=seed) for seed, name in enumerate('ab')]
+    cache = SessionCache(max_bytes=1, flush_seconds=60)
+    edit(cache, db_ids[0])
+    entry = cache.get(db_ids[0])
+    # Loading the other session evicts the edited one before the background flush runs
+    cache.get(db_ids[1])
+    assert cache.stats()['evicted_pending'] == 1
+    assert cache.get(db_ids[0]) is entry
+    assert entry.dirty
+    cache.close()
+    assert not entry.dirty
+
+
+def test_size_follows_the_edits(database_file, tmp_path, cache):
+    db_id = create_session(tmp_path, 'a')
+    entry = cache.get(db_id)
+    for step in range(12):
+        if step % 4 == 3:
+            cache.undo(entry)
+        elif step % 4 == 2 and step > 6:
+            cache.redo(entry)
+        else:
+            edit(cache, db_id)
+        assert entry.event_count == len(entry.analysis_data['events'])
+        assert entry.size == (session_cache.SESSION_OVERHEAD_BYTES
+                              + session_cache.EVENT_BYTES * (entry.event_count + entry.history.event_count()))
+        assert cache.stats()['bytes'] == entry.size